@@ -0,0 +1,31 @@
+import click
+import logging
+import uncoverml as ls
+import uncoverml.config
+import uncoverml.geoio
+import uncoverml.mllog
+import uncoverml.mpiops
+log = logging.getLogger(__name__)
+
+
+@click.command()
+@click.argument('pipeline_file')
+@click.argument('cube_file', type=click.Path(exists=False))
+@click.option('-c', '--chunk_mb', type=float, default=32.,
+              help='approximate size of each chunk of the cube in MB')
+@click.option('-l', '--complevel', type=click.IntRange(0, 9), default=0,
+              help='blosc compression level, 0 for an uncompressed cube')
+@click.option('-v', '--verbosity',
+              type=click.Choice(['DEBUG', 'INFO', 'WARNING', 'ERROR']),
+              default='INFO', help='Level of logging')
+def cli(pipeline_file, cube_file, chunk_mb, complevel, verbosity):
+    """
+    Stack the covariates of PIPELINE_FILE into the HDF5 cube CUBE_FILE.
+
+    Add `cube: {file: CUBE_FILE}` to the pipeline file to read the
+    covariates from the cube instead of the individual GeoTIFFs.
+    """
+    uncoverml.mllog.configure(verbosity)
+    config = ls.config.Config(pipeline_file)
+    ls.mpiops.run_once(ls.geoio.write_covariate_cube, config, cube_file,
+                       chunk_mb, complevel)
@@ -61,6 +61,7 @@ setup(
             'geoinfo = preprocessing.geoinfo:cli',
             'resample = preprocessing.resample:cli',
             'rasteraverage = preprocessing.raster_average:cli',
+            'stackcovariates = preprocessing.stack:cli',
             'gridsearch = uncoverml.scripts.gridsearch:cli'
         ]
     },
@@ -2,7 +2,8 @@
 import numpy as np
 from sklearn.metrics import r2_score
 
-from uncoverml.cubist import Cubist, MultiCubist
+from uncoverml import cubist
+from uncoverml.cubist import Cubist, MultiCubist, Rule, CompiledRules
 
 # Declare some test data taken from the boston houses dataset
 x = np.array([
@@ -93,3 +94,47 @@ def test_multicibist_mpi(mpisync):
     score = r2_score(y, y_pred_p)
 
     assert 0.7 < score < 0.8
+
+
+def _rule_text(rnd, n_features, thresholds):
+    conditions = []
+    for _ in range(rnd.randint(0, 4)):
+        feature = rnd.randint(n_features)
+        if feature == 7:
+            conditions.append('type="3" att="f7.tif_7" elts="{}","{}"'.format(
+                *rnd.choice(5, 2, replace=False) + 1))
+        else:
+            conditions.append('type="2" att="f{0}.tif_{0}" cut="{1}" '
+                              'result="{2}"'.format(
+                                  feature, rnd.choice(thresholds[feature]),
+                                  rnd.choice(['<', '>', '<=', '>='])))
+    features = rnd.choice(n_features, 2, replace=False)
+    polynomial = 'coeff="{}" att="f{}.tif_{}" coeff="{}"'.format(
+        rnd.randn(), features[0], features[0], rnd.randn())
+    lines = ['="1" cover="1" mean="0"'] + conditions + [polynomial]
+    return '\n'.join(lines) + '\n'
+
+
+def test_compiled_rules(monkeypatch):
+    # several blocks of rows, not filling whole bytes of the bitsets
+    monkeypatch.setattr(cubist, 'BLOCK_ROWS', 6)
+    rnd = np.random.RandomState(2)
+    n, m = x.shape
+    # few enough thresholds that rules share conditions
+    thresholds = [np.percentile(x[:, i], [25, 50, 75]) for i in range(m)]
+    models = [[Rule(_rule_text(rnd, m, thresholds), m)
+               for _ in range(rnd.randint(1, 30))] for _ in range(6)]
+    rules = CompiledRules(models, m)
+    n_conditions = sum(len(r.conditions) for model in models for r in model)
+    assert rules.n_conditions < n_conditions
+
+    # rows with missing values only count towards the rules they satisfy
+    x_nan = x.copy()
+    x_nan[[1, 8], [3, 5]] = np.nan
+    for features in x, x_nan:
+        expected = np.zeros((n, len(models)))
+        for i, model in enumerate(models):
+            for rule in model:
+                mask = rule.satisfied(features)
+                expected[mask, i] += rule.regress(features, mask)
+        assert np.allclose(rules.predict(features), expected, equal_nan=True)
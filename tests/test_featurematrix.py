@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+from uncoverml import features
+from uncoverml import transforms
+from uncoverml.featurematrix import FeatureMatrix
+from uncoverml.models import apply_masked
+
+
+@pytest.mark.parametrize('missing', [0., 0.05, 0.5])
+def test_featurematrix_roundtrip(missing):
+    x = np.ma.masked_array(np.random.rand(50, 11),
+                           mask=np.random.rand(50, 11) < missing)
+    m = FeatureMatrix.from_masked(x)
+    assert m.shape == x.shape and len(m) == 50
+    assert np.all(m.valid_rows == ~np.any(np.ma.getmaskarray(x), axis=1))
+    assert np.all(m.mask == np.ma.getmaskarray(x))
+    assert m.complete == (not np.any(x.mask))
+    assert m.nbytes < x.data.nbytes + np.ma.getmaskarray(x).nbytes
+    y = m.to_masked()
+    assert np.all(y.data == x.data) and np.all(y.mask == x.mask)
+
+    rows = np.random.rand(50) < 0.5
+    assert np.all(m[rows].mask == np.ma.getmaskarray(x)[rows])
+    both = FeatureMatrix.concatenate([m, FeatureMatrix(x.data[:7])])
+    assert np.all(both.mask[:50] == np.ma.getmaskarray(x))
+    assert not np.any(both.mask[50:])
+    side = FeatureMatrix.hstack([FeatureMatrix(x.data[:, :2]), m])
+    assert np.all(side.mask[:, 2:] == np.ma.getmaskarray(x))
+    assert not np.any(side.mask[:, :2])
+    cols = np.arange(11) % 3 > 0
+    assert np.all(m[:, cols].mask == np.ma.getmaskarray(x)[:, cols])
+    assert np.all(m.count() == np.ma.count(x, axis=0))
+
+
+@pytest.mark.parametrize('transform', [
+    transforms.MeanImputer, transforms.GaussImputer,
+    transforms.CentreTransform, transforms.StandardiseTransform,
+    lambda: transforms.WhitenTransform(0.5)])
+def test_featurematrix_transforms(transform):
+    x = np.ma.masked_array(np.random.rand(60, 5),
+                           mask=np.random.rand(60, 5) < 0.05)
+    expected = transform()(x.copy())
+    result = transform()(FeatureMatrix.from_masked(x.copy()))
+    assert isinstance(result, FeatureMatrix)
+    mask = np.ma.getmaskarray(expected)
+    assert np.all(result.mask == mask)
+    assert np.allclose(result.data[~mask], expected.data[~mask])
+
+
+def test_featurematrix_onehot():
+    x = np.ma.masked_array(np.random.randint(0, 4, (30, 2)),
+                           mask=np.random.rand(30, 2) < 0.1)
+    onehot = transforms.OneHotTransform()
+    result = onehot(FeatureMatrix.from_masked(x))
+    assert [list(s) for s in onehot.x_sets] == \
+        [list(np.unique(x[:, i].compressed())) for i in range(2)]
+    expected = [transforms.OneHotTransform()(x[:, np.newaxis, np.newaxis, [i]])
+                for i in range(2)]
+    expected = np.ma.concatenate([e.reshape(30, -1) for e in expected],
+                                 axis=1)
+    assert np.all(result.mask == expected.mask)
+    assert np.all(result.data == expected.data)
+
+
+def test_featurematrix_apply_masked():
+    x = np.ma.masked_array(np.random.rand(40, 3),
+                           mask=np.random.rand(40, 3) < 0.1)
+
+    def f(a):
+        return np.column_stack((a.sum(axis=1), a[:, 0]))
+
+    expected = apply_masked(f, x)
+    result = apply_masked(f, FeatureMatrix.from_masked(x))
+    assert np.all(result.mask == expected.mask)
+    assert np.all(result[~result.mask] == expected[~expected.mask])
+
+
+def test_gather_features():
+    x = np.ma.masked_array(np.random.rand(20, 4),
+                           mask=np.random.rand(20, 4) < 0.2)
+    x_all = features.gather_features(x)
+    assert np.all(x_all.data == x.data) and np.all(x_all.mask == x.mask)
+    x_all = features.gather_features(FeatureMatrix.from_masked(x))
+    assert np.all(x_all.data == x.data) and np.all(x_all.mask == x.mask)
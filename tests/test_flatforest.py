@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from sklearn.ensemble import RandomForestRegressor
+
+from uncoverml import flatforest
+from uncoverml.flatforest import FlatForest
+
+
+@pytest.fixture
+def forests():
+    rnd = np.random.RandomState(3)
+    X = rnd.randn(300, 4)
+    y = X[:, 0] + np.sin(3 * X[:, 1]) + 0.1 * rnd.randn(300)
+    return X, [RandomForestRegressor(n_estimators=5, random_state=s).fit(X, y)
+               for s in range(2)]
+
+
+def test_flatforest_predict(forests, tmpdir, monkeypatch):
+    X, rfs = forests
+    # several blocks of rows, the last one partial
+    monkeypatch.setattr(flatforest, 'BLOCK_ROWS', 64)
+    Xs = np.random.RandomState(4).randn(150, 4)
+    trees = [dt for rf in rfs for dt in rf.estimators_]
+    y = np.array([np.exp(dt.predict(Xs)) for dt in trees])
+
+    forest = FlatForest.concatenate([FlatForest.from_trees(rf.estimators_,
+                                                           np.exp)
+                                     for rf in rfs])
+    assert forest.n_trees == 10
+    Ey, Vy = forest.predict_moments(Xs)
+    assert np.allclose(Ey, y.mean(axis=0))
+    assert np.allclose(Vy, y.var(axis=0))
+    threaded = forest.predict_moments(Xs, n_jobs=3)
+    assert np.array_equal(threaded[0], Ey)
+    assert np.array_equal(threaded[1], Vy)
+
+    # the split points of the training data are where rounding matters
+    for dt in trees:
+        assert np.array_equal(FlatForest.from_trees([dt]).predict(X),
+                              dt.predict(X))
+
+    forest.save(str(tmpdir.join('forest')))
+    loaded = FlatForest.load(str(tmpdir.join('forest')))
+    assert isinstance(loaded.feature, np.memmap)
+    assert np.array_equal(loaded.predict(Xs), Ey)
+    with pytest.raises(FileNotFoundError):
+        FlatForest.load(str(tmpdir.join('missing')))
@@ -1,10 +1,14 @@
+import os
+
 import pytest
 from affine import Affine
 import numpy as np
 import rasterio
 
 from uncoverml import geoio
+from uncoverml import image
 from uncoverml.image import Image
+from uncoverml.featurestore import FeatureStore
 
 crs = rasterio.crs.CRS({'init': 'epsg:4326'})
 
@@ -143,6 +147,29 @@ def test_pix2latlong(pix_size_single, origin_point, is_flipped,
     assert np.all(lonlats == true_d)
 
 
+def test_grid_geometry():
+    origin = (-0.3, 12.1)
+    pixsize = (1. / 3., 0.00025)
+    shape = (37, 23)
+    geom = image.grid_geometry(*(origin + pixsize + shape))
+    assert image.grid_geometry(*(origin + pixsize + shape)) is geom
+
+    corners = np.array([[x, y] for x in range(shape[0] + 1)
+                        for y in range(shape[1] + 1)])
+    lonlat = geom.pix2lonlat(corners)
+    assert np.all(lonlat == [[origin[0] + float(x) * pixsize[0],
+                              origin[1] + float(y) * pixsize[1]]
+                             for x, y in corners])
+    # points on a corner belong to the pixel above, except on the far edge
+    expected = np.minimum(corners, np.array(shape) - 1)
+    assert np.all(geom.lonlat2pix(lonlat) == expected)
+    below = np.nextafter(lonlat, -np.inf)
+    assert np.all(geom.lonlat2pix(below) == expected - (corners < shape))
+    outside = np.array([[origin[0] - 1., origin[1]],
+                        [origin[0] + 100., origin[1]]])
+    assert np.all(geom.lonlat2pix(outside)[:, 0] == [-1, shape[0]])
+
+
 def test_load_shapefile(shapefile):
     true_lonlats, filename = shapefile
     for i in range(10):
@@ -244,3 +271,279 @@ def test_Image_split_overlap(array_image_src, num_chunks, overlap_pixels):
     Irecon = np.hstack(Ichunks)
     assert I.shape == Irecon.shape
     assert np.all(I == Irecon)
+
+
+def _write_geotiff(filename, data, **kwargs):
+    data = data[np.newaxis] if data.ndim == 2 else data
+    A = Affine(1., 0, 0., 0, -1., float(data.shape[1]))
+    with rasterio.open(filename, 'w', driver='GTiff', width=data.shape[2],
+                       height=data.shape[1], count=data.shape[0],
+                       dtype=data.dtype, crs=crs, transform=A,
+                       **kwargs) as f:
+        f.write(data)
+
+
+@pytest.mark.parametrize('dtype, nodata', [(np.float32, -1.),
+                                           (np.float64, None),
+                                           (np.uint8, 0)])
+def test_rasterio_image_source_data(random_filename, dtype, nodata):
+    data = (np.random.rand(2, 13, 9) * 5).astype(dtype)
+    if data.dtype.kind == 'f':
+        data[1, 3, 4] = np.nan
+    filename = random_filename(ext='.tif')
+    _write_geotiff(filename, data, nodata=nodata)
+
+    src = geoio.RasterioImageSource(filename)
+    d = src.data(2, 8, 3, 11)
+    with rasterio.open(filename) as f:
+        expected = f.read(masked=True)
+    # (band, row, col) -> (x, y, band) with y running up the image
+    expected = np.ma.transpose(expected, [2, 1, 0])[:, ::-1][2:8, 3:11]
+    expected_mask = np.ma.getmaskarray(expected) | np.isnan(expected.data)
+    assert d.dtype == data.dtype
+    assert d.data.flags.c_contiguous and d.mask.flags.c_contiguous
+    assert d.mask.shape == d.shape
+    assert np.all(d.mask == expected_mask)
+    assert np.all(d.data[~d.mask] == expected.data[~expected_mask])
+
+
+def test_dataset_pool(random_filename):
+    names = [random_filename(ext='.tif') for _ in range(3)]
+    for i, n in enumerate(names):
+        _write_geotiff(n, np.full((4, 5), i, dtype=np.float32))
+
+    pool = geoio.DatasetPool(max_open=2)
+    for n in names[:2]:
+        with pool.dataset(n) as ds:
+            assert ds.width == 5
+    with pool.dataset(names[0]) as ds:
+        assert np.all(ds.read(1) == 0)
+    assert pool.stats() == {'opens': 2, 'hits': 1, 'evictions': 0, 'open': 2}
+
+    # names[1] is least recently used so is the one closed
+    with pool.dataset(names[2]) as ds2:
+        assert np.all(ds2.read(1) == 2)
+    assert pool.stats() == {'opens': 3, 'hits': 1, 'evictions': 1, 'open': 2}
+    with pool.dataset(names[0]):
+        pass
+    assert pool.hits == 2
+
+    # borrowed handles are never evicted
+    with pool.dataset(names[1]) as ds1:
+        with pool.dataset(names[2]) as ds2:
+            with pool.dataset(names[0]) as ds0:
+                assert not (ds0.closed or ds1.closed or ds2.closed)
+    assert pool.stats()['open'] == 2
+
+    # concurrent borrowers of a file each get their own handle
+    with pool.dataset(names[0]) as ds:
+        with pool.dataset(names[0]) as other:
+            assert ds is not other
+    assert pool.stats()['open'] == 2
+
+    pool.close_all()
+    assert pool.stats()['open'] == 0
+
+
+@pytest.mark.parametrize('block_phase', [0, 3])
+def test_construct_splits_block_aligned(num_chunks, block_phase):
+    npixels = 500
+    block_rows = 16
+    splits = image.construct_splits(npixels, num_chunks,
+                                    block_rows=block_rows,
+                                    block_phase=block_phase)
+    assert splits[0][0] == 0
+    assert splits[-1][1] == npixels
+    for (_, end), (start, _) in zip(splits[:-1], splits[1:]):
+        assert end == start
+        assert (start - block_phase) % block_rows == 0
+
+
+def test_construct_splits_unaligned_fallback():
+    # fewer blocks than chunks, so just split evenly
+    splits = image.construct_splits(40, 4, overlap=1, block_rows=32)
+    assert splits == [(0, 11), (9, 21), (19, 31), (29, 40)]
+
+
+class _CubeConfig:
+    def __init__(self, files, cube):
+        self.feature_sets = [type('FeatureSet', (), {'files': files})]
+        self.cube = cube
+
+
+def test_covariate_cube(random_filename):
+    cont = np.random.rand(30, 20).astype(np.float32)
+    cont[3, 4] = -1.
+    cont[10, 2] = np.nan
+    cat = np.random.randint(0, 5, size=(2, 30, 20)).astype(np.uint8)
+    names = [random_filename(ext='.tif') for _ in range(3)]
+    _write_geotiff(names[0], cont, nodata=-1.)
+    _write_geotiff(names[1], cat, nodata=0)
+    _write_geotiff(names[2], cont)
+    cube = random_filename(ext='.h5')
+    config = _CubeConfig(names[:2], cube)
+    geoio.write_covariate_cube(config, cube, chunk_mb=0.001)
+
+    for tif in names[:2]:
+        tif_src = geoio.RasterioImageSource(tif)
+        cube_src = geoio.covariate_source(tif, config)
+        assert isinstance(cube_src, geoio.CubeImageSource)
+        assert cube_src.full_resolution == tif_src.full_resolution
+        assert cube_src.dtype == tif_src.dtype
+        assert cube_src.origin_latitude == tif_src.origin_latitude
+        assert cube_src.pixsize_y == tif_src.pixsize_y
+        for window in [(0, 20, 0, 30), (3, 11, 5, 17)]:
+            expected = tif_src.data(*window)
+            d = cube_src.data(*window)
+            assert np.all(d.mask == expected.mask)
+            assert np.all(d.data[~d.mask] == expected.data[~d.mask])
+
+    # not stacked, so read from the GeoTIFF
+    assert isinstance(geoio.covariate_source(names[2], config),
+                      geoio.RasterioImageSource)
+
+
+def test_iterate_sources_threaded(random_filename, monkeypatch):
+    names = [random_filename(ext='.tif') for _ in range(6)]
+    for n in names:
+        _write_geotiff(n, np.random.rand(12, 9).astype(np.float32))
+    config = _CubeConfig(names[:4], None)
+    config.feature_sets.append(type('FeatureSet', (), {'files': names[4:]}))
+
+    def f(image_source):
+        return image_source.data(0, 9, 0, 12)
+
+    serial = geoio._iterate_sources(f, config)
+    monkeypatch.setattr(geoio, 'io_threads', 4)
+    threaded = geoio._iterate_sources(f, config)
+    assert [list(s.keys()) for s in threaded] == \
+        [list(s.keys()) for s in serial]
+    assert list(threaded[0].keys()) == sorted(os.path.basename(n)
+                                              for n in names[:4])
+    for s, t in zip(serial, threaded):
+        for k in s:
+            assert np.all(s[k] == t[k])
+
+    # reads submitted ahead of time are collected in the same order
+    with geoio.ThreadPoolExecutor(max_workers=2) as executor:
+        reads = geoio._submit_reads(f, config, executor)
+        prefetched = geoio._iterate_sources(f, config, reads)
+    assert not reads
+    for s, t in zip(serial, prefetched):
+        for k in s:
+            assert np.all(s[k] == t[k])
+
+
+@pytest.mark.parametrize('multiband, compress', [(False, None),
+                                                 (True, 'deflate')])
+def test_image_writer_parallel(random_filename, multiband, compress):
+    width, height, n_subchunks = 7, 23, 3
+    bbox = np.array([[10., -20.], [17., 3.]])
+    y = np.ma.masked_array(np.random.rand(width * height, 2),
+                           mask=np.random.rand(width * height, 2) < 0.1)
+    starts = image.chunk_starts(height, n_subchunks)
+    ends = list(starts[1:]) + [height]
+    grid = y.reshape(width, height, 2)
+
+    outputs = {}
+    for parallel in [False, True]:
+        outdir = os.path.dirname(random_filename())
+        writer = geoio.ImageWriter((width, height), bbox, crs, 'pred',
+                                   n_subchunks, outdir,
+                                   band_tags=['Prediction', 'Variance'],
+                                   parallel=parallel, multiband=multiband,
+                                   compress=compress,
+                                   overviews=multiband)
+        for i, (s, e) in enumerate(zip(starts, ends)):
+            writer.write(grid[:, s:e].reshape(-1, 2), i)
+        writer.close()
+        ext = '.vrt' if parallel else '.tif'
+        names = ['pred' + ext] if multiband else \
+            ['pred_prediction' + ext, 'pred_variance' + ext]
+        assert [os.path.basename(f) for f in writer.filenames] == names
+        outputs[parallel] = []
+        for f in writer.filenames:
+            with rasterio.open(f) as ds:
+                assert ds.transform == writer.A
+                assert ds.nodata == writer.nodata_value
+                if multiband:
+                    assert ds.descriptions == ('Prediction', 'Variance')
+                    assert ds.tags(2)['image_type'] == 'Variance'
+                if compress and not parallel:
+                    assert ds.compression.value.lower() == compress
+                    assert ds.block_shapes[0] == (writer.block_size,) * 2
+                if multiband and not parallel:
+                    assert ds.overviews(1) == [2]
+                outputs[parallel].append(ds.read())
+
+    if compress:
+        for _, _, tile in writer.tiles:
+            with rasterio.open(tile) as ds:
+                assert ds.compression.value.lower() == compress
+    for funnel, tiled in zip(outputs[False], outputs[True]):
+        assert funnel.shape == (2 if multiband else 1, height, width)
+        assert np.all(funnel == tiled)
+    prediction = outputs[True][0][0]
+    assert np.sum(prediction == geoio.ImageWriter.nodata_value) == \
+        np.sum(y.mask[:, 0])
+
+
+def test_feature_store(random_filename):
+    names = [random_filename(ext='.tif') for _ in range(3)]
+    for n in names:
+        _write_geotiff(n, np.random.rand(12, 9).astype(np.float32))
+    config = _CubeConfig(names, None)
+    config.patchsize = 0
+    config.patch_stats = None
+    config.target_file = random_filename(ext='.shp')
+    with open(config.target_file, 'wb') as f:
+        f.write(b'targets')
+    lonlat = np.column_stack((np.random.rand(20) * 9,
+                              np.random.rand(20) * 12))
+
+    def cached(rows):
+        targets = geoio.Targets(lonlat[rows], np.zeros(len(rows)))
+        config.feature_store = None
+        expected = geoio.image_feature_sets(targets, config)
+        store = os.path.dirname(names[0]) + '_store'
+        config.feature_store = store
+        result = geoio.image_feature_sets(targets, config)
+        for s, t in zip(expected[0].values(), result[0].values()):
+            assert np.all(s.data == t.data) and np.all(s.mask == t.mask)
+        return len(os.listdir(store))
+
+    assert cached(np.arange(10)) == 3
+    # targets resampled or split differently are looked up by position
+    assert cached(np.array([9, 0, 0, 4])) == 3
+    # and new ones are added to the entries
+    assert cached(np.arange(5, 20)) == 3
+    assert cached(np.arange(20)[::-1]) == 3
+    # a changed covariate is intersected again
+    _write_geotiff(names[1], np.random.rand(12, 9).astype(np.float32))
+    os.utime(names[1], (1, 1))
+    assert cached(np.arange(20)) == 4
+
+
+def test_feature_store_rows(tmpdir):
+    store = FeatureStore(str(tmpdir))
+    covariate = str(tmpdir.join('covariate.tif'))
+    key = {'path': covariate}
+    lonlat = np.random.rand(6, 2)
+
+    def extract(positions):
+        extracted.append(len(positions))
+        return np.ma.masked_array(positions[:, :1], mask=positions[:, :1] > .5)
+
+    extracted = []
+    store.fetch(key, lonlat[:4], extract)
+    store.update(covariate)
+    x = store.fetch(key, lonlat[[5, 1, 3]], extract)
+    store.update(covariate)
+    rows = [3, 5, 0, 2, 1]
+    x_stored = store.fetch(key, lonlat[rows], extract)
+    assert extracted == [4, 1]
+    assert store.hits == 1 and store.misses == 2
+    assert np.all(x.data == lonlat[[5, 1, 3], :1])
+    assert np.all(x.mask == (lonlat[[5, 1, 3], :1] > .5))
+    assert np.all(x_stored.data == lonlat[rows, :1])
+    assert np.all(x_stored.mask == (lonlat[rows, :1] > .5))
@@ -1,10 +1,13 @@
 import numpy as np
 import pytest
+from scipy.integrate import fixed_quad
 from sklearn.metrics import r2_score
 
 from uncoverml.krige import krige_methods, Krige, all_ml_models, MLKrige
-from uncoverml.models import modelmaps
+from uncoverml.models import modelmaps, _quadrature_moments, _normpdf, \
+    QUADORDER, RandomForestRegressor
 from uncoverml.optimise.models import transformed_modelmaps
+from uncoverml.transforms import target as transforms
 
 models = list(modelmaps.keys()) + list(transformed_modelmaps.keys())
 
@@ -111,6 +114,53 @@ def test_mlkrige(linear_data, models_supported, get_krige_method):
     assert r2_score(ys2, Ey) > 0
 
 
+@pytest.mark.parametrize('transform', ['sqrt', 'log', 'rank', 'kde'])
+def test_quadrature_moments(transform):
+    rnd = np.random.RandomState(1)
+    ytform = transforms.transforms[transform]()
+    ytform.fit(np.exp(rnd.randn(100)) + 0.1)
+    Ey_t = 0.5 * rnd.randn(11) + 1
+    Vy_t = rnd.uniform(0.01, 0.2, 11)
+
+    def expec_int(x, mu, std):
+        return ytform.itransform(x) * _normpdf(x, mu, std)
+
+    def var_int(x, Ex, mu, std):
+        return (ytform.itransform(x) - Ex)**2 * _normpdf(x, mu, std)
+
+    # a pixel at a time, as the quadrature used to be
+    Ey = np.empty_like(Ey_t)
+    Vy = np.empty_like(Vy_t)
+    for i, (Eyi, Vyi) in enumerate(zip(Ey_t, Vy_t)):
+        Syi = np.sqrt(Vyi)
+        a, b = Eyi - 3 * Syi, Eyi + 3 * Syi
+        Ey[i], _ = fixed_quad(expec_int, a, b, n=QUADORDER,
+                              args=(Eyi, Syi))
+        Vy[i], _ = fixed_quad(var_int, a, b, n=QUADORDER,
+                              args=(Ey[i], Eyi, Syi))
+
+    Ey_batched, Vy_batched = _quadrature_moments(ytform.itransform, Ey_t,
+                                                 Vy_t, batch=4)
+    assert np.array_equal(Ey_batched, Ey)
+    assert np.array_equal(Vy_batched, Vy)
+
+
+@pytest.mark.parametrize('n_jobs', [1, 3])
+def test_randomforest_predict_proba(linear_data, n_jobs):
+    yt, Xt, ys, Xs = linear_data()
+    rf = RandomForestRegressor(n_estimators=10, n_jobs=n_jobs)
+    rf.fit(Xt, yt)
+    Ey, Vy, ql, qu = rf.predict_proba(Xs)
+
+    # every tree predicting twice, as it used to
+    Ey_two_pass = rf.predict(Xs)
+    Vy_two_pass = np.mean([(dt.predict(Xs) - Ey_two_pass)**2
+                           for dt in rf.estimators_], axis=0)
+    assert np.allclose(Ey, Ey_two_pass)
+    assert np.allclose(Vy, Vy_two_pass)
+    assert ql.shape == qu.shape == Ey.shape
+
+
 # def test_modelpersistance(make_fakedata):
 
 #     X, y, _, mod_dir = make_fakedata
@@ -1,9 +1,12 @@
 # import copy
+import os
+import subprocess
+import sys
 
 import numpy as np
 import pytest
 
-from uncoverml import mpiops
+from uncoverml import backends, mpiops
 # from uncoverml import pipeline
 # from uncoverml import transforms
 
@@ -60,6 +63,68 @@ def test_covariance(mpisync, masked_array):
     assert np.allclose(c_true, c)
 
 
+def test_allreduce_array(mpisync):
+    x = np.arange(6, dtype=np.int32).reshape(2, 3) + mpiops.chunk_index
+    total = mpiops.allreduce_array(x)
+    assert total.dtype == np.int32
+    assert np.all(total == mpiops.comm.allreduce(x))
+    largest = mpiops.allreduce_array(mpiops.chunk_index, op=mpiops.MAX)
+    assert largest == mpiops.chunks - 1
+
+
+def test_allreduce_masked(mpisync):
+    x = np.ma.masked_array(data=[1., 2., 3.],
+                           mask=[mpiops.chunk_index == 0, True, False])
+    total = mpiops.allreduce_masked(x)
+    assert np.all(total.mask == [mpiops.chunks == 1, True, False])
+    assert total[2] == 3. * mpiops.chunks
+    assert np.allclose(total, mpiops.comm.allreduce(x, op=mpiops.sum0_op))
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.int64, bool])
+def test_gather_array(mpisync, masked_array, dtype):
+    x, x_all = masked_array
+    # a different number of rows on every node, none on some
+    x = x[:mpiops.chunk_index * 3].astype(dtype)
+    x_all = np.ma.concatenate(mpiops.comm.allgather(x), axis=0)
+    for root in [None, 0]:
+        result = mpiops.gather_array(x, root=root)
+        if root is not None and mpiops.chunk_index != root:
+            assert result is None
+            continue
+        assert result.dtype == x_all.dtype
+        assert np.all(np.ma.getmaskarray(result) ==
+                      np.ma.getmaskarray(x_all))
+        assert np.all(result.data == x_all.data)
+    plain = mpiops.gather_array(x.data)
+    assert not np.ma.isMaskedArray(plain)
+    assert np.all(plain == x_all.data)
+
+
+def test_bcast_array(mpisync):
+    x = np.arange(5, dtype=np.float32) if mpiops.chunk_index == 0 else None
+    x = mpiops.bcast_array(x, root=0)
+    assert x.dtype == np.float32
+    assert np.all(x == np.arange(5))
+
+
+def test_moments(mpisync, masked_array):
+    x, x_all = masked_array
+    moments = mpiops.Moments(2, covariance=True)
+    # in uneven chunks, one of them empty
+    for rows in np.split(np.arange(len(x)), [3, 3, 8]):
+        moments.update(x[rows])
+    moments = moments.allreduce()
+    mean = np.ma.mean(x_all, axis=0).data
+    assert np.allclose(moments.mean, mean)
+    assert np.allclose(moments.sd, np.ma.std(x_all, axis=0).data)
+    # products of deviations from the column means where both are present
+    centred = np.ma.filled(x_all - mean, 0)
+    present = (~x_all.mask).astype(float)
+    cov = np.dot(centred.T, centred) / np.dot(present.T, present)
+    assert np.allclose(moments.covariance, cov)
+
+
 class DummySettings:
     def __init__(self):
         pass
@@ -71,6 +136,11 @@ def test_sd(mpisync, masked_array):
     sd_true = np.ma.std(x_all, axis=0, ddof=0).data
     assert np.allclose(sd, sd_true)
 
+    # a column without data has no sd
+    x = np.ma.masked_array(np.ones((4, 2)), mask=[[False, True]] * 4)
+    with pytest.raises(ValueError):
+        mpiops.sd(x)
+
 
 def test_random_full_points():
 
@@ -82,9 +152,90 @@ def test_random_full_points():
 
     Xp = mpiops.random_full_points(X, 80)
 
-    assert Xp.shape[1] == 3
+    assert Xp.shape == (80, 3)
     assert np.ma.count_masked(Xp) == 0
 
     Xp = mpiops.random_full_points(X, 200)
 
     assert Xp.shape[0] <= 100
+
+
+def test_random_full_points_sparse(mpisync):
+    # only a few complete rows, on some of the nodes
+    Xd = np.arange(300.).reshape(100, 3) + 1000 * mpiops.chunk_index
+    Xm = np.ones_like(Xd, dtype=bool)
+    if mpiops.chunk_index % 2 == 0:
+        Xm[::25] = False
+    X = np.ma.MaskedArray(data=Xd, mask=Xm)
+    complete = Xd[~Xm.any(axis=1)]
+    complete_all = np.concatenate(mpiops.comm.allgather(complete))
+
+    Xp = mpiops.random_full_points(X, 3)
+    assert Xp.shape == (min(3, len(complete_all)), 3)
+    # the rows are complete rows, the same on every node
+    assert np.all(np.isin(Xp[:, 0], complete_all[:, 0]))
+    assert np.all(mpiops.bcast_array(Xp) == Xp)
+
+    Xp = mpiops.random_full_points(X, 1000)
+    assert np.all(np.sort(Xp[:, 0]) == np.sort(complete_all[:, 0]))
+
+
+_local_script = """
+import numpy as np
+from uncoverml import mpiops
+mpiops.init('local', 3)
+x = np.ma.masked_array(np.arange(4.) + 10 * mpiops.chunk_index,
+                       mask=[mpiops.chunk_index == 1, False, False, False])
+total = mpiops.allreduce_array(np.arange(3))
+rows = mpiops.gather_array(x[:mpiops.chunk_index + 1, np.newaxis])
+mean = mpiops.mean(x[:, np.newaxis])
+largest = mpiops.comm.allreduce(mpiops.chunk_index, op=mpiops.MAX)
+point = mpiops.comm.bcast(mpiops.chunk_index, root=2)
+if mpiops.chunk_index == {fail}:
+    raise SystemExit(1)
+mpiops.comm.barrier()
+if mpiops.chunk_index == 0:
+    print(mpiops.chunks, total.tolist(), rows.ravel().tolist(),
+          float(mean[0]), largest, point)
+"""
+
+
+def test_local_backend():
+    # not an MPI process, even when the tests are
+    env = dict(os.environ, UNCOVERML_BACKEND='single')
+    package = os.path.dirname(os.path.dirname(mpiops.__file__))
+    env['PYTHONPATH'] = os.pathsep.join([package] +
+                                        env.get('PYTHONPATH', '').split(
+                                            os.pathsep))
+    out = subprocess.run([sys.executable, '-c',
+                          _local_script.format(fail=-1)], env=env,
+                         stdout=subprocess.PIPE, timeout=60, check=True)
+    expected = "3 [0, 3, 6] [0.0, None, 11.0, 20.0, 21.0, 22.0] {} 2 2"
+    assert out.stdout.decode().strip() == expected.format(128 / 11)
+
+    # a node failing doesn't leave the others waiting
+    out = subprocess.run([sys.executable, '-c',
+                          _local_script.format(fail=1)], env=env,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         timeout=60)
+    assert out.returncode != 0
+
+
+def test_profiled_comm():
+    comm = backends.ProfiledComm(mpiops.comm)
+    x = np.ones((10, 3))
+    for _ in range(2):
+        total = comm.allreduce(x)
+    comm.barrier()
+    assert np.all(total == mpiops.chunks)
+
+    rows, elapsed = comm.report()
+    calls = {r[1]: r for r in rows}
+    assert set(calls) == {'allreduce', 'barrier'}
+    site, _, count, nbytes, mean_s, max_s, skew = calls['allreduce']
+    assert site.startswith('test_mpi.py:')
+    assert site.endswith('(test_profiled_comm)')
+    assert count == 2 * mpiops.chunks
+    assert nbytes == 2 * mpiops.chunks * x.nbytes
+    assert 0 <= mean_s <= max_s and elapsed > 0
+    assert 0 <= skew <= max_s
@@ -1,6 +1,11 @@
 import numpy as np
+import pytest
 
+from uncoverml import features
 from uncoverml import patch
+from uncoverml.geoio import ArrayImageSource
+from uncoverml.image import Image
+from uncoverml.targets import Targets
 
 
 def test_grid_patch(make_multi_patch):
@@ -19,3 +24,90 @@ def test_point_patches(make_points):
     patches = np.array(list(patch.point_patches(timg, pwidth, points)))
 
     assert np.allclose(patches, tpatch)
+
+
+@pytest.mark.parametrize('patchsize', [0, 1])
+@pytest.mark.parametrize('block_shape', [(1, None), (5, 7), (64, 64)])
+def test_extract_features_by_block(patchsize, block_shape):
+    res_x, res_y = 30, 20
+    data = np.random.rand(res_x, res_y, 2)
+    mask = np.random.rand(res_x, res_y, 2) < 0.1
+    src = ArrayImageSource(np.ma.MaskedArray(data=data, mask=mask),
+                           origin=(10., -5.), crs=None, pixsize=(0.5, 0.25))
+    src._block_rows, src._block_cols = block_shape
+
+    pix = np.column_stack((
+        np.random.randint(patchsize, res_x - patchsize, size=50),
+        np.random.randint(patchsize, res_y - patchsize, size=50)))
+    lonlat = np.array([10., -5.]) + (pix + 0.5) * np.array([0.5, 0.25])
+    targets = Targets(lonlat, np.zeros(50))
+
+    x = features.extract_features(src, targets, patchsize)
+    expected = patch.patches_at_target(Image(src), patchsize, targets)
+    assert x.shape == (50, 2 * patchsize + 1, 2 * patchsize + 1, 2)
+    assert np.all(x.data == expected.data)
+    assert np.all(x.mask == expected.mask)
+
+
+@pytest.mark.parametrize('patchsize', [0, 1])
+def test_masked_subchunks(patchsize):
+    data = np.random.rand(12, 17, 3).astype(np.float32)
+    src = ArrayImageSource(np.ma.MaskedArray(data=data, mask=False),
+                           origin=(10., -5.), crs=None, pixsize=(0.5, 0.25))
+    for i in range(3):
+        x = features.extract_subchunks(src, i, 3, patchsize)
+        masked = features.masked_subchunks(src, i, 3, patchsize)
+        assert masked.shape == x.shape
+        assert masked.dtype == x.dtype
+        assert np.all(masked.mask)
+
+
+@pytest.mark.parametrize('patchsize', [1, 2])
+def test_grid_summaries(patchsize):
+    data = np.random.rand(11, 9, 2) * 10 + 1e3
+    mask = np.random.rand(11, 9, 2) < 0.4
+    s = patch.grid_summaries(data, mask, patchsize, patch.PATCH_STATS)
+
+    patches = np.ma.masked_array(data=patch.grid_patches(data, patchsize),
+                                 mask=patch.grid_patches(mask, patchsize))
+    flat = patches.reshape(patches.shape[0], -1, 2)
+    centre = patches[:, patchsize, patchsize]
+    n = len(patch.PATCH_STATS)
+    assert s.shape == (flat.shape[0], 1, 1, n * 2)
+    s = s.reshape(-1, n, 2)
+    empty = np.ma.count(flat, axis=1) == 0
+    assert np.all(s.mask[:, 0] == centre.mask)
+    assert np.all(s[:, 0][~centre.mask] == centre.data[~centre.mask])
+    for i, f in enumerate([np.ma.mean, np.ma.var, np.ma.min, np.ma.max], 1):
+        assert np.all(s.mask[:, i] == empty)
+        expected = f(flat, axis=1)
+        assert np.allclose(s[:, i][~empty], expected[~empty])
+    assert np.all(s[:, 5] == np.ma.count_masked(flat, axis=1))
+
+
+def test_extract_features_summaries():
+    res_x, res_y, patchsize = 30, 20, 2
+    stats = ['mean', 'max', 'masked']
+    data = np.random.rand(res_x, res_y, 2)
+    mask = np.random.rand(res_x, res_y, 2) < 0.1
+    src = ArrayImageSource(np.ma.MaskedArray(data=data, mask=mask),
+                           origin=(10., -5.), crs=None, pixsize=(0.5, 0.25))
+    src._block_rows, src._block_cols = (5, 7)
+
+    # targets anywhere, including within the patch halo of the edges
+    pix = np.column_stack((np.random.randint(0, res_x, size=50),
+                           np.random.randint(0, res_y, size=50)))
+    lonlat = np.array([10., -5.]) + (pix + 0.5) * np.array([0.5, 0.25])
+    targets = Targets(lonlat, np.zeros(50))
+
+    x = features.extract_features(src, targets, patchsize, stats)
+    full = patch.summaries(data, mask, patchsize, stats)
+    assert x.shape == (50, 1, 1, 6)
+    assert np.allclose(x.data[:, 0, 0], full[0][pix[:, 0], pix[:, 1]])
+    assert np.all(x.mask[:, 0, 0] == full[1][pix[:, 0], pix[:, 1]])
+
+    sub = features.extract_subchunks(src, 0, 1, patchsize, patch_stats=stats)
+    masked = features.masked_subchunks(src, 0, 1, patchsize,
+                                       patch_stats=stats)
+    assert sub.shape == masked.shape == \
+        ((res_x - 2 * patchsize) * (res_y - 2 * patchsize), 1, 1, 6)
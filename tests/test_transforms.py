@@ -226,3 +226,55 @@ def test_WhitenTransform_caching():
 
     assert np.all(np.equal(x_trans, x_expected))
 
+
+def test_float32_precision(make_random_data, monkeypatch):
+    from uncoverml.transforms import transformset
+    x, mu, std = make_random_data
+    expected = StandardiseTransform()(x)
+    whitened = WhitenTransform(1.0)(x)
+
+    monkeypatch.setattr(transformset, 'float_type', np.dtype(np.float32))
+    x32 = x.astype(np.float32)
+    standardiser = StandardiseTransform()
+    produced = standardiser(x32)
+    assert produced.dtype == np.float32
+    assert standardiser.mean.dtype == np.float64
+    assert np.allclose(produced, expected, atol=1e-5)
+    produced = WhitenTransform(1.0)(x32)
+    assert produced.dtype == np.float32
+    assert np.allclose(np.abs(produced), np.abs(whitened), atol=1e-3)
+
+    chunks = {'a': np.ma.masked_array(np.random.randint(0, 9, (5, 1, 1, 2)),
+                                      mask=False)}
+    x = transformset.build_feature_vector(chunks, is_categorical=False)
+    assert x.dtype == np.float32
+
+
+def test_fit_transforms_streaming(make_missing_data):
+    from uncoverml.features import fit_transforms
+    from uncoverml.transforms import ImageTransformSet, TransformSet
+
+    def transform_set():
+        return ImageTransformSet(imputer=MeanImputer(),
+                                 global_transforms=[StandardiseTransform(),
+                                                    WhitenTransform(1.0)])
+
+    x = make_missing_data
+    image = {'a.tif': x[:, np.newaxis, np.newaxis, :]}
+    whole = transform_set()
+    final = TransformSet(transforms=[CentreTransform()])
+    expected = final(whole(image))
+
+    # fitted a subchunk at a time
+    subchunks = np.array_split(np.arange(len(x)), 4)
+    streamed = transform_set()
+    final = TransformSet(transforms=[CentreTransform()])
+    passes = fit_transforms(
+        lambda i: [{'a.tif': image['a.tif'][subchunks[i]]}],
+        len(subchunks), [streamed], final)
+    assert passes == 4
+    assert streamed.fitted and final.fitted
+    assert np.allclose(streamed.imputer.mean, whole.imputer.mean)
+    # eigenvectors are only defined up to their sign
+    assert np.allclose(np.abs(final(streamed(image)).data),
+                       np.abs(expected.data))
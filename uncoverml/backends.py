@@ -0,0 +1,372 @@
+"""
+Communicators the nodes of a run talk through.
+
+`mpiops.comm` is one of these. They all offer the subset of the mpi4py
+communicator interface uncoverml uses, so the rest of the code doesn't
+care how the nodes were started:
+
+- `MPIComm`, the MPI world of a run started by `mpirun`
+- `SingleComm`, a lone process, for runs without any parallelism
+- `LocalComm`, processes forked on this machine, which pass messages
+  through pipes and need no MPI installation
+
+Reductions are given as `Op` objects, which each communicator knows how
+to apply. Any of them can be wrapped in a `ProfiledComm` to time its
+collectives.
+"""
+import atexit
+import logging
+import multiprocessing
+import os
+import pickle
+import sys
+import time
+from functools import reduce
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+class Op:
+    """
+    A commutative reduction of two values.
+
+    Parameters
+    ----------
+    function : callable
+        `function(x, y, dtype)` combining two values, as for
+        `MPI.Op.Create`
+    mpi_name : str, optional
+        the name of the equivalent predefined MPI operation, if any
+    """
+    def __init__(self, function, mpi_name=None):
+        self.function = function
+        self.mpi_name = mpi_name
+        self._mpi_op = None
+
+    def __call__(self, x, y):
+        return self.function(x, y, None)
+
+    def mpi_op(self, MPI):
+        """The MPI operation, created the first time it is needed"""
+        if self.mpi_name:
+            return getattr(MPI, self.mpi_name)
+        if self._mpi_op is None:
+            self._mpi_op = MPI.Op.Create(self.function, commute=True)
+        return self._mpi_op
+
+
+class MPIComm:
+    """
+    The MPI world, with `Op` reductions translated to MPI operations.
+
+    Every other attribute is that of `MPI.COMM_WORLD`.
+    """
+    def __init__(self):
+        from mpi4py import MPI
+        self.MPI = MPI
+        self.comm = MPI.COMM_WORLD
+
+    def _op(self, op):
+        return op.mpi_op(self.MPI) if isinstance(op, Op) else op
+
+    def allreduce(self, sendobj, op=None):
+        if op is None:
+            return self.comm.allreduce(sendobj)
+        return self.comm.allreduce(sendobj, op=self._op(op))
+
+    def reduce(self, sendobj, op=None, root=0):
+        if op is None:
+            return self.comm.reduce(sendobj, root=root)
+        return self.comm.reduce(sendobj, op=self._op(op), root=root)
+
+    def Allreduce(self, sendbuf, recvbuf, op):
+        self.comm.Allreduce(sendbuf, recvbuf, op=self._op(op))
+
+    def __getattr__(self, name):
+        return getattr(self.comm, name)
+
+
+class _ObjectComm:
+    """
+    The collectives built from the point to point messages of a subclass.
+
+    Every collective goes through the root, or node 0, one message at a
+    time, so no two nodes ever wait on each other to receive. Buffer
+    collectives are the object ones, copied into the receive buffers.
+    """
+    def Get_rank(self):
+        return self.rank
+
+    def Get_size(self):
+        return self.size
+
+    def bcast(self, obj, root=0):
+        if self.rank == root:
+            for node in range(self.size):
+                if node != root:
+                    self.send(obj, dest=node)
+            return obj
+        return self.recv(source=root)
+
+    def gather(self, sendobj, root=0):
+        if self.rank != root:
+            self.send(sendobj, dest=root)
+            return None
+        return [sendobj if node == root else self.recv(source=node)
+                for node in range(self.size)]
+
+    def scatter(self, sendobj, root=0):
+        if self.rank != root:
+            return self.recv(source=root)
+        for node in range(self.size):
+            if node != root:
+                self.send(sendobj[node], dest=node)
+        return sendobj[root]
+
+    def allgather(self, sendobj):
+        return self.bcast(self.gather(sendobj, root=0), root=0)
+
+    def reduce(self, sendobj, op=None, root=0):
+        objs = self.gather(sendobj, root=root)
+        if objs is None:
+            return None
+        return reduce(op if op is not None else _sum, objs)
+
+    def allreduce(self, sendobj, op=None):
+        return self.bcast(self.reduce(sendobj, op, root=0), root=0)
+
+    def barrier(self):
+        self.allgather(None)
+
+    def Allreduce(self, sendbuf, recvbuf, op):
+        recvbuf[...] = self.allreduce(np.asarray(sendbuf), op)
+
+    def Allgatherv(self, sendbuf, recvbuf):
+        recvbuf[0][...] = np.concatenate(
+            [np.ravel(p) for p in self.allgather(sendbuf)])
+
+    def Gatherv(self, sendbuf, recvbuf, root=0):
+        parts = self.gather(sendbuf, root=root)
+        if parts is not None:
+            recvbuf[0][...] = np.concatenate([np.ravel(p) for p in parts])
+
+    def Bcast(self, buf, root=0):
+        data = self.bcast(buf if self.rank == root else None, root=root)
+        if self.rank != root:
+            buf[...] = data
+
+
+def _sum(x, y):
+    return x + y
+
+
+class SingleComm(_ObjectComm):
+    """
+    A world of one node.
+
+    Objects are passed back as they are, not copied.
+    """
+    rank = 0
+    size = 1
+
+    def send(self, obj, dest):
+        raise ValueError("A single node has no one to send to")
+
+    def recv(self, source):
+        raise ValueError("A single node has no one to receive from")
+
+
+class LocalComm(_ObjectComm):
+    """
+    A world of processes forked on this machine, joined by pipes.
+
+    Use `LocalComm.start` to fork them.
+
+    Parameters
+    ----------
+    rank : int
+        the index of this process
+    connections : dict
+        the pipe to every other process, by its index
+    """
+    def __init__(self, rank, connections):
+        self.rank = rank
+        self.size = len(connections) + 1
+        self.connections = connections
+
+    def send(self, obj, dest):
+        self.connections[dest].send(obj)
+
+    def recv(self, source):
+        return self.connections[source].recv()
+
+    @classmethod
+    def start(cls, processes):
+        """
+        Fork this process into a world of `processes` nodes.
+
+        Each process returns from this call with its own communicator and
+        carries on running the same program. The original process becomes
+        node 0 and waits for the others when it exits. A node that dies
+        closes its pipes, so nodes waiting on it fail rather than hang.
+
+        Parameters
+        ----------
+        processes : int
+            the number of nodes
+
+        Returns
+        -------
+        comm : LocalComm
+            this process's communicator
+        """
+        pipes = {(i, j): multiprocessing.Pipe()
+                 for i in range(processes) for j in range(i + 1, processes)}
+        children = []
+        rank = 0
+        for node in range(1, processes):
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                rank = node
+                children = []
+                break
+            children.append(pid)
+
+        # keep only this process's end of its own pipes, so the pipes of a
+        # node close when it dies
+        connections = {}
+        for (i, j), (end_i, end_j) in pipes.items():
+            if rank == i:
+                connections[j] = end_i
+                end_j.close()
+            elif rank == j:
+                connections[i] = end_j
+                end_i.close()
+            else:
+                end_i.close()
+                end_j.close()
+        if children:
+            atexit.register(_wait_for, children, connections)
+        return cls(rank, connections)
+
+
+def _wait_for(children, connections):
+    # nodes still waiting on node 0 see it leave rather than wait forever
+    for c in connections.values():
+        c.close()
+    failed = 0
+    for pid in children:
+        _, status = os.waitpid(pid, 0)
+        if status != 0:
+            failed += 1
+    if failed:
+        log.error("{} of the {} local nodes failed".format(
+            failed, len(children) + 1))
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(1)
+
+
+_profiled = ['bcast', 'gather', 'scatter', 'allgather', 'reduce',
+             'allreduce', 'barrier', 'send', 'recv', 'Allreduce',
+             'Allgatherv', 'Gatherv', 'Bcast']
+
+# calls from these files are attributed to their callers
+_comm_files = [os.path.join(os.path.dirname(__file__), 'mpiops.py'),
+               os.path.abspath(__file__)]
+
+
+class ProfiledComm:
+    """
+    A communicator that records the collectives made through it.
+
+    For every call site outside mpiops and this module, and every kind of
+    call made from it, keeps the number of calls, the bytes this node
+    passed in (or received, for `recv`) and the seconds it spent in them.
+    A node that reaches a collective early waits there for the others, so
+    the spread of those seconds over the nodes measures load imbalance.
+
+    Parameters
+    ----------
+    comm : communicator
+        the communicator to profile
+    """
+    def __init__(self, comm):
+        self.comm = comm
+        self.records = {}
+        self.start = time.time()
+
+    def __getattr__(self, name):
+        attr = getattr(self.comm, name)
+        if name not in _profiled:
+            return attr
+
+        def profiled(*args, **kwargs):
+            site = _call_site()
+            start = time.perf_counter()
+            result = attr(*args, **kwargs)
+            seconds = time.perf_counter() - start
+            payload = result if name == 'recv' else \
+                (args[0] if args else next(iter(kwargs.values()), None))
+            record = self.records.setdefault((site, name), [0, 0, 0.])
+            record[0] += 1
+            record[1] += _nbytes(payload)
+            record[2] += seconds
+            return result
+        return profiled
+
+    def report(self):
+        """
+        The records of every node, merged.
+
+        A collective, so every node must call it.
+
+        Returns
+        -------
+        rows : list
+            a (site, call, count, bytes, mean seconds, max seconds, skew)
+            tuple for every call site and kind of call, with the most
+            time consuming first. Counts and bytes are summed over the
+            nodes, skew is the max minus the min seconds over the nodes.
+        elapsed : float
+            the seconds node 0 has been profiling for
+        """
+        records = self.comm.allgather(self.records)
+        rows = []
+        for key in sorted(set(k for r in records for k in r)):
+            per_node = [r.get(key, [0, 0, 0.]) for r in records]
+            seconds = [n[2] for n in per_node]
+            rows.append(key + (sum(n[0] for n in per_node),
+                               sum(n[1] for n in per_node),
+                               sum(seconds) / len(seconds), max(seconds),
+                               max(seconds) - min(seconds)))
+        rows.sort(key=lambda r: -r[5])
+        return rows, time.time() - self.start
+
+
+def _call_site():
+    frame = sys._getframe(2)
+    while frame.f_back is not None and \
+            os.path.abspath(frame.f_code.co_filename) in _comm_files:
+        frame = frame.f_back
+    code = frame.f_code
+    return "{}:{} ({})".format(os.path.basename(code.co_filename),
+                               frame.f_lineno, code.co_name)
+
+
+def _nbytes(obj):
+    """The bytes in obj, without pickling it if it is made of arrays"""
+    if obj is None:
+        return 0
+    if hasattr(obj, 'nbytes'):
+        return int(obj.nbytes)
+    if isinstance(obj, (list, tuple)):
+        return sum(_nbytes(o) for o in obj)
+    try:
+        return len(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return 0
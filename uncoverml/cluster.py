@@ -14,19 +14,6 @@ Never use more than this many x's to compute a distance matrix
 distance_partition_size = 10000
 
 
-def sum_axis_0(x, y, dtype):
-    """
-    Reduce operation that sums 2 arrays on axis zero
-    """
-    s = np.sum(np.vstack((x, y)), axis=0)
-    return s
-
-"""
-MPI reduce operation for summing over axis 0
-"""
-sum0_op = mpiops.MPI.Op.Create(sum_axis_0, commute=True)
-
-
 class TrainingData:
     """
     Light wrapper for the indices and values of training data
@@ -201,12 +188,12 @@ def weighted_starting_candidates(X, k, l):
     C = None
     if mpiops.chunk_index == 0:
         idx = np.random.choice(X.shape[0])
-        C = [X[idx]]
-    C = mpiops.comm.bcast(C, root=0)
+        C = np.ma.getdata(X[idx:idx + 1])
+    C = mpiops.bcast_array(C, root=0)
     d2_x = kmean_distance2(X, C)
     # Figure out how many iterations to do. Roughly log n.
     phi_x_c_local = np.sum(d2_x)
-    phi_x_c = mpiops.comm.allreduce(phi_x_c_local, op=mpiops.MPI.SUM)
+    phi_x_c = mpiops.allreduce_array(phi_x_c_local)
     psi = int(round(np.log(phi_x_c)))
     log.info("kmeans|| using {} sampling iterations".format(psi))
     for i in range(psi):
@@ -219,7 +206,7 @@ def weighted_starting_candidates(X, k, l):
         draws = np.random.rand(probs.shape[0])
         hits = draws <= probs
         new_c = X[hits]
-        C = np.concatenate([C] + mpiops.comm.allgather(new_c), axis=0)
+        C = np.concatenate([C, mpiops.gather_array(new_c)], axis=0)
         log.info("it {}\tcandidates: {}".format(i, C.shape[0]))
 
     w = compute_weights(X, C)
@@ -268,7 +255,7 @@ def compute_class(X, C, training_data=None):
         idx += n_i
     x_indices = np.arange(classes.shape[0])
 
-    cost = mpiops.comm.allreduce(local_cost)
+    cost = mpiops.allreduce_array(local_cost)
     # force assignment of the training data
     if training_data:
         classes[training_data.indices] = training_data.classes
@@ -292,18 +279,16 @@ def centroid(X, weights=None):
     centroid : ndarray
         (d,) length array, the d-dimensional centroid point of all x in X.
     """
-    centroid = np.zeros(X.shape[1])
+    local = np.zeros(X.shape[1] + 1)
     if weights is not None:
-        local_count = np.sum(weights)
-        local_sum = np.sum(X * weights, axis=0)
+        local[0] = np.sum(weights)
+        local[1:] = np.sum(X * weights, axis=0)
     else:
-        local_count = X.shape[0]
-        local_sum = np.sum(X, axis=0)
-    full_count = mpiops.comm.reduce(local_count, op=mpiops.MPI.SUM, root=0)
-    full_sum = mpiops.comm.reduce(local_sum, op=sum0_op, root=0)
-    if mpiops.chunk_index == 0:
-        centroid = full_sum / float(full_count)
-    centroid = mpiops.comm.bcast(centroid, root=0)
+        local[0] = X.shape[0]
+        local[1:] = np.sum(X, axis=0)
+    # the count and the sum travel in one buffer
+    full = mpiops.allreduce_array(local)
+    centroid = full[1:] / full[0]
     return centroid
 
 
@@ -343,9 +328,9 @@ def reseed_point(X, C, index):
         if potential_cost < local_cost:
             local_candidate = x_i[potential_idx]
             local_cost = potential_cost
-    best_pernode = mpiops.comm.allgather(local_cost)
-    best_node = np.argmax(best_pernode)
-    new_point = mpiops.comm.bcast(local_candidate, root=best_node)
+    best_pernode = mpiops.gather_array(np.array([local_cost]))
+    best_node = int(np.argmax(best_pernode))
+    new_point = mpiops.bcast_array(local_candidate, root=best_node)
     return new_point
 
 
@@ -373,17 +358,22 @@ def kmeans_step(X, C, classes, weights=None):
     C_new : ndarray
         (k, d) array of new cluster centres
     """
+    k = C.shape[0]
+    w = np.ones(X.shape[0]) if weights is None else weights
+    # member counts, masses and weighted sums of every class at once, so
+    # a step costs one reduction rather than a few per class
+    local = np.zeros((k, X.shape[1] + 2))
+    local[:, 0] = np.bincount(classes, minlength=k)
+    local[:, 1] = np.bincount(classes, weights=w, minlength=k)
+    np.add.at(local[:, 2:], classes, np.ma.getdata(X) * w[:, np.newaxis])
+    full = mpiops.allreduce_array(local)
+
     C_new = np.zeros_like(C)
-    for i in range(C.shape[0]):
-        indices = classes == i
-        n_members = mpiops.comm.allreduce(np.sum(indices), op=mpiops.MPI.SUM)
-        if n_members == 0:
+    for i in range(k):
+        if full[i, 0] == 0:
             C_new[i] = reseed_point(X, C, i)
         else:
-            X_ind = X[indices]
-            w_ind = (None if weights is None
-                     else weights[indices][:, np.newaxis])
-            C_new[i] = centroid(X_ind, w_ind)
+            C_new[i] = full[i, 2:] / full[i, 1]
 
     return C_new
 
@@ -425,7 +415,7 @@ def run_kmeans(X, C, k, weights=None, training_data=None, max_iterations=1000):
         C_new = kmeans_step(X, C, classes, weights=weights)
         classes_new, cost = compute_class(X, C_new)
         delta_local = np.sum(classes != classes_new)
-        delta = mpiops.comm.allreduce(delta_local, op=mpiops.MPI.SUM)
+        delta = mpiops.allreduce_array(delta_local)
         log.info("kmeans it: {}\tcost:{:.3f}\tdelta: {}".format(
             i, cost, delta))
         C = C_new
@@ -466,7 +456,7 @@ def initialise_centres(X, k, l, training_data=None, max_iterations=1000):
     w, C = weighted_starting_candidates(X, k, l)
     Ck_init_indices = (np.random.choice(C.shape[0], size=k, replace=False)
                        if mpiops.chunk_index == 0 else None)
-    Ck_init_indices = mpiops.comm.bcast(Ck_init_indices, root=0)
+    Ck_init_indices = mpiops.bcast_array(Ck_init_indices, root=0)
     Ck_init = C[Ck_init_indices]
     log.info("Running K-means on candidate samples")
     C_init, _ = run_kmeans(C, Ck_init, k, weights=w,
@@ -477,8 +467,7 @@ def initialise_centres(X, k, l, training_data=None, max_iterations=1000):
     if training_data:
         for i in range(k):
             k_indices = training_data.classes == i
-            has_training = mpiops.comm.allreduce(np.sum(k_indices),
-                                                 op=mpiops.MPI.SUM) > 0
+            has_training = mpiops.allreduce_array(np.sum(k_indices)) > 0
             if has_training:
                 x_indices = training_data.indices[k_indices]
                 X_data = X[x_indices]
@@ -504,7 +493,7 @@ def compute_n_classes(classes, config):
     k : int > 0
         The max of k and the number of classes referenced in the training data
     """
-    k = mpiops.comm.allreduce(np.amax(classes), op=mpiops.MPI.MAX)
+    k = mpiops.allreduce_array(np.amax(classes), op=mpiops.MAX)
     k = int(max(k, config.n_classes))
     return k
 
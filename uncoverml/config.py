@@ -5,6 +5,7 @@ import glob
 import csv
 import yaml
 
+from uncoverml import patch
 from uncoverml import transforms
 
 log = logging.getLogger(__name__)
@@ -134,10 +135,35 @@ class Config:
             s = yaml.load(f)
         self.name = path.basename(yaml_file).rsplit(".", 1)[0]
 
-        # TODO expose this option when fixed
-        if 'patchsize' in s:
-            log.info("Patchsize currently fixed at 0 -- ignoring")
+        # raw patches are not supported, but neighbourhood summaries are
         self.patchsize = 0
+        self.patch_stats = None
+        if 'patchstats' in s:
+            if s.get('patchsize', 0) < 1:
+                raise ValueError("patchstats needs a patchsize of at least "
+                                 "1, the half-width of the neighbourhood")
+            unknown = set(s['patchstats']) - set(patch.PATCH_STATS)
+            if unknown:
+                raise ValueError("Unknown patchstats {}, choose from "
+                                 "{}".format(sorted(unknown),
+                                             ', '.join(patch.PATCH_STATS)))
+            self.patchsize = s['patchsize']
+            self.patch_stats = s['patchstats']
+        elif 'patchsize' in s:
+            log.info("Patchsize currently fixed at 0 without patchstats "
+                     "-- ignoring")
+
+        # floating point type of the features, applied by the commands
+        # with transforms.transformset.set_precision
+        self.precision = s['precision'] if 'precision' in s else 'float64'
+        if self.precision not in ('float32', 'float64'):
+            raise ValueError("precision must be float32 or float64, "
+                             "not {}".format(self.precision))
+
+        # chunk boundaries snap to multiples of this many rows; set from
+        # the rasters' internal tiling by geoio.block_alignment
+        self.block_rows = 1
+        self.block_phase = 0
 
         self.algorithm = s['learning']['algorithm']
         self.cubist = self.algorithm == 'cubist'
@@ -151,6 +177,12 @@ class Config:
             self.outbands = s['prediction']['outbands']
         self.thumbnails = s['prediction']['thumbnails'] \
             if 'thumbnails' in s['prediction'] else None
+        self.multiband = s['prediction']['multiband'] \
+            if 'multiband' in s['prediction'] else False
+        self.compress = s['prediction']['compress'] \
+            if 'compress' in s['prediction'] else None
+        self.overviews = s['prediction']['overviews'] \
+            if 'overviews' in s['prediction'] else False
 
         self.pickle = any(True for d in s['features'] if d['type'] == 'pickle')
 
@@ -204,6 +236,16 @@ class Config:
         if 'resample' in s['targets']:
             self.resample = s['targets']['resample']
 
+        # covariates intersected with the targets, reused between runs
+        self.feature_store = None
+        if 'feature_store' in s:
+            self.feature_store = path.abspath(s['feature_store']['directory'])
+
+        # covariates pre-stacked by the stackcovariates command
+        self.cube = None
+        if 'cube' in s:
+            self.cube = path.abspath(s['cube']['file'])
+
         self.mask = None
         if 'mask' in s:
             self.mask = s['mask']['file']
@@ -23,6 +23,7 @@ CATEGORICAL = 3
 STR1 = re.compile('^Evaluation on training data', re.MULTILINE)
 STR2 = re.compile('Evaluation on test data')
 CASES = re.compile('cases\):\n')
+BLOCK_ROWS = 512  # rows predicted at once by CompiledRules
 
 
 def save_data(filename, data):
@@ -258,6 +259,7 @@ class Cubist:
         models = map(remove_first_line, modelfile.split('rules')[1:])
         rules_split = [model.split('conds')[1:] for model in models]
         self.models = [list(map(new_rule, model)) for model in rules_split]
+        self._rules = None
 
         '''
         Complete the training by cleaning up after ourselves
@@ -308,18 +310,11 @@ class Cubist:
             print('Train first')
             return
 
-        # Determine which rule to run on each row and then run the regression
-        # on each row of x to get the regression output.
-        y_pred = np.zeros((n, len(self.models)))
-        for m, model in enumerate(self.models):
-            for rule in model:
-
-                # Determine which rows satisfy this rule
-                mask = rule.satisfied(x)
-
-                # Make the prediction for the whole matrix, and keep only the
-                # rows that are correctly sized
-                y_pred[mask, m] += rule.regress(x, mask)
+        # Determine which rules each row of x satisfies and sum their
+        # regressions, for each committee member
+        if getattr(self, '_rules', None) is None:
+            self._rules = CompiledRules(self.models, m)
+        y_pred = self._rules.predict(x)
 
         y_mean = np.mean(y_pred, axis=1)
         y_var = np.var(y_pred, axis=1)
@@ -470,6 +465,7 @@ class MultiCubist:
         """
         # set a different random seed for each thread
         np.random.seed(mpiops.chunk_index)
+        self._rules = None
 
         if self.parallel:  # during training
             process_trees = np.array_split(range(self.trees),
@@ -554,30 +550,9 @@ class MultiCubist:
             print('Train first')
             return
 
-        n, _ = x.shape
-
         # on each row of x to get the regression output.
         # we have prediction for each x tree/cubes * len(models) in each tree
-
-        y_pred = np.zeros((n, self.trees * self.committee_members))
-
-        for i in range(self.trees):
-            if self.parallel:  # used in training
-                pk_f = join(self.temp_dir,
-                            'cube_{}.pk'.format(i))
-            else:  # used when parallel is false, i.e., during x-val
-                pk_f = join(self.temp_dir,
-                            'cube_x_{}_p_{}.pk'.format(i, mpiops.chunk_index))
-            with open(pk_f, 'rb') as fp:
-                c = pickle.load(fp)
-                for m, model in enumerate(c.models):
-                    for rule in model:
-                        # Determine which rows satisfy this rule
-                        mask = rule.satisfied(x)
-                        # Make the prediction for the whole matrix,
-                        # and keep only the rows that are correctly sized
-                        y_pred[mask, i * self.committee_members + m] += \
-                            rule.regress(x, mask)
+        y_pred = self._compiled_rules(x.shape[1]).predict(x)
 
         y_mean = np.mean(y_pred, axis=1)
         y_var = np.var(y_pred, axis=1)
@@ -606,6 +581,26 @@ class MultiCubist:
         mean, _, _, _ = self.predict_proba(x)
         return mean
 
+    def _compiled_rules(self, n_features):
+        # the cubes are read and compiled once, on the first prediction
+        if getattr(self, '_rules', None) is not None:
+            return self._rules
+        models = []
+        for i in range(self.trees):
+            if self.parallel:  # used in training
+                pk_f = join(self.temp_dir,
+                            'cube_{}.pk'.format(i))
+            else:  # used when parallel is false, i.e., during x-val
+                pk_f = join(self.temp_dir,
+                            'cube_x_{}_p_{}.pk'.format(i, mpiops.chunk_index))
+            with open(pk_f, 'rb') as fp:
+                c = pickle.load(fp)
+            # a column per committee member, even when cubist made fewer
+            models += c.models + [[]] * (self.committee_members -
+                                         len(c.models))
+        self._rules = CompiledRules(models, n_features)
+        return self._rules
+
     def calculate_usage(self):
         """
         Averages the Cond and Model statistics of all the cubist runs
@@ -770,3 +765,137 @@ class Rule:
 
         prediction = self.bias + x[mask].dot(self.coefficients)
         return prediction
+
+
+class CompiledRules:
+    """
+    The rules of several rule based models, compiled for batch prediction.
+
+    Each distinct condition, however many rules across the models test it,
+    is evaluated once for a block of rows, giving a bitset of the rows that
+    pass it. The bitset of the rows satisfying a rule is the intersection
+    of those of its conditions. The regressions of all the rules are one
+    matrix multiply, and each model predicts the sum of the regressions of
+    the rules a row satisfies.
+
+    Parameters
+    ----------
+    models : list
+        the models, each a list of `Rule`, such as the committee members of
+        one or more Cubist models
+    n_features : int
+        the number of features the rules are of
+    """
+    def __init__(self, models, n_features):
+        numbers = OrderedDict()  # the number of each distinct condition
+        rule_conditions = [[numbers.setdefault(_condition_key(c),
+                                               len(numbers))
+                            for c in rule.conditions]
+                           for model in models for rule in model]
+        self.n_conditions = len(numbers)
+
+        # the continuous conditions, grouped by comparison
+        continuous = OrderedDict()
+        for key, number in numbers.items():
+            if key[0] == CONTINUOUS:
+                _, comparison, index, operand = key
+                group = continuous.setdefault(comparison, ([], [], []))
+                for part, value in zip(group, (number, index, operand)):
+                    part.append(value)
+        self.continuous = OrderedDict(
+            (comparison, (np.array(n, dtype=int), np.array(i, dtype=int),
+                          np.array(o, dtype=float)[:, np.newaxis]))
+            for comparison, (n, i, o) in continuous.items())
+        self.categorical = [(number, key[1], np.array(key[2])[:, np.newaxis])
+                            for key, number in numbers.items()
+                            if key[0] == CATEGORICAL]
+
+        # the conditions of each rule, padded with a condition every row
+        # passes, numbered n_conditions
+        width = max([len(c) for c in rule_conditions] + [1])
+        self.conditions = np.full((width, len(rule_conditions)),
+                                  self.n_conditions, dtype=int)
+        for rule, conditions in enumerate(rule_conditions):
+            self.conditions[:len(conditions), rule] = conditions
+
+        # the regression coefficients of each rule, with the bias last
+        rules = [rule for model in models for rule in model]
+        self.coefficients = np.zeros((len(rules), n_features + 1))
+        for r, rule in enumerate(rules):
+            self.coefficients[r, :-1] = rule.coefficients
+            self.coefficients[r, -1] = rule.bias
+        self.splits = np.cumsum([0] + [len(model) for model in models])
+
+    def satisfied(self, x):
+        """
+        The rows satisfying each rule.
+
+        Parameters
+        ----------
+        x : ndarray
+            the (N, D) features
+
+        Returns
+        -------
+        satisfied : ndarray
+            (n_rules, N) booleans, True where a row satisfies a rule
+        """
+        return self._satisfied(np.ascontiguousarray(x.T))
+
+    def predict(self, x):
+        """
+        The predictions of every model.
+
+        Parameters
+        ----------
+        x : ndarray
+            the (N, D) features
+
+        Returns
+        -------
+        y : ndarray
+            the (N, n_models) predictions
+        """
+        y = np.empty((len(x), len(self.splits) - 1))
+        for start in range(0, len(x), BLOCK_ROWS):
+            x_t = np.ones((x.shape[1] + 1, len(x[start:start + BLOCK_ROWS])))
+            x_t[:-1] = x[start:start + BLOCK_ROWS].T
+            regressions = self.coefficients.dot(x_t)
+            satisfied = self._satisfied(x_t[:-1])
+            if np.all(np.isfinite(x_t)):
+                regressions *= satisfied
+            else:
+                regressions = np.where(satisfied, regressions, 0.)
+            for m, (first, last) in enumerate(zip(self.splits[:-1],
+                                                  self.splits[1:])):
+                y[start:start + BLOCK_ROWS, m] = \
+                    regressions[first:last].sum(axis=0)
+        return y
+
+    def _satisfied(self, x_t):
+        n_rows = x_t.shape[1]
+        passed = np.empty((self.n_conditions + 1, n_rows), dtype=bool)
+        passed[-1] = True
+        for comparison, (numbers, indices, operands) in \
+                self.continuous.items():
+            passed[numbers] = Rule.comparator[comparison](x_t[indices],
+                                                          operands)
+        for number, index, values in self.categorical:
+            # np.isclose(values, x), without its overheads
+            column = x_t[index]
+            passed[number] = (np.abs(values - column) <=
+                              1e-8 + 1e-5 * np.abs(column)).any(axis=0)
+
+        passed = np.packbits(passed, axis=1)
+        rows = passed[self.conditions[0]]
+        for conditions in self.conditions[1:]:
+            rows &= passed[conditions]
+        return np.unpackbits(rows, axis=1, count=n_rows).view(bool)
+
+
+def _condition_key(condition):
+    if condition['type'] == CONTINUOUS:
+        return (CONTINUOUS, condition['operator'],
+                condition['operand_index'], condition['operand'])
+    return (CATEGORICAL, condition['operand_index'],
+            tuple(condition['values']))
@@ -0,0 +1,149 @@
+"""
+A compact alternative to masked arrays for feature matrices.
+"""
+import numpy as np
+
+
+class FeatureMatrix:
+    """
+    An (N, D) feature matrix with missing values.
+
+    A masked array keeps a byte of mask for every value. A FeatureMatrix
+    keeps the dense data, whether each row is complete, and only when some
+    rows are incomplete a per-value mask packed to one bit per value. Rows
+    are what models predict on, so most consumers only need `valid_rows`.
+
+    The transform sets build one from the covariates, and the imputers and
+    transforms work on it in place of a masked array. Arithmetic in place
+    applies to missing values too, whose data is meaningless.
+
+    Parameters
+    ----------
+    data : ndarray
+        the (N, D) values
+    mask : ndarray, optional
+        (N, D) booleans, True where a value is missing
+    """
+    def __init__(self, data, mask=None):
+        self.data = data
+        if mask is not None and np.any(mask):
+            mask = np.broadcast_to(mask, data.shape)
+            self.valid_rows = ~mask.any(axis=1)
+            self._packed = np.packbits(mask, axis=1)
+        else:
+            self.valid_rows = np.ones(data.shape[0], dtype=bool)
+            self._packed = None
+
+    @classmethod
+    def from_masked(cls, x):
+        """A FeatureMatrix holding the data and mask of masked array `x`"""
+        return cls(np.ma.getdata(x), np.ma.getmask(x))
+
+    @classmethod
+    def from_packed(cls, data, packed):
+        """A FeatureMatrix of `data` with the mask `packed_mask` gives"""
+        result = cls(data)
+        if np.any(packed):
+            result.valid_rows = ~packed.any(axis=1)
+            result._packed = packed
+        return result
+
+    @classmethod
+    def concatenate(cls, matrices):
+        """Stack FeatureMatrices row-wise"""
+        result = cls(np.concatenate([m.data for m in matrices], axis=0))
+        result.valid_rows = np.concatenate([m.valid_rows for m in matrices])
+        if any(m._packed is not None for m in matrices):
+            result._packed = np.concatenate([m.packed_mask
+                                             for m in matrices], axis=0)
+        return result
+
+    @classmethod
+    def hstack(cls, matrices):
+        """Stack FeatureMatrices column-wise"""
+        data = np.concatenate([m.data for m in matrices], axis=1)
+        if all(m._packed is None for m in matrices):
+            return cls(data)
+        # the bits of each row are packed together, so unpack to restack
+        return cls(data, np.concatenate([m.mask for m in matrices], axis=1))
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def ndim(self):
+        return self.data.ndim
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    @property
+    def nbytes(self):
+        packed = self._packed.nbytes if self._packed is not None else 0
+        return self.data.nbytes + self.valid_rows.nbytes + packed
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __getitem__(self, rows):
+        if isinstance(rows, tuple):
+            # rows and columns
+            return FeatureMatrix(self.data[rows], None if self._packed is
+                                 None else self.mask[rows])
+        result = FeatureMatrix(self.data[rows])
+        result.valid_rows = self.valid_rows[rows]
+        if self._packed is not None:
+            result._packed = self._packed[rows]
+        return result
+
+    def __isub__(self, other):
+        self.data -= other
+        return self
+
+    def __itruediv__(self, other):
+        self.data /= other
+        return self
+
+    def astype(self, dtype):
+        """A copy with the data cast to `dtype`"""
+        result = FeatureMatrix(self.data.astype(dtype))
+        result.valid_rows = self.valid_rows
+        result._packed = self._packed
+        return result
+
+    def count(self):
+        """The (D,) number of values present in each column"""
+        if self._packed is None:
+            return np.full(self.data.shape[1], len(self), dtype=int)
+        return len(self) - self.mask.sum(axis=0)
+
+    @property
+    def complete(self):
+        """True if no value is missing"""
+        return self._packed is None or bool(np.all(self.valid_rows))
+
+    @property
+    def mask(self):
+        """The (N, D) boolean mask, unpacked"""
+        return self.rows_mask(slice(None))
+
+    def rows_mask(self, rows):
+        """The boolean mask of some rows, unpacking only theirs"""
+        if self._packed is None:
+            return np.zeros(self.data[rows].shape, dtype=bool)
+        return np.unpackbits(self._packed[rows], axis=1,
+                             count=self.data.shape[1]).astype(bool)
+
+    @property
+    def packed_mask(self):
+        """The (N, ceil(D / 8)) mask, packed along the rows"""
+        if self._packed is not None:
+            return self._packed
+        return np.zeros((self.data.shape[0], (self.data.shape[1] + 7) // 8),
+                        dtype=np.uint8)
+
+    def to_masked(self):
+        """The equivalent masked array"""
+        return np.ma.masked_array(data=self.data, mask=self.mask)
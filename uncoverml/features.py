@@ -4,6 +4,7 @@ import numpy as np
 import pickle
 
 from uncoverml import mpiops
+from uncoverml.featurematrix import FeatureMatrix
 from uncoverml.image import Image
 from uncoverml import patch
 from uncoverml import transforms
@@ -11,59 +12,120 @@ from uncoverml import transforms
 log = logging.getLogger(__name__)
 
 
-def extract_subchunks(image_source, subchunk_index, n_subchunks, patchsize):
+def extract_subchunks(image_source, subchunk_index, n_subchunks, patchsize,
+                      block_rows=1, block_phase=0, patch_stats=None):
     equiv_chunks = n_subchunks * mpiops.chunks
     equiv_chunk_index = mpiops.chunks*subchunk_index + mpiops.chunk_index
     image = Image(image_source, equiv_chunk_index,
-                  equiv_chunks, patchsize)
-    x = patch.all_patches(image, patchsize)
+                  equiv_chunks, patchsize, block_rows, block_phase)
+    x = patch.all_patches(image, patchsize, patch_stats)
     return x
 
 
-def _image_has_targets(y_min, y_max, im):
-    encompass = im.ymin <= y_min and im.ymax >= y_max
-    edge_low = im.ymax >= y_min and im.ymax <= y_max
-    edge_high = im.ymin >= y_min and im.ymin <= y_max
-    inside = encompass or edge_low or edge_high
-    return inside
+def masked_subchunks(image_source, subchunk_index, n_subchunks, patchsize,
+                     block_rows=1, block_phase=0, patch_stats=None):
+    """
+    A fully masked array shaped like the result of `extract_subchunks`,
+    made without reading the image. Stands in for subchunks in which no
+    pixel will be predicted.
+    """
+    equiv_chunks = n_subchunks * mpiops.chunks
+    equiv_chunk_index = mpiops.chunks*subchunk_index + mpiops.chunk_index
+    image = Image(image_source, equiv_chunk_index,
+                  equiv_chunks, patchsize, block_rows, block_phase)
+    xres, yres = image.patched_shape(patchsize)
+    if patch_stats and patchsize > 0:
+        return np.ma.masked_all(
+            (xres * yres, 1, 1, len(patch_stats) * image.channels))
+    side = 2 * patchsize + 1
+    return np.ma.masked_all((xres * yres, side, side, image.channels),
+                            dtype=image.dtype)
 
 
-def _extract_from_chunk(image_source, targets, chunk_index, total_chunks,
-                        patchsize):
-    image_chunk = Image(image_source, chunk_index, total_chunks, patchsize)
-    # figure out which chunks I need to consider
-    y_min = targets.positions[0, 1]
-    y_max = targets.positions[-1, 1]
-    if _image_has_targets(y_min, y_max, image_chunk):
-        x = patch.patches_at_target(image_chunk, patchsize, targets)
-    else:
-        x = None
-    return x
+def extract_features(image_source, targets, patchsize, patch_stats=None):
+    """
+    Sample the image at the targets, reading only the parts of the image
+    that contain targets.
 
+    The targets are grouped by the internal block (tile or strip) of the
+    image they fall in, and for each group only the window spanning its
+    targets plus the patch halo is read, so the cost of intersection grows
+    with the number of targets rather than the size of the image.
 
-def extract_features(image_source, targets, n_subchunks, patchsize):
+    Each node gets its own share of the targets, so all nodes will always
+    have targets. The patches are returned in the order of the targets.
+    With `patch_stats`, the neighbourhood summaries of `patch.summaries`
+    are returned instead of the patches.
     """
-    each node gets its own share of the targets, so all nodes
-    will always have targets
-    """
-    equiv_chunks = n_subchunks * mpiops.chunks
-    x_all = []
-    for i in range(equiv_chunks):
-        x = _extract_from_chunk(image_source, targets, i, equiv_chunks,
-                                patchsize)
-        if x is not None:
-            x_all.append(x)
-    if len(x_all) > 0:
-        x_all_data = np.concatenate([a.data for a in x_all], axis=0)
-        x_all_mask = np.concatenate([a.mask for a in x_all], axis=0)
-        x_all = np.ma.masked_array(x_all_data, mask=x_all_mask)
-    else:
+    image = Image(image_source)
+    lonlats = targets.positions
+    valid = image.in_bounds(lonlats)
+    if not np.any(valid):
         raise ValueError("All targets lie outside image boundaries")
-    assert x_all.shape[0] == targets.observations.shape[0]
+    assert np.all(valid)
+
+    pixels = image.lonlat2pix(lonlats)
+    xres, yres, nchannels = image.resolution
+    block_rows = image_source.block_rows
+    block_cols = image_source.block_cols
+    # block boundaries are counted from the first row of the file
+    phase = yres % block_rows if image_source.y_flipped else 0
+    block_y = (pixels[:, 1] - phase) // block_rows
+    block_x = pixels[:, 0] // block_cols
+    block_id = block_y * (xres // block_cols + 1) + block_x
+
+    summarise = bool(patch_stats) and patchsize > 0
+    if summarise:
+        shp = (pixels.shape[0], 1, 1, len(patch_stats) * nchannels)
+        x_data = np.empty(shp)
+    else:
+        side = 2 * patchsize + 1
+        shp = (pixels.shape[0], side, side, nchannels)
+        x_data = np.empty(shp, dtype=image_source.dtype)
+    x_mask = np.empty(shp, dtype=bool)
+
+    order = np.argsort(block_id, kind='mergesort')
+    _, group_starts = np.unique(block_id[order], return_index=True)
+    groups = np.split(order, group_starts[1:])
+    for idx in groups:
+        p = pixels[idx]
+        xmin = max(p[:, 0].min() - patchsize, 0)
+        xmax = min(p[:, 0].max() + patchsize + 1, xres)
+        ymin = max(p[:, 1].min() - patchsize, 0)
+        ymax = min(p[:, 1].max() + patchsize + 1, yres)
+        window = image_source.data(xmin, xmax, ymin, ymax)
+        local = p - np.array([xmin, ymin])
+        if summarise:
+            s = patch.point_summaries(window.data,
+                                      np.ma.getmaskarray(window),
+                                      patchsize, local, patch_stats)
+            x_data[idx], x_mask[idx] = s.data, s.mask
+            continue
+        x_data[idx] = patch.point_patches(window.data, patchsize, local)
+        x_mask[idx] = patch.point_patches(np.ma.getmaskarray(window),
+                                          patchsize, local)
+    log.debug("Read {} windows for {} targets".format(len(groups),
+                                                      pixels.shape[0]))
+    x_all = np.ma.masked_array(data=x_data, mask=x_mask)
     return x_all
 
 
 def transform_features(feature_sets, transform_sets, final_transform, config):
+    """
+    Transform the covariate chunks of every feature set into one feature
+    matrix.
+
+    Each transform set flattens its image chunks into a FeatureMatrix, which
+    its imputer and transforms work on in place of a masked array. The
+    sets' matrices are concatenated for the final transform.
+
+    Returns
+    -------
+    x : FeatureMatrix
+        the (N, D) transformed features
+    keep : ndarray
+        the (N,) rows with at least one covariate present
+    """
     # apply feature transforms
     transformed_vectors = [t(c) for c, t in zip(feature_sets, transform_sets)]
     # TODO remove this when cubist gets removed
@@ -85,7 +147,7 @@ def transform_features(feature_sets, transform_sets, final_transform, config):
             log.info('Saving featurevec for reuse')
             pickle.dump(feature_vec, open(config.featurevec, 'wb'))
 
-    x = np.ma.concatenate(transformed_vectors, axis=1)
+    x = FeatureMatrix.hstack(transformed_vectors)
     if config.cubist or config.multicubist or config.krige:
         log.warning("{}: Ignoring preprocessing "
                     "transform".format(config.algorithm))
@@ -95,6 +157,104 @@ def transform_features(feature_sets, transform_sets, final_transform, config):
     return x, cull_all_null_rows(feature_sets)
 
 
+def fit_transforms(read_subchunk, n_subchunks, transform_sets,
+                   final_transform=None):
+    """
+    Fit transforms to every subchunk without holding them all in memory.
+
+    Each pass reads every subchunk once and adds it to the statistics of
+    the first transform of each set still to be fitted, after applying
+    the fitted transforms before it. Those transforms are fitted at the
+    end of the pass, so a pass is needed for each transform that depends
+    on the output of another (and one more for the final transform, which
+    sees the output of all the sets).
+
+    Parameters
+    ----------
+    read_subchunk : callable
+        given a subchunk index, returns the list of covariate chunks of
+        each feature set for that subchunk, as `geoio.image_subchunks`
+    n_subchunks : int
+        the number of subchunks
+    transform_sets : list
+        the ImageTransformSet of each feature set
+    final_transform : TransformSet, optional
+        the transform applied to the concatenated feature sets
+
+    Returns
+    -------
+    passes : int
+        the number of passes over the subchunks
+    """
+    final = [final_transform] if final_transform else []
+    passes = 0
+    while not all(t.fitted for t in transform_sets + final):
+        log.info("Fitting transforms: pass {} over {} subchunks".format(
+            passes + 1, n_subchunks))
+        fitting = [not t.fitted for t in transform_sets]
+        stats = [None] * len(transform_sets)
+        final_stats = None
+        for i in range(n_subchunks):
+            feature_sets = read_subchunk(i)
+            for j, (c, t) in enumerate(zip(feature_sets, transform_sets)):
+                if fitting[j]:
+                    stats[j] = t.accumulate(c, stats[j])
+            if final and not any(fitting):
+                x = FeatureMatrix.hstack([t(c) for c, t in
+                                          zip(feature_sets, transform_sets)])
+                final_stats = final_transform.accumulate(x, final_stats)
+        for t, s, f in zip(transform_sets, stats, fitting):
+            if f:
+                t.fit(s)
+        if final and not any(fitting):
+            final_transform.fit(final_stats)
+        passes += 1
+    return passes
+
+
+def stream_features(read_subchunk, transform_sets, final_transform, config,
+                    frac=1.0):
+    """
+    Transform the features of every subchunk, one subchunk at a time.
+
+    The transforms are fitted to all the subchunks first with
+    `fit_transforms`, then a final pass reads and transforms each
+    subchunk in turn, so only one subchunk of raw covariates is ever in
+    memory.
+
+    Parameters
+    ----------
+    read_subchunk : callable
+        given a subchunk index, returns the covariate chunks of each
+        feature set for that subchunk
+    transform_sets : list
+        the ImageTransformSet of each feature set
+    final_transform : TransformSet
+        the transform applied to the concatenated feature sets, or None
+    config : Config
+        the pipeline configuration, with `n_subchunks`
+    frac : float, optional
+        keep this fraction of the transformed rows, chosen at random
+
+    Returns
+    -------
+    x : FeatureMatrix
+        the transformed features of this node
+    """
+    passes = fit_transforms(read_subchunk, config.n_subchunks,
+                            transform_sets, final_transform)
+    log.info("Fitted transforms in {} pass(es)".format(passes))
+    rnd = np.random.RandomState(1)
+    x_all = []
+    for i in range(config.n_subchunks):
+        x, _ = transform_features(read_subchunk(i), transform_sets,
+                                  final_transform, config)
+        if frac < 1.0:
+            x = x[rnd.rand(x.shape[0]) < frac]
+        x_all.append(x)
+    return FeatureMatrix.concatenate(x_all)
+
+
 def save_intersected_features(feature_sets, transform_sets, config):
     """
     This function saves raw covariates values at the target locations, i.e.,
@@ -123,7 +283,7 @@ def save_intersected_features(feature_sets, transform_sets, config):
     transformed_vectors = [t(c) for c, t in zip(feature_sets,
                                                 transform_sets_mod)]
 
-    x = np.ma.concatenate(transformed_vectors, axis=1)
+    x = FeatureMatrix.hstack(transformed_vectors)
     x_all = gather_features(x, node=0)
     if mpiops.chunk_index == 0:
         np.savetxt(config.rawcovariates, X=x_all.data, delimiter=',',
@@ -161,18 +321,31 @@ def cull_all_null_rows(feature_sets):
 
 
 def gather_features(x, node=None):
-    if node:
-        x_all = np.ma.vstack(mpiops.comm.gather(x, root=node))
-    else:
-        x_all = np.ma.vstack(mpiops.comm.allgather(x))
-    return x_all
+    # typed buffers, with the mask packed to a bit per value
+    root = node if node else None
+    if isinstance(x, FeatureMatrix):
+        # already packed, so the mask is sent as it is
+        data = mpiops.gather_array(x.data, root=root)
+        packed = mpiops.gather_array(x.packed_mask, root=root)
+        if data is None:
+            return None
+        return FeatureMatrix.from_packed(data, packed).to_masked()
+    x_all = mpiops.gather_array(x, root=root)
+    if x_all is None:
+        return None
+    return np.ma.masked_array(x_all, mask=np.ma.getmaskarray(x_all))
 
 
 def remove_missing(x, targets=None):
     log.info("Stripping out missing data")
     classes = targets.observations if targets else None
-    if np.ma.count_masked(x) > 0:
-        no_missing_x = np.sum(x.mask, axis=1) == 0
+    if isinstance(x, FeatureMatrix):
+        complete = x.complete
+    else:
+        complete = np.ma.count_masked(x) == 0
+    if not complete:
+        no_missing_x = x.valid_rows if isinstance(x, FeatureMatrix) \
+            else np.sum(x.mask, axis=1) == 0
         x = x.data[no_missing_x]
         # remove labels that correspond to data missing in x
         if targets is not None:
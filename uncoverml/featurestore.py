@@ -0,0 +1,184 @@
+"""
+On-disk cache of covariates intersected with targets.
+
+Each entry holds the values of one covariate at every target position
+intersected so far. Entries are keyed by the covariate file's path, size,
+modification time and grid, the target file and the patch settings. Rows
+are looked up by position, so resampling the targets or splitting them
+over a different number of nodes reuses the entry, and only positions the
+entry doesn't have yet are intersected and added to it. Changing a
+covariate or the target file misses the cache for the affected entries
+only, and nothing ever has to be invalidated by hand.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+from uncoverml import mpiops
+
+log = logging.getLogger(__name__)
+
+
+def file_digest(filename):
+    """A digest of the contents of `filename`"""
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _position_keys(positions):
+    # one complex number per (x, y), which numpy sorts by x then y
+    positions = np.ascontiguousarray(positions, dtype=np.float64)
+    return positions.reshape(-1, 2).view(np.complex128).ravel()
+
+
+class FeatureStore:
+    """
+    A directory of intersected covariates.
+
+    `fetch` runs on the reader threads and only reads entries; the rows it
+    had to intersect are written by `update`, which all nodes call in the
+    same covariate order.
+
+    Parameters
+    ----------
+    directory : str
+        where the entries are kept, created if it doesn't exist
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._new_rows = {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, filename, image_source, targets_digest, patchsize,
+            patch_stats=None):
+        """
+        The key of the entry for a covariate intersected with targets.
+
+        Parameters
+        ----------
+        filename : str
+            the covariate file
+        image_source : ImageSource
+            the source the covariate is read through, for its grid
+        targets_digest : str
+            `file_digest` of the target file, before any resampling
+        patchsize : int
+            the patch half-width
+        patch_stats : list, optional
+            the patch summaries, if any
+        """
+        st = os.stat(filename)
+        crs = image_source.crs
+        return {
+            'path': os.path.abspath(filename),
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'grid': [list(image_source.full_resolution),
+                     image_source.pixsize_x, image_source.pixsize_y,
+                     image_source.origin_longitude,
+                     image_source.origin_latitude,
+                     crs.to_string() if hasattr(crs, 'to_string')
+                     else str(crs)],
+            'targets': targets_digest,
+            'patchsize': patchsize,
+            'patch_stats': list(patch_stats) if patch_stats else None,
+        }
+
+    def _entry(self, key):
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode())
+        return os.path.join(self.directory, digest.hexdigest() + '.npz')
+
+    def get(self, key):
+        """
+        The stored rows for `key`, or None.
+
+        Returns
+        -------
+        positions : ndarray
+            the (M,) positions of the rows as `_position_keys`, sorted
+        x : MaskedArray
+            the (M, ...) covariate values at those positions
+        """
+        try:
+            with np.load(self._entry(key)) as f:
+                return f['positions'], np.ma.masked_array(data=f['data'],
+                                                          mask=f['mask'])
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+
+    def put(self, key, positions, x):
+        """Store the rows `x` at the sorted `positions` under `key`"""
+        entry = self._entry(key)
+        # write then rename so readers never see a partial entry
+        tmp = '{}.{}.{}.tmp'.format(entry, os.getpid(),
+                                    threading.get_ident())
+        with open(tmp, 'wb') as f:
+            np.savez(f, positions=positions, data=np.ma.getdata(x),
+                     mask=np.ma.getmaskarray(x))
+        os.replace(tmp, entry)
+
+    def fetch(self, key, positions, extract):
+        """
+        The covariate values at the (N, 2) `positions`.
+
+        Rows the entry for `key` has are read from it, the others are
+        computed by `extract(missing_positions)` and kept for `update`.
+        """
+        wanted = _position_keys(positions)
+        missing = np.ones(len(wanted), dtype=bool)
+        stored = self.get(key)
+        if stored is not None:
+            stored_positions, stored_x = stored
+            index = np.minimum(np.searchsorted(stored_positions, wanted),
+                               len(stored_positions) - 1)
+            missing = stored_positions[index] != wanted
+        with self._lock:
+            if np.any(missing):
+                self.misses += 1
+            else:
+                self.hits += 1
+        if stored is not None and not np.any(missing):
+            return stored_x[index]
+
+        new = extract(positions[missing])
+        with self._lock:
+            self._new_rows[key['path']] = (key, wanted[missing], new)
+        if stored is None:
+            return new
+        x = stored_x[index]
+        x[missing] = new
+        return x
+
+    def update(self, filename):
+        """
+        Add the rows of `filename` intersected by `fetch` on any node to
+        its entry. This is collective: every node calls it for each
+        covariate, in the same order.
+        """
+        new_rows = mpiops.comm.gather(
+            self._new_rows.pop(os.path.abspath(filename), None), root=0)
+        if mpiops.chunk_index != 0:
+            return
+        new_rows = [r for r in new_rows if r is not None]
+        if not new_rows:
+            return
+        key = new_rows[0][0]
+        parts = [r[1:] for r in new_rows]
+        stored = self.get(key)
+        if stored is not None:
+            parts.insert(0, stored)
+        positions = np.concatenate([p for p, _ in parts])
+        x = np.ma.concatenate([x for _, x in parts], axis=0)
+        # np.unique sorts the positions, dropping repeated targets
+        positions, first = np.unique(positions, return_index=True)
+        self.put(key, positions, x[first])
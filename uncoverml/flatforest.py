@@ -0,0 +1,207 @@
+"""
+Regression forests flattened into arrays, for repeated prediction.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join, isdir
+
+import numpy as np
+
+BLOCK_ROWS = 32768  # rows traversed at once, amortising numpy calls
+COMPACT_LEVELS = 4  # tree levels between checks for rows done descending
+COMPACT_FRACTION = 0.6  # drop those rows once fewer than this are not
+
+_ARRAYS = ['feature', 'threshold', 'children', 'value', 'roots', 'depths']
+
+
+class FlatForest:
+    """
+    Regression trees flattened into contiguous node arrays.
+
+    The nodes of all the trees are numbered consecutively. Node `k` sends a
+    row to node `children[2 * k + 1]` if its `feature[k]` is greater than
+    `threshold[k]`, and to node `children[2 * k]` otherwise. Leaves are
+    their own children, so a tree is traversed one level at a time for a
+    whole block of rows, rows reaching a leaf early staying put.
+
+    Thresholds are scikit-learn's rounded down to float32, which splits
+    float32 features exactly as scikit-learn does.
+
+    Parameters
+    ----------
+    feature : ndarray
+        the (n_nodes,) int32 feature each node splits on
+    threshold : ndarray
+        the (n_nodes,) float32 threshold of each node, infinite for leaves
+    children : ndarray
+        the (2 * n_nodes,) int32 left and right child of each node
+    value : ndarray
+        the (n_nodes,) float64 prediction of each leaf
+    roots : ndarray
+        the (n_trees,) int32 root node of each tree
+    depths : ndarray
+        the (n_trees,) int32 depth of each tree
+    """
+    def __init__(self, feature, threshold, children, value, roots, depths):
+        self.feature = feature
+        self.threshold = threshold
+        self.children = children
+        self.value = value
+        self.roots = roots
+        self.depths = depths
+
+    @classmethod
+    def from_trees(cls, trees, itransform=None):
+        """
+        Flatten fitted single output scikit-learn regression trees.
+
+        Parameters
+        ----------
+        trees : list
+            the trees, e.g. the `estimators_` of a random forest
+        itransform : callable, optional
+            a transform applied to the leaf predictions, such as the
+            inverse of a target transform
+
+        Returns
+        -------
+        forest : FlatForest
+        """
+        parts = {k: [] for k in _ARRAYS}
+        offset = 0
+        for tree in trees:
+            t = tree.tree_
+            leaf = t.children_left < 0
+            nodes = np.arange(t.node_count)
+            threshold = t.threshold.astype(np.float32)
+            threshold = np.where(threshold > t.threshold,
+                                 np.nextafter(threshold, -np.inf), threshold)
+            value = np.zeros(t.node_count)
+            value[leaf] = t.value[leaf, 0, 0]
+            if itransform is not None:
+                value[leaf] = itransform(value[leaf])
+            parts['feature'].append(np.where(leaf, 0, t.feature))
+            parts['threshold'].append(np.where(leaf, np.inf, threshold))
+            parts['children'].append(np.stack(
+                [np.where(leaf, nodes, t.children_left),
+                 np.where(leaf, nodes, t.children_right)], axis=1).ravel() +
+                offset)
+            parts['value'].append(value)
+            parts['roots'].append([offset])
+            parts['depths'].append([t.max_depth])
+            offset += t.node_count
+        return cls(**_concatenate_parts(parts))
+
+    @classmethod
+    def concatenate(cls, forests):
+        """One forest of the trees of `forests`"""
+        parts = {k: [getattr(f, k) for f in forests] for k in _ARRAYS}
+        offsets = np.cumsum([0] + [len(f.value) for f in forests[:-1]])
+        parts['children'] = [c + o for c, o in
+                             zip(parts['children'], offsets)]
+        parts['roots'] = [r + o for r, o in zip(parts['roots'], offsets)]
+        return cls(**_concatenate_parts(parts))
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    def save(self, directory):
+        """Write the node arrays to `directory`, one .npy file each"""
+        os.makedirs(directory, exist_ok=True)
+        for k in _ARRAYS:
+            np.save(join(directory, k + '.npy'), getattr(self, k))
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """
+        Read a forest written by `save`.
+
+        The node arrays are memory mapped by default, so processes
+        predicting with the same forest share its pages.
+        """
+        if not isdir(directory):
+            raise FileNotFoundError("No flat forest in {}".format(directory))
+        return cls(**{k: np.load(join(directory, k + '.npy'),
+                                 mmap_mode=mmap_mode) for k in _ARRAYS})
+
+    def predict_moments(self, X, n_jobs=1):
+        """
+        The mean and variance of the trees' predictions.
+
+        Rows are predicted a block at a time, and each block's mean and
+        variance are updated tree by tree, so memory doesn't grow with the
+        number of trees. Blocks are independent, so they are spread over
+        `n_jobs` threads.
+
+        Parameters
+        ----------
+        X : ndarray
+            the (N, D) features
+        n_jobs : int, optional
+            the number of threads predicting blocks at once
+
+        Returns
+        -------
+        mean : ndarray
+            the (N,) mean prediction
+        var : ndarray
+            the (N,) variance of the predictions
+        """
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        mean = np.zeros(len(X))
+        m2 = np.zeros(len(X))
+
+        def predict_block(start):
+            s = slice(start, start + BLOCK_ROWS)
+            x = X[s].ravel()
+            row_starts = np.arange(len(mean[s]), dtype=np.int32) * X.shape[1]
+            for t in range(self.n_trees):
+                y = np.take(self.value, self._leaves(x, row_starts, t))
+                # Welford's update
+                delta = y - mean[s]
+                mean[s] += delta / (t + 1)
+                m2[s] += delta * (y - mean[s])
+
+        with ThreadPoolExecutor(max_workers=max(n_jobs, 1)) as executor:
+            # list() to raise any error of a block
+            list(executor.map(predict_block,
+                              range(0, len(X), BLOCK_ROWS)))
+        return mean, m2 / max(self.n_trees, 1)
+
+    def predict(self, X, n_jobs=1):
+        """The mean prediction of the trees for the (N, D) features X"""
+        return self.predict_moments(X, n_jobs)[0]
+
+    def _leaves(self, x, row_starts, tree):
+        leaves = np.full(len(row_starts), self.roots[tree], dtype=np.int32)
+        # the rows still descending, their nodes and where they start in x
+        rows, node = None, leaves
+        for level in range(1, self.depths[tree] + 1):
+            right = np.take(x, row_starts + np.take(self.feature, node)) > \
+                np.take(self.threshold, node)
+            node = np.take(self.children, 2 * node + right)
+            # most rows reach a leaf well before the deepest one, so stop
+            # traversing them once enough have
+            if level % COMPACT_LEVELS == 0:
+                descending = np.take(self.threshold, node) < np.inf
+                if np.count_nonzero(descending) < COMPACT_FRACTION * len(node):
+                    if rows is None:
+                        leaves, rows = node, np.flatnonzero(descending)
+                    else:
+                        leaves[rows] = node
+                        rows = rows[descending]
+                    node = node[descending]
+                    row_starts = row_starts[descending]
+        if rows is None:
+            return node
+        leaves[rows] = node
+        return leaves
+
+
+def _concatenate_parts(parts):
+    dtypes = {'feature': np.int32, 'threshold': np.float32,
+              'children': np.int32, 'value': np.float64,
+              'roots': np.int32, 'depths': np.int32}
+    return {k: np.concatenate(v).astype(dtypes[k]) if v else
+            np.zeros(0, dtype=dtypes[k]) for k, v in parts.items()}
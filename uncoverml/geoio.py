@@ -1,13 +1,20 @@
 from __future__ import division
 
+import os
 import os.path
 import logging
+import threading
+import time
 from abc import ABCMeta, abstractmethod
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import json
 import pickle
+from math import gcd
 import matplotlib.pyplot as plt
 import rasterio
+from rasterio.enums import MaskFlags, Resampling
 import numpy as np
 import shapefile
 import tables as hdf
@@ -17,14 +24,146 @@ from uncoverml import image
 from uncoverml import features
 from uncoverml.transforms import missing_percentage
 from uncoverml.targets import Targets
+from uncoverml.featurestore import FeatureStore, file_digest
 
 
 log = logging.getLogger(__name__)
 
+io_threads = 1
+"""int: the number of covariates each node reads concurrently
+"""
+
+
+class DatasetPool:
+    """
+    Per-process LRU pool of open rasterio datasets.
+
+    Every ImageSource reading from a GeoTIFF borrows its handle from this
+    pool instead of calling rasterio.open itself, so the header of each file
+    is parsed once per process rather than once per window. At most
+    `max_open` handles are kept open; the least recently used handle that
+    is not currently borrowed is closed when the limit is exceeded.
+
+    rasterio handles must not be read from two threads at once, so unless
+    the pool is `shared` a handle is lent to one borrower at a time and a
+    second handle on the same file is opened for concurrent borrowers.
+
+    Parameters
+    ----------
+    max_open : int, optional
+        maximum number of datasets kept open at any one time
+    opener : callable, optional
+        function taking a filename and returning an open handle with a
+        `closed` attribute and a `close` method. Defaults to opening the
+        file read-only with rasterio.
+    shared : bool, optional
+        lend the same handle to concurrent borrowers of a file. Only for
+        handles that are safe to use from several threads.
+    """
+    def __init__(self, max_open=64, opener=None, shared=False):
+        self.max_open = max_open
+        self._opener = opener
+        self._shared = shared
+        self._idle = OrderedDict()  # least recently used first
+        self._busy = {}
+        self._lock = threading.RLock()
+        self._pid = os.getpid()
+        self.opens = 0
+        self.hits = 0
+        self.evictions = 0
+
+    @contextmanager
+    def dataset(self, filename):
+        """Borrow an open, read-only dataset for `filename`."""
+        with self._lock:
+            self._check_pid()
+            key = self._reuse(filename)
+            if key is None:
+                ds = self._opener(filename) if self._opener \
+                    else rasterio.open(filename, 'r')
+                key = id(ds)
+                self._busy[key] = [filename, ds, 0]
+                self.opens += 1
+            else:
+                self.hits += 1
+            entry = self._busy[key]
+            entry[2] += 1
+            self._evict()
+        try:
+            yield entry[1]
+        finally:
+            with self._lock:
+                entry[2] -= 1
+                if entry[2] == 0 and self._busy.get(key) is entry:
+                    del self._busy[key]
+                    self._idle[key] = entry  # most recently used at the end
+                self._evict()
+
+    def resize(self, max_open):
+        with self._lock:
+            self.max_open = max(1, int(max_open))
+            self._evict()
+
+    def close_all(self):
+        with self._lock:
+            while self._idle:
+                self._idle.popitem()[1][1].close()
+
+    def stats(self):
+        return {'opens': self.opens, 'hits': self.hits,
+                'evictions': self.evictions,
+                'open': len(self._idle) + len(self._busy)}
+
+    def _reuse(self, filename):
+        if self._shared:
+            for key, entry in self._busy.items():
+                if entry[0] == filename:
+                    return key
+        for key in reversed(list(self._idle.keys())):
+            entry = self._idle[key]
+            if entry[0] == filename:
+                del self._idle[key]
+                if entry[1].closed:
+                    continue
+                self._busy[key] = entry
+                return key
+        return None
+
+    def _evict(self):
+        while self._idle and \
+                len(self._idle) + len(self._busy) > self.max_open:
+            self._idle.popitem(last=False)[1][1].close()
+            self.evictions += 1
+
+    def _check_pid(self):
+        # handles must not be shared with forked children
+        if os.getpid() != self._pid:
+            self._idle = OrderedDict()
+            self._busy = {}
+            self._pid = os.getpid()
+
+
+dataset_pool = DatasetPool()
+"""module-level DatasetPool shared by all RasterioImageSource objects in
+this process
+"""
+
+
+def log_dataset_pool_stats():
+    """Log the dataset pool counters summed over all nodes"""
+    stats = dataset_pool.stats()
+    keys = ['opens', 'hits', 'evictions']
+    totals = mpiops.allreduce_array(np.array([stats[k] for k in keys]))
+    log.info("Dataset pool: {} opens, {} hits, {} evictions".format(*totals))
+
 
 class ImageSource:
     __metaclass__ = ABCMeta
 
+    _block_rows = 1
+    _block_cols = None
+    _y_flipped = False
+
     @abstractmethod
     def data(self, min_x, max_x, min_y, max_y):
         pass
@@ -61,6 +200,19 @@ class ImageSource:
     def crs(self):
         return self._crs
 
+    @property
+    def block_rows(self):
+        return self._block_rows
+
+    @property
+    def block_cols(self):
+        # blocks span whole rows unless the source is tiled
+        return self._block_cols if self._block_cols else self._full_res[0]
+
+    @property
+    def y_flipped(self):
+        return self._y_flipped
+
 
 class RasterioImageSource(ImageSource):
 
@@ -68,7 +220,7 @@ class RasterioImageSource(ImageSource):
 
         self._filename = filename
         assert os.path.isfile(filename), '{} does not exist'.format(filename)
-        with rasterio.open(self._filename, 'r') as geotiff:
+        with dataset_pool.dataset(self._filename) as geotiff:
             self._full_res = (geotiff.width, geotiff.height, geotiff.count)
             self._nodata_value = geotiff.meta['nodata']
             # we don't support different channels with different dtypes
@@ -78,6 +230,12 @@ class RasterioImageSource(ImageSource):
                                      "with differently typed channels")
             self._dtype = np.dtype(geotiff.dtypes[0])
             self._crs = geotiff.crs
+            # size of the internal tiles or strips
+            self._block_rows, self._block_cols = geotiff.block_shapes[0]
+            # only read mask bands when the mask isn't just the nodata
+            self._mask_band = any(
+                MaskFlags.per_dataset in f or MaskFlags.alpha in f
+                for f in geotiff.mask_flag_enums)
 
             A = geotiff.affine
             # No shearing or rotation allowed!!
@@ -104,33 +262,53 @@ class RasterioImageSource(ImageSource):
 
         # NOTE these are exclusive
         window = ((min_y, max_y), (min_x, max_x))
-        with rasterio.open(self._filename, 'r') as geotiff:
-            d = geotiff.read(window=window, masked=True)
-        d = d[np.newaxis, :, :] if d.ndim == 2 else d
-        d = np.ma.transpose(d, [2, 1, 0])  # Transpose and channels at back
+        # GDAL writes straight into a (x, y, band) array through a
+        # transposed (and flipped) view, so the window is decoded once
+        # with no transpose or flip copies afterwards
+        shape = (max_x - min_x, max_y - min_y, self._full_res[2])
+        d = np.empty(shape, dtype=self._dtype)
+        with dataset_pool.dataset(self._filename) as geotiff:
+            geotiff.read(window=window, out=_file_order(d, self._y_flipped))
+            if self._mask_band:
+                valid = np.empty(shape, dtype=np.uint8)
+                geotiff.read_masks(window=window,
+                                   out=_file_order(valid, self._y_flipped))
+                mask = valid == 0
+            else:
+                mask = None
 
         # if nans exist in data, mask them, i.e. convert to nodatavalue
         # TODO: Consider removal once covariates are fixed
-        nans = np.isnan(d.data)
-        if d.mask.ndim:
-            d.mask[nans] = True
-
-        if self._y_flipped:
-            d = d[:, ::-1]
-
-        # Otherwise scikit image complains
-        m = np.ma.MaskedArray(data=np.ascontiguousarray(d.data),
-                              mask=np.ascontiguousarray(d.mask))
-
-        # # uniform mask format
-        # if np.ma.count_masked(m) == 0:
-        #     m = np.ma.masked_array(data=m.data,
-        #                            mask=np.zeros_like(m.data, dtype=bool))
+        mask = _nodata_mask(d, self._nodata_value, mask)
+        m = np.ma.MaskedArray(data=d, mask=mask, copy=False)
         assert m.data.ndim == 3
         assert m.mask.ndim == 3 or m.mask.ndim == 0
         return m
 
 
+def _file_order(a, y_flipped):
+    """A (band, row, column) view of an (x, y, band) array"""
+    a = a.transpose(2, 1, 0)
+    return a[:, ::-1] if y_flipped else a
+
+
+def _nodata_mask(d, nodata, mask=None):
+    """
+    Mask the nodata and NaN pixels of `d`, on top of `mask` if given.
+
+    Only one boolean array the size of `d` is allocated, and NaNs are only
+    looked for in floating point data.
+    """
+    if mask is None:
+        mask = np.zeros(d.shape, dtype=bool) if nodata is None \
+            else np.equal(d, nodata)
+    elif nodata is not None:
+        mask |= d == nodata
+    if d.dtype.kind == 'f' and np.isnan(d).any():
+        mask |= np.isnan(d)
+    return mask
+
+
 class ArrayImageSource(ImageSource):
     """
     An image source that uses an internally stored numpy array
@@ -162,6 +340,195 @@ class ArrayImageSource(ImageSource):
         return data_window
 
 
+class _CubeReader:
+    """
+    Read-only handle on a covariate cube written by write_covariate_cube.
+
+    The most recently read window of all the stacked bands is kept, so the
+    covariates of one window are served from a single read of the cube.
+    """
+    def __init__(self, filename):
+        self._file = hdf.open_file(filename, 'r')
+        self._array = self._file.root.covariates
+        self.meta = json.loads(self._array.attrs.meta)
+        self._layers = {k['path']: k for k in self.meta['layers']}
+        self._lock = threading.Lock()
+        self._window = None
+        self._window_data = None
+
+    @property
+    def closed(self):
+        return not self._file.isopen
+
+    def close(self):
+        self._window_data = None
+        self._file.close()
+
+    def layer(self, filename):
+        """The cube entry for `filename` if it is present and up to date"""
+        layer = self._layers.get(filename)
+        if layer is not None and os.path.isfile(filename):
+            st = os.stat(filename)
+            if (st.st_size, st.st_mtime) != (layer['size'], layer['mtime']):
+                log.warning("{} has changed since it was stacked "
+                            "into the cube".format(filename))
+                layer = None
+        return layer
+
+    def read(self, min_y, max_y, min_x, max_x):
+        window = (min_y, max_y, min_x, max_x)
+        with self._lock:
+            if window != self._window:
+                self._window_data = None
+                self._window_data = self._array[min_y:max_y, min_x:max_x]
+                self._window = window
+            return self._window_data
+
+
+cube_pool = DatasetPool(max_open=4, opener=_CubeReader, shared=True)
+"""module-level DatasetPool of open covariate cubes
+"""
+
+
+class CubeImageSource(ImageSource):
+    """
+    An image source serving one covariate out of a covariate cube.
+
+    Parameters
+    ----------
+    cube : str
+        path of an HDF5 cube written by write_covariate_cube
+    filename : str
+        path of the GeoTIFF the covariate was stacked from
+    """
+    def __init__(self, cube, filename):
+        self._cube = cube
+        self._filename = filename
+        with cube_pool.dataset(cube) as reader:
+            meta = reader.meta
+            layer = reader.layer(filename)
+        if layer is None:
+            raise ValueError("{} is not stacked in {}".format(filename, cube))
+
+        self._offset = layer['offset']
+        self._full_res = (meta['width'], meta['height'], layer['count'])
+        self._nodata_value = layer['nodata']
+        self._dtype = np.dtype(layer['dtype'])
+        self._crs = rasterio.crs.CRS.from_string(meta['crs'])
+        self._pixsize_x = meta['pixsize_x']
+        self._pixsize_y = meta['pixsize_y']
+        self._start_lon = meta['origin_longitude']
+        self._start_lat = meta['origin_latitude']
+        self._y_flipped = meta['y_flipped']
+        self._block_rows = meta['chunk_rows']
+
+    def data(self, min_x, max_x, min_y, max_y):
+
+        if self._y_flipped:
+            min_y, max_y = (self._full_res[1] - max_y,
+                            self._full_res[1] - min_y)
+
+        with cube_pool.dataset(self._cube) as reader:
+            w = reader.read(min_y, max_y, min_x, max_x)
+        # rows, columns, bands -> columns, rows, bands in a single copy
+        end = self._offset + self._full_res[2]
+        d = np.empty((w.shape[1], w.shape[0], self._full_res[2]),
+                     dtype=self._dtype)
+        rows = d.transpose(1, 0, 2)
+        rows = rows[::-1] if self._y_flipped else rows
+        rows[...] = w[:, :, self._offset:end]
+        mask = _nodata_mask(d, self._nodata_value)
+        return np.ma.MaskedArray(data=d, mask=mask, copy=False)
+
+
+def write_covariate_cube(config, filename, chunk_mb=32., complevel=0):
+    """
+    Stack all the covariates of a config into one chunked HDF5 array.
+
+    The cube has shape (rows, columns, bands) in the row order of the
+    GeoTIFFs, with all the bands of all the covariates along the last axis,
+    and is chunked into strips of full rows so that the covariates of a
+    chunk are read with one contiguous read. Pointing the `cube` section of
+    a config at the result makes CubeImageSource serve the covariates.
+
+    Parameters
+    ----------
+    config : Config
+        the pipeline configuration whose covariates are stacked
+    filename : str
+        output HDF5 file
+    chunk_mb : float, optional
+        approximate size in megabytes of each HDF5 chunk
+    complevel : int, optional
+        blosc compression level, 0 (no compression) to 9
+    """
+    files = [f for s in config.feature_sets for f in s.files]
+    sources = [RasterioImageSource(f) for f in files]
+    template = sources[0]
+    for f, s in zip(files, sources):
+        same_grid = (s.full_resolution[:2] == template.full_resolution[:2]
+                     and s.pixsize_x == template.pixsize_x
+                     and s.pixsize_y == template.pixsize_y
+                     and s.origin_longitude == template.origin_longitude
+                     and s.origin_latitude == template.origin_latitude
+                     and s.y_flipped == template.y_flipped)
+        if not same_grid:
+            raise ValueError("{} is not on the same grid as {}".format(
+                f, files[0]))
+
+    width, height = template.full_resolution[:2]
+    counts = [s.full_resolution[2] for s in sources]
+    offsets = np.cumsum([0] + counts)
+    nbands = int(offsets[-1])
+    dtype = np.result_type(*[s.dtype for s in sources])
+
+    # whole strips of rows, a multiple of every covariate's block height
+    block = 1
+    for s in sources:
+        block = block * s.block_rows // gcd(block, s.block_rows)
+    rows = int(chunk_mb * 2**20) // (width * nbands * dtype.itemsize)
+    rows = min(max(block, rows // block * block), height)
+
+    layers = []
+    for f, s, off, c in zip(files, sources, offsets, counts):
+        st = os.stat(f)
+        layers.append({'path': f, 'offset': int(off), 'count': c,
+                       'dtype': s.dtype.str,
+                       'nodata': None if s.nodata_value is None
+                       else float(s.nodata_value),
+                       'size': st.st_size, 'mtime': st.st_mtime})
+    meta = {'width': width, 'height': height,
+            'pixsize_x': template.pixsize_x,
+            'pixsize_y': template.pixsize_y,
+            'origin_longitude': template.origin_longitude,
+            'origin_latitude': template.origin_latitude,
+            'y_flipped': template.y_flipped,
+            'crs': template.crs.to_string(),
+            'chunk_rows': rows,
+            'layers': layers}
+
+    filters = hdf.Filters(complevel=complevel, complib='blosc') \
+        if complevel else None
+    log.info("Stacking {} covariates ({} bands) into {}".format(
+        len(files), nbands, filename))
+    with hdf.open_file(filename, 'w') as h5:
+        cube = h5.create_carray('/', 'covariates',
+                                atom=hdf.Atom.from_dtype(dtype),
+                                shape=(height, width, nbands),
+                                chunkshape=(rows, width, nbands),
+                                filters=filters)
+        for r0 in range(0, height, rows):
+            r1 = min(r0 + rows, height)
+            strip = np.empty((r1 - r0, width, nbands), dtype=dtype)
+            for f, off, c in zip(files, offsets, counts):
+                with dataset_pool.dataset(f) as geotiff:
+                    d = geotiff.read(window=((r0, r1), (0, width)))
+                strip[:, :, off:off + c] = np.transpose(d, [1, 2, 0])
+            cube[r0:r1] = strip
+            log.info("Stacked rows {} to {} of {}".format(r0, r1, height))
+        cube.attrs.meta = json.dumps(meta)
+
+
 def load_shapefile(filename, targetfield):
     """
     TODO
@@ -235,11 +602,56 @@ def get_image_spec(model, config):
 
 
 class ImageWriter:
+    """
+    Writes the prediction image, one GeoTIFF per band.
+
+    By default every node sends its partitions to node 0, which writes
+    them. With `parallel`, each node instead writes its own partitions as
+    multiband GeoTIFF tiles, and `close` stitches the tiles into one VRT per
+    band, so output bandwidth grows with the number of nodes and node 0
+    never holds more than its own partition.
+
+    Parameters
+    ----------
+    shape : tuple
+        the (width, height, ...) of the image
+    bbox : ndarray
+        the bounding box of the image
+    crs : CRS
+        the coordinate reference system of the image
+    name : str
+        the prefix of the output files
+    n_subchunks : int
+        the number of partitions each node writes
+    outputdir : str
+        the directory to write to
+    band_tags : list, optional
+        the name of each output band
+    block_rows : int, optional
+        the row alignment of the partitions, see `geoio.block_alignment`
+    block_phase : int, optional
+        the row offset of the partition alignment
+    parallel : bool, optional
+        have every node write its own partitions
+    multiband : bool, optional
+        write all bands to a single file instead of a file per band
+    compress : str, optional
+        the GDAL compression of the output, e.g. 'deflate' or 'zstd'.
+        Compressed outputs are tiled and use the floating point predictor.
+    overviews : bool, optional
+        build internal overviews of the output GeoTIFFs when closing
+    patchsize : int, optional
+        the patch half-width the partitions were read with; the image is
+        that many pixels smaller than the covariates on every side
+    """
 
     nodata_value = np.array(-1e20, dtype='float32')
+    block_size = 256
 
     def __init__(self, shape, bbox, crs, name, n_subchunks, outputdir,
-                 band_tags=None):
+                 band_tags=None, block_rows=1, block_phase=0,
+                 parallel=False, multiband=False, compress=None,
+                 overviews=False, patchsize=0):
         # affine
         self.A, _, _ = image.bbox2affine(bbox[1, 0], bbox[0, 0],
                                          bbox[0, 1], bbox[1, 1],
@@ -247,12 +659,23 @@ class ImageWriter:
         self.shape = shape
         self.outbands = len(band_tags)
         self.bbox = bbox
+        self.crs = crs
         self.name = name
         self.outputdir = outputdir
         self.n_subchunks = n_subchunks
-        self.sub_starts = [k[0] for k in np.array_split(
-                           np.arange(self.shape[1]),
-                           mpiops.chunks * self.n_subchunks)]
+        self.parallel = parallel
+        self.multiband = multiband
+        self.overviews = overviews
+        self.options = {'tiled': True, 'blockxsize': self.block_size,
+                        'blockysize': self.block_size,
+                        'compress': compress, 'predictor': 3} \
+            if compress else {}
+        # partitions are split on the covariate rows, each losing the
+        # patch halo at its edges
+        self.sub_starts = image.chunk_starts(self.shape[1] + 2 * patchsize,
+                                             mpiops.chunks * self.n_subchunks,
+                                             block_rows, block_phase)
+        self.sub_starts = np.maximum(self.sub_starts - patchsize, 0)
 
         # file tags don't have spaces
         if band_tags:
@@ -260,20 +683,38 @@ class ImageWriter:
         else:
             file_tags = [str(k) for k in range(self.outbands)]
             band_tags = file_tags
+        self.band_tags = band_tags
 
-        if mpiops.chunk_index == 0:
-            # create a file for each band
-            self.files = []
-            for band in range(self.outbands):
-                output_filename = os.path.join(outputdir, name + "_" +
-                                               file_tags[band] + ".tif")
+        ext = ".vrt" if parallel else ".tif"
+        if multiband:
+            self.filenames = [os.path.join(outputdir, name + ext)]
+        else:
+            self.filenames = [os.path.join(outputdir, name + "_" + t + ext)
+                              for t in file_tags]
+        self.files = []
+        if parallel:
+            self.tiledir = os.path.join(outputdir, name + "_tiles")
+            if mpiops.chunk_index == 0:
+                os.makedirs(self.tiledir, exist_ok=True)
+            mpiops.comm.barrier()
+            self.tiles = []
+            if overviews:
+                log.info("Overviews are not built for parallel writes")
+        elif mpiops.chunk_index == 0:
+            # create a file for each band, or one for all of them
+            count = self.outbands if multiband else 1
+            for i, output_filename in enumerate(self.filenames):
                 f = rasterio.open(output_filename, 'w', driver='GTiff',
                                   width=self.shape[0], height=self.shape[1],
-                                  dtype=np.float32, count=1,
+                                  dtype=np.float32, count=count,
                                   crs=crs,
                                   transform=self.A,
-                                  nodata=self.nodata_value)
-                f.update_tags(1, image_type=band_tags[band])
+                                  nodata=self.nodata_value,
+                                  **self.options)
+                tags = band_tags if multiband else [band_tags[i]]
+                for band, tag in enumerate(tags, start=1):
+                    f.update_tags(band, image_type=tag)
+                    f.set_band_description(band, tag)
                 self.files.append(f)
 
     def write(self, x, subchunk_index):
@@ -286,6 +727,10 @@ class ImageWriter:
         if x.mask is not False:
             x.data[x.mask] = self.nodata_value
 
+        if self.parallel:
+            self._write_tile(image, subchunk_index)
+            return
+
         mpiops.comm.barrier()
         log.info("Writing partition to output file")
         if mpiops.chunk_index != 0:
@@ -300,18 +745,130 @@ class ImageWriter:
                 data = np.ma.transpose(data, [2, 1, 0])  # untranspose
                 yend = ystart + data.shape[1]  # this is Y
                 window = ((ystart, yend), (0, self.shape[0]))
-                # write each band separately
-                for i, f in enumerate(self.files):
-                    f.write(data[i:i+1], window=window)
+                if self.multiband:
+                    self.files[0].write(data[:self.outbands], window=window)
+                else:
+                    # write each band separately
+                    for i, f in enumerate(self.files):
+                        f.write(data[i:i+1], window=window)
+        mpiops.comm.barrier()
+
+    def _write_tile(self, image, subchunk_index):
+        from affine import Affine
+        subindex = mpiops.chunks * subchunk_index + mpiops.chunk_index
+        ystart = self.sub_starts[subindex]
+        data = np.ma.getdata(np.ma.transpose(image, [2, 1, 0]))
+        tile = os.path.join(self.tiledir,
+                            "part{:05d}.tif".format(subindex))
+        log.info("Writing partition to {}".format(tile))
+        with rasterio.open(tile, 'w', driver='GTiff',
+                           width=self.shape[0], height=data.shape[1],
+                           dtype=np.float32, count=self.outbands,
+                           crs=self.crs,
+                           transform=self.A * Affine.translation(0, ystart),
+                           nodata=self.nodata_value, **self.options) as f:
+            f.write(data[:self.outbands])
+        self.tiles.append((ystart, data.shape[1], tile))
+
+    def close(self):
+        """
+        Finish the output files. With parallel writes this gathers the
+        tiles written by every node and writes the VRT of each band.
+        """
+        for f in self.files:
+            if self.overviews:
+                factors = _overview_factors(self.shape[0], self.shape[1],
+                                            self.block_size)
+                log.info("Building overviews {} of {}".format(factors,
+                                                              f.name))
+                f.build_overviews(factors, Resampling.average)
+            f.close()
+        self.files = []
+        if not self.parallel:
+            return
+        tiles = mpiops.comm.gather(self.tiles, root=0)
+        if mpiops.chunk_index == 0:
+            tiles = sorted(t for node_tiles in tiles for t in node_tiles)
+            bands = list(enumerate(self.band_tags, start=1))
+            for i, filename in enumerate(self.filenames):
+                _write_vrt(filename, self.shape[0], self.shape[1], self.A,
+                           self.crs, tiles,
+                           bands if self.multiband else [bands[i]],
+                           float(self.nodata_value))
         mpiops.comm.barrier()
 
     def output_thumbnails(self, ratio=10):
         if mpiops.chunk_index == 0:
             # input_tif, output_tif, ratio, resampling=5
-            for f in self.files:
-                thumbnails = os.path.splitext(f.name)
-                thumbnail = thumbnails[0] + '_thumbnail' + thumbnails[1]
-                resample(f, output_tif=thumbnail, ratio=ratio)
+            for f in self.filenames:
+                thumbnail = os.path.splitext(f)[0] + '_thumbnail.tif'
+                if self.overviews and not self.parallel:
+                    _decimate(f, output_tif=thumbnail, ratio=ratio)
+                else:
+                    resample(f, output_tif=thumbnail, ratio=ratio)
+
+
+def _overview_factors(width, height, block_size):
+    factors = []
+    factor = 2
+    while min(width, height) / factor >= block_size / 2:
+        factors.append(factor)
+        factor *= 2
+    return factors or [2]
+
+
+def _decimate(input_tif, output_tif, ratio):
+    """
+    Write a shrunken copy of a raster, read from its overviews.
+    """
+    with rasterio.open(input_tif) as src:
+        shape = (src.count, max(1, round(src.height / ratio)),
+                 max(1, round(src.width / ratio)))
+        data = src.read(out_shape=shape, resampling=Resampling.average)
+        transform = src.transform * src.transform.scale(
+            src.width / shape[2], src.height / shape[1])
+        with rasterio.open(output_tif, 'w', driver='GTiff',
+                           height=shape[1], width=shape[2],
+                           count=src.count, dtype=rasterio.float32,
+                           crs=src.crs, transform=transform,
+                           nodata=src.nodata) as dest:
+            dest.write(data.astype(np.float32))
+
+
+def _write_vrt(filename, width, height, affine, crs, tiles, bands, nodata):
+    """
+    Write a VRT mosaicking full width row tiles.
+
+    `tiles` is a list of (row offset, rows, tile filename) tuples and
+    `bands` a list of (tile band, tag) tuples, one per VRT band.
+    """
+    from xml.etree import ElementTree as ET
+    root = ET.Element('VRTDataset', rasterXSize=str(width),
+                      rasterYSize=str(height))
+    if crs:
+        ET.SubElement(root, 'SRS').text = \
+            rasterio.crs.CRS.from_user_input(crs).to_wkt()
+    ET.SubElement(root, 'GeoTransform').text = \
+        ', '.join(repr(float(v)) for v in affine.to_gdal())
+    vrtdir = os.path.dirname(os.path.abspath(filename))
+    for i, (band, tag) in enumerate(bands, start=1):
+        vrt_band = ET.SubElement(root, 'VRTRasterBand', dataType='Float32',
+                                 band=str(i))
+        ET.SubElement(vrt_band, 'Description').text = tag
+        metadata = ET.SubElement(vrt_band, 'Metadata')
+        ET.SubElement(metadata, 'MDI', key='image_type').text = tag
+        ET.SubElement(vrt_band, 'NoDataValue').text = repr(nodata)
+        for ystart, rows, tile in tiles:
+            source = ET.SubElement(vrt_band, 'SimpleSource')
+            ET.SubElement(source, 'SourceFilename',
+                          relativeToVRT='1').text = \
+                os.path.relpath(os.path.abspath(tile), vrtdir)
+            ET.SubElement(source, 'SourceBand').text = str(band)
+            ET.SubElement(source, 'SrcRect', xOff='0', yOff='0',
+                          xSize=str(width), ySize=str(rows))
+            ET.SubElement(source, 'DstRect', xOff='0', yOff=str(ystart),
+                          xSize=str(width), ySize=str(rows))
+    ET.ElementTree(root).write(filename)
 
 
 def feature_names(config):
@@ -327,35 +884,83 @@ def feature_names(config):
     return results
 
 
-def _iterate_sources(f, config):
+def covariate_source(filename, config):
+    """
+    The ImageSource for a covariate, served from the config's covariate cube
+    when the covariate is stacked in it and unchanged since.
+    """
+    if config.cube:
+        try:
+            return CubeImageSource(config.cube, filename)
+        except ValueError as e:
+            log.warning("{}: reading the GeoTIFF instead".format(e))
+    return RasterioImageSource(filename)
+
+
+def _read_source(f, tif, config):
+    start = time.time()
+    x = f(covariate_source(tif, config))
+    return x, time.time() - start
+
 
+def _submit_reads(f, config, executor):
+    tifs = [tif for s in config.feature_sets for tif in s.files]
+    return deque(executor.submit(_read_source, f, tif, config)
+                 for tif in tifs)
+
+
+def _iterate_sources(f, config, reads=None):
+
+    if reads is None:
+        # GDAL releases the GIL while decoding, so reading the covariates in
+        # threads overlaps their decompression.
+        with ThreadPoolExecutor(max_workers=max(1, io_threads)) as executor:
+            return _iterate_sources(f, config,
+                                    _submit_reads(f, config, executor))
+
+    # The collectives in _log_read stay on this thread and run in file
+    # order on every node, whichever thread did the reading.
+    start = time.time()
+    n_reads = len(reads)
+    total_bytes = 0
     results = []
     for s in config.feature_sets:
         extracted_chunks = {}
         for tif in s.files:
             name = os.path.basename(tif)
-            image_source = RasterioImageSource(tif)
-            x = f(image_source)
-            # TODO this may hurt performance. Consider removal
-            if type(x) is np.ma.MaskedArray:
-                count = mpiops.count(x)
-                # if not np.all(count > 0):
-                #     s = ("{} has no data in at least one band.".format(name) +
-                #          " Valid_pixel_count: {}".format(count))
-                #     raise ValueError(s)
-                missing_percent = missing_percentage(x)
-                t_missing = mpiops.comm.allreduce(
-                    missing_percent) / mpiops.chunks
-                log.info("{}: {}px {:2.2f}% missing".format(
-                    name, count, t_missing))
+            x, seconds = reads.popleft().result()
+            total_bytes += getattr(x, 'nbytes', 0)
+            _log_read(name, x, seconds)
             extracted_chunks[name] = x
         extracted_chunks = OrderedDict(sorted(
             extracted_chunks.items(), key=lambda t: t[0]))
 
         results.append(extracted_chunks)
+    log.info("Read {} covariates ({:.1f}MB) in {:.2f}s using {} "
+             "thread(s)".format(n_reads, total_bytes / 1e6,
+                                time.time() - start, max(1, io_threads)))
     return results
 
 
+def _log_read(name, x, seconds):
+    nbytes = getattr(x, 'nbytes', 0)
+    read = "{:.1f}MB read in {:.2f}s".format(nbytes / 1e6, seconds)
+    # TODO this may hurt performance. Consider removal
+    if type(x) is np.ma.MaskedArray:
+        count = mpiops.count(x)
+        # if not np.all(count > 0):
+        #     s = ("{} has no data in at least one band.".format(name) +
+        #          " Valid_pixel_count: {}".format(count))
+        #     raise ValueError(s)
+        missing_percent = missing_percentage(x)
+        t_missing = mpiops.comm.allreduce(
+            missing_percent) / mpiops.chunks
+        log.info("{}: {}px {:2.2f}% missing, {}".format(
+            name, count, t_missing, read))
+    else:
+        log.debug("{}: {}".format(name, read))
+
+
 def image_resolutions(config):
     def f(image_source):
         r = image_source._full_res
@@ -365,13 +970,103 @@ def image_resolutions(config):
     return result
 
 
-def image_subchunks(subchunk_index, config):
+def _block_alignment(config):
+    sources = [covariate_source(f, config)
+               for s in config.feature_sets for f in s.files]
+    extra = [config.mask] if config.mask else []
+    if config.lon_lat:
+        extra.extend([config.lat, config.lon])
+    sources.extend(RasterioImageSource(f) for f in extra)
+    heights = {s.full_resolution[1] for s in sources}
+    flips = {s.y_flipped for s in sources}
+    if len(heights) != 1 or len(flips) != 1:
+        log.info("Rasters differ in height or orientation: "
+                 "chunks will not be block aligned")
+        return 1, 0
+    height = heights.pop()
+    rows = 1
+    for s in sources:
+        rows = rows * s.block_rows // gcd(rows, s.block_rows)
+    if rows > height:
+        return 1, 0
+    # image rows run upwards from the bottom of a north-up file, so the
+    # block boundaries are counted from the last row
+    phase = height % rows if flips.pop() else 0
+    return rows, phase
+
+
+def block_alignment(config):
+    """
+    Find the row alignment shared by every raster the config reads.
+
+    Chunk boundaries that are multiples of the returned number of rows
+    (offset by the returned phase) never split an internal tile or strip
+    of any covariate, mask or lon/lat raster, so no block is decompressed
+    by two nodes. Rasters with different block heights are aligned on the
+    least common multiple of those heights.
+
+    Parameters
+    ----------
+    config : Config
+        the pipeline configuration
+
+    Returns
+    -------
+    block_rows : int
+        the number of rows chunk boundaries should be a multiple of
+    block_phase : int
+        the row offset of the first block boundary
+    """
+    rows, phase = mpiops.run_once(_block_alignment, config)
+    log.info("Aligning chunks to blocks of {} rows".format(rows))
+    return rows, phase
+
+
+def _subchunk_reader(subchunk_index, config, masked=False):
+
+    extract = features.masked_subchunks if masked \
+        else features.extract_subchunks
 
     def f(image_source):
-        r = features.extract_subchunks(image_source, subchunk_index,
-                                       config.n_subchunks, config.patchsize)
+        r = extract(image_source, subchunk_index, config.n_subchunks,
+                    config.patchsize, config.block_rows, config.block_phase,
+                    config.patch_stats)
         return r
-    result = _iterate_sources(f, config)
+    return f
+
+
+def submit_subchunk_reads(subchunk_index, config, executor, masked=False):
+    """
+    Start reading the covariates of a subchunk in the background.
+
+    The reads involve no communication, so they can run while this node
+    works on the previous subchunk; pass the result to `image_subchunks`
+    to collect them.
+
+    Parameters
+    ----------
+    subchunk_index : int
+        the subchunk to read
+    config : Config
+        the pipeline configuration
+    executor : concurrent.futures.Executor
+        the executor to run the reads on
+    masked : bool, optional
+        the subchunk is entirely masked on this node, so return masked
+        arrays of the right shape instead of reading
+
+    Returns
+    -------
+    reads : deque
+        the futures of the reads, in covariate order
+    """
+    return _submit_reads(_subchunk_reader(subchunk_index, config, masked),
+                         config, executor)
+
+
+def image_subchunks(subchunk_index, config, reads=None, masked=False):
+    f = _subchunk_reader(subchunk_index, config, masked)
+    result = _iterate_sources(f, config, reads)
     return result
 
 
@@ -379,9 +1074,33 @@ def image_feature_sets(targets, config):
 
     def f(image_source):
         r = features.extract_features(image_source, targets,
-                                      config.n_subchunks, config.patchsize)
+                                      config.patchsize, config.patch_stats)
         return r
-    result = _iterate_sources(f, config)
+
+    if not config.feature_store:
+        return _iterate_sources(f, config)
+
+    store = FeatureStore(config.feature_store)
+    digest = file_digest(config.target_file)
+
+    def cached(image_source):
+        key = store.key(image_source._filename, image_source, digest,
+                        config.patchsize, config.patch_stats)
+
+        def extract(positions):
+            return features.extract_features(
+                image_source, Targets(positions, None), config.patchsize,
+                config.patch_stats)
+        return store.fetch(key, targets.positions, extract)
+
+    result = _iterate_sources(cached, config)
+    for s in config.feature_sets:
+        for tif in s.files:
+            store.update(tif)
+    hits = mpiops.comm.allreduce(store.hits)
+    misses = mpiops.comm.allreduce(store.misses)
+    log.info("Feature store: {} covariates intersected, {} reused".format(
+        misses, hits))
     return result
 
 
@@ -390,14 +1109,19 @@ def semisupervised_feature_sets(targets, config):
     frac = config.subsample_fraction
 
     def f(image_source):
-        r_t = features.extract_features(image_source, targets, n_subchunks=1,
-                                        patchsize=config.patchsize)
+        r_t = features.extract_features(image_source, targets,
+                                        patchsize=config.patchsize,
+                                        patch_stats=config.patch_stats)
         r_a = features.extract_subchunks(image_source, subchunk_index=0,
                                          n_subchunks=1,
-                                         patchsize=config.patchsize)
+                                         patchsize=config.patchsize,
+                                         block_rows=config.block_rows,
+                                         block_phase=config.block_phase,
+                                         patch_stats=config.patch_stats)
         if frac < 1.0:
-            np.random.seed(1)
-            r_a = r_a[np.random.rand(r_a.shape[0]) < frac]
+            # covariates are read in threads, so don't touch the global seed
+            rnd = np.random.RandomState(1)
+            r_a = r_a[rnd.rand(r_a.shape[0]) < frac]
 
         r_data = np.concatenate([r_t.data, r_a.data], axis=0)
         r_mask = np.concatenate([r_t.mask, r_a.mask], axis=0)
@@ -414,10 +1138,14 @@ def unsupervised_feature_sets(config):
     def f(image_source):
         r = features.extract_subchunks(image_source, subchunk_index=0,
                                        n_subchunks=1,
-                                       patchsize=config.patchsize)
+                                       patchsize=config.patchsize,
+                                       block_rows=config.block_rows,
+                                       block_phase=config.block_phase,
+                                       patch_stats=config.patch_stats)
         if frac < 1.0:
-            np.random.seed(1)
-            r = r[np.random.rand(r.shape[0]) < frac]
+            # covariates are read in threads, so don't touch the global seed
+            rnd = np.random.RandomState(1)
+            r = r[rnd.rand(r.shape[0]) < frac]
         return r
     result = _iterate_sources(f, config)
     return result
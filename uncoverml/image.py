@@ -6,28 +6,49 @@ from affine import Affine
 log = logging.getLogger(__name__)
 
 
-def construct_splits(npixels, nchunks, overlap=0):
+def chunk_starts(npixels, nchunks, block_rows=1, block_phase=0):
+    """
+    First row of each of `nchunks` contiguous chunks of `npixels` rows.
+
+    The chunks are as even as np.array_split would make them, except that
+    every interior boundary is moved to the nearest row `r` with
+    (r - block_phase) % block_rows == 0, so that no chunk boundary cuts
+    through a tile or strip of the underlying file. If the image is too
+    small to give every chunk at least one block the unaligned starts are
+    returned.
+    """
+    starts = np.array([s[0] for s in np.array_split(np.arange(npixels),
+                                                    nchunks)])
+    if block_rows > 1 and nchunks > 1:
+        inner = starts[1:] - block_phase
+        inner = np.round(inner / block_rows) * block_rows + block_phase
+        aligned = np.concatenate(([0], np.clip(inner, 0, npixels)))
+        aligned = aligned.astype(int)
+        if np.all(np.diff(np.append(aligned, npixels)) > 0):
+            return aligned
+        log.debug("Too few blocks of {} rows to align {} "
+                  "chunks".format(block_rows, nchunks))
+    return starts
+
+
+def construct_splits(npixels, nchunks, overlap=0, block_rows=1,
+                     block_phase=0):
     # Build the equivalent windowed image
     # y bounds are EXCLUSIVE
-    y_arrays = np.array_split(np.arange(npixels), nchunks)
+    starts = chunk_starts(npixels, nchunks, block_rows, block_phase)
+    ends = np.append(starts[1:], npixels)
     y_bounds = []
     # construct the overlap
-    for i, s in enumerate(y_arrays):
-        if i == 0:
-            p_min = s[0]
-            p_max = s[-1] + overlap + 1
-        elif i == len(y_arrays) - 1:
-            p_min = s[0] - overlap
-            p_max = s[-1] + 1
-        else:
-            p_min = s[0] - overlap
-            p_max = s[-1] + overlap + 1
-        y_bounds.append((p_min, p_max))
+    for i, (s, e) in enumerate(zip(starts, ends)):
+        p_min = s - overlap if i > 0 else s
+        p_max = e + overlap if (i == 0 or i < nchunks - 1) else e
+        y_bounds.append((int(p_min), int(p_max)))
     return y_bounds
 
 
 class Image:
-    def __init__(self, source, chunk_idx=0, nchunks=1, overlap=0):
+    def __init__(self, source, chunk_idx=0, nchunks=1, overlap=0,
+                 block_rows=1, block_phase=0):
         assert chunk_idx >= 0 and chunk_idx < nchunks
 
         if nchunks == 1 and overlap != 0:
@@ -51,21 +72,14 @@ class Image:
         assert self.pixsize_x > 0
         assert self.pixsize_y > 0
 
-        # construct the canonical pixel<->position map
-        pix_x = range(self._full_res[0] + 1)  # outer corner of last pixel
-        coords_x = [self._start_lon + float(k) * self.pixsize_x
-                    for k in pix_x]
-        self._coords_x = coords_x
-        pix_y = range(self._full_res[1] + 1)  # ditto
-        coords_y = [self._start_lat + float(k) * self.pixsize_y
-                    for k in pix_y]
-        self._coords_y = coords_y
-        self._pix_x_to_coords = dict(zip(pix_x, coords_x))
-        self._pix_y_to_coords = dict(zip(pix_y, coords_y))
+        # the canonical pixel<->position map, shared by images on this grid
+        self.geometry = grid_geometry(self._start_lon, self._start_lat,
+                                      self.pixsize_x, self.pixsize_y,
+                                      self._full_res[0], self._full_res[1])
 
         # exclusive y range of this chunk in full image
-        ymin, ymax = construct_splits(self._full_res[1],
-                                      nchunks, overlap)[chunk_idx]
+        ymin, ymax = construct_splits(self._full_res[1], nchunks, overlap,
+                                      block_rows, block_phase)[chunk_idx]
         self._offset = np.array([0, ymin], dtype=int)
         # exclusive x range of this chunk (same for all chunks)
         xmin, xmax = 0, self._full_res[0]
@@ -166,9 +180,7 @@ class Image:
 
     # @contract(xy='array[Nx2](int64),N>0')
     def _global_pix2lonlat(self, xy):
-        result = np.array([[self._pix_x_to_coords[x],
-                           self._pix_y_to_coords[y]] for x, y in xy])
-        return result
+        return self.geometry.pix2lonlat(xy)
 
     # @contract(xy='array[Nx2](int64),N>0')
     def pix2lonlat(self, xy):
@@ -177,24 +189,13 @@ class Image:
 
     # @contract(lonlat='array[Nx2](float64),N>0')
     def _global_lonlat2pix(self, lonlat):
-        x = np.searchsorted(self._coords_x, lonlat[:, 0], side='right') - 1
-        x = x.astype(int)
-        ycoords = self._coords_y
-        y = np.searchsorted(ycoords, lonlat[:, 1], side='right') - 1
-        y = y.astype(int)
-
-        # We want the *closed* interval, which means moving
-        # points on the end back by 1
-        on_end_x = lonlat[:, 0] == self._coords_x[-1]
-        on_end_y = lonlat[:, 1] == self._coords_y[-1]
-        x[on_end_x] -= 1
-        y[on_end_y] -= 1
+        result = self.geometry.lonlat2pix(lonlat)
+        x = result[:, 0]
+        y = result[:, 1]
         if (not all(np.logical_and(x >= 0, x < self._full_res[0]))) or \
                 (not all(np.logical_and(y >= 0, y < self._full_res[1]))):
             raise ValueError("Queried location is not "
                              "in the image {}!".format(self.source._filename))
-
-        result = np.concatenate((x[:, np.newaxis], y[:, np.newaxis]), axis=1)
         return result
 
     # @contract(lonlat='array[Nx2](float64),N>0')
@@ -221,6 +222,66 @@ class Image:
         return result
 
 
+class GridGeometry:
+    """
+    The mapping between pixels and coordinates of a grid whose y axis runs
+    up the image.
+
+    Pixel `k` of an axis has its outer corner at ``origin + k * pixsize``,
+    and coordinates on the far edge of the grid belong to its last pixel.
+    Conversions are vectorised affine arithmetic, so the cost does not
+    grow with the size of the grid.
+
+    Parameters
+    ----------
+    origin_x, origin_y : float
+        the coordinates of the corner of pixel (0, 0)
+    pixsize_x, pixsize_y : float
+        the (positive) size of a pixel
+    width, height : int
+        the size of the grid in pixels
+    """
+    def __init__(self, origin_x, origin_y, pixsize_x, pixsize_y, width,
+                 height):
+        self.origin = np.array([origin_x, origin_y], dtype=float)
+        self.pixsize = np.array([pixsize_x, pixsize_y], dtype=float)
+        self.shape = np.array([width, height], dtype=int)
+
+    def pix2lonlat(self, xy):
+        """The coordinates of the outer corners of (N, 2) pixels"""
+        return self.origin + np.asarray(xy).astype(float) * self.pixsize
+
+    def lonlat2pix(self, lonlat):
+        """
+        The (N, 2) pixels containing coordinates. Points off the grid get
+        pixel -1 or width (height) on that axis.
+        """
+        lonlat = np.asarray(lonlat, dtype=float)
+        pix = np.floor((lonlat - self.origin) / self.pixsize)
+        pix = np.clip(pix, -1, self.shape).astype(int)
+        # the division can be a pixel out near edges: settle on the pixel
+        # whose corners (computed as pix2lonlat does) bracket the point
+        pix += self.pix2lonlat(pix + 1) <= lonlat
+        pix -= self.pix2lonlat(pix) > lonlat
+        pix = np.clip(pix, -1, self.shape)
+        # We want the *closed* interval, which means moving
+        # points on the end back by 1
+        pix -= lonlat == self.pix2lonlat(self.shape[np.newaxis])
+        return pix
+
+
+_geometries = {}
+
+
+def grid_geometry(origin_x, origin_y, pixsize_x, pixsize_y, width, height):
+    """The GridGeometry of a grid, shared between all images on it"""
+    key = (float(origin_x), float(origin_y), float(pixsize_x),
+           float(pixsize_y), int(width), int(height))
+    if key not in _geometries:
+        _geometries[key] = GridGeometry(*key)
+    return _geometries[key]
+
+
 def bbox2affine(xmax, xmin, ymax, ymin, xres, yres):
 
     pixsize_x = (xmax - xmin) / xres
@@ -2,6 +2,7 @@
 
 import os
 import pickle
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
 from os.path import join, isdir, abspath
 import numpy as np
@@ -12,14 +13,18 @@ from revrand.btypes import Parameter, Positive
 from revrand.likelihoods import Gaussian
 from revrand.optimize import Adam
 from revrand.utils import atleast_list
-from scipy.integrate import fixed_quad
+from joblib import effective_n_jobs
+from scipy.special import roots_legendre
 from scipy.stats import norm
 from sklearn.ensemble import RandomForestRegressor as RFR
 from sklearn.linear_model import ARDRegression
 from sklearn.svm import SVR
 from sklearn.tree import DecisionTreeRegressor, ExtraTreeRegressor
+from sklearn.utils import check_array
 from uncoverml import mpiops
 from uncoverml.cubist import Cubist
+from uncoverml.featurematrix import FeatureMatrix
+from uncoverml.flatforest import FlatForest
 from uncoverml.cubist import MultiCubist
 from uncoverml.likelihoods import Switching
 from uncoverml.transforms import target as transforms
@@ -29,6 +34,7 @@ from uncoverml.transforms import target as transforms
 #
 
 QUADORDER = 5  # Order of quadrature used for transforming probabilistic vals
+QUADBATCH = 100000  # Pixels integrated at once, bounding the quadrature grid
 
 
 #
@@ -608,17 +614,28 @@ class RandomForestRegressor(RFR):
     """
     Implements a "probabilistic" output by looking at the variance of the
     decision tree estimator ouputs.
+
+    Each tree predicts once, on up to `n_jobs` threads, and the mean and
+    variance of the predictions are accumulated as they arrive.
     """
 
     def predict_proba(self, X, interval=0.95):
-        if hasattr(self, "_notransform_predict"):
-            Ey = self._notransform_predict(X)
-        else:
-            Ey = self.predict(X)
-
-        Vy = np.zeros_like(Ey)
-        for dt in self.estimators_:
-            Vy += (dt.predict(X) - Ey)**2
+        # the trees predict without checking, so validate once for all
+        X = check_array(X, dtype=np.float32)
+        workers = effective_n_jobs(self.n_jobs)
+        Ey, Vy = 0., 0.
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # a window of trees at a time, reduced in order, so results don't
+            # depend on which thread finishes first
+            for start in range(0, len(self.estimators_), workers):
+                trees = self.estimators_[start:start + workers]
+                for n, y in enumerate(executor.map(
+                        lambda dt: dt.predict(X, check_input=False), trees),
+                        start + 1):
+                    # Welford's update
+                    delta = y - Ey
+                    Ey = Ey + delta / n
+                    Vy = Vy + delta * (y - Ey)
 
         Vy /= len(self.estimators_)
 
@@ -637,6 +654,14 @@ def _join_dicts(dicts):
 
 
 class RandomForestRegressorMulti(TagsMixin):
+    """
+    Several random forests, trained in parallel across the nodes.
+
+    Each forest is pickled to the results directory as it is trained. Once
+    all are trained their trees are flattened into one `FlatForest`,
+    written there too, which prediction loads once and memory maps. Like
+    the forests' own, prediction uses `n_jobs` threads.
+    """
 
     def __init__(self,
                  outdir='.',
@@ -681,16 +706,16 @@ class RandomForestRegressorMulti(TagsMixin):
                 **self.kwargs
                 )
             rf.fit(x, y)
-            if self.parallel:  # used in training
-                pk_f = join(self.temp_dir,
-                            'rf_model_{}.pk'.format(t))
-            else:  # used when parallel is false, i.e., during x-val
-                pk_f = join(self.temp_dir,
-                            'rf_model_{}_{}.pk'.format(t, mpiops.chunk_index))
-            with open(pk_f, 'wb') as fp:
+            with open(self._forest_file(t), 'wb') as fp:
                 pickle.dump(rf, fp)
         if self.parallel:
             mpiops.comm.barrier()
+            if mpiops.chunk_index == 0:
+                self._compile().save(self._flat_dir())
+            mpiops.comm.barrier()
+        else:
+            self._compile().save(self._flat_dir())
+        self._forest = None
         # Mark that we are now trained
         self._trained = True
 
@@ -701,23 +726,8 @@ class RandomForestRegressorMulti(TagsMixin):
             print('Train first')
             return
 
-        y_pred = np.zeros((x.shape[0], self.forests * self.n_estimators))
-
-        for i in range(self.forests):
-            if self.parallel:  # used in training
-                pk_f = join(self.temp_dir,
-                            'rf_model_{}.pk'.format(i))
-            else:  # used when parallel is false, i.e., during x-val
-                pk_f = join(self.temp_dir,
-                            'rf_model_{}_{}.pk'.format(i, mpiops.chunk_index))
-            with open(pk_f, 'rb') as fp:
-                f = pickle.load(fp)
-                for m, dt in enumerate(f.estimators_):
-                    y_pred[:, i * self.n_estimators + m] = \
-                        f.ytform.itransform(dt.predict(x))
-
-        y_mean = np.mean(y_pred, axis=1)
-        y_var = np.var(y_pred, axis=1)
+        y_mean, y_var = self._flat_forest().predict_moments(
+            x, effective_n_jobs(self.kwargs.get('n_jobs')))
 
         # Determine quantiles
         ql, qu = norm.interval(interval, loc=y_mean, scale=np.sqrt(y_var))
@@ -727,6 +737,43 @@ class RandomForestRegressorMulti(TagsMixin):
     def predict(self, x):
         return self.predict_proba(x)[0]
 
+    def _forest_file(self, t):
+        if self.parallel:  # used in training
+            return join(self.temp_dir, 'rf_model_{}.pk'.format(t))
+        # used when parallel is false, i.e., during x-val
+        return join(self.temp_dir,
+                    'rf_model_{}_{}.pk'.format(t, mpiops.chunk_index))
+
+    def _flat_dir(self):
+        if self.parallel:
+            return join(self.temp_dir, 'rf_model_flat')
+        return join(self.temp_dir,
+                    'rf_model_flat_{}'.format(mpiops.chunk_index))
+
+    def _compile(self):
+        forests = []
+        for t in range(self.forests):
+            with open(self._forest_file(t), 'rb') as fp:
+                rf = pickle.load(fp)
+            forests.append(FlatForest.from_trees(rf.estimators_,
+                                                 rf.ytform.itransform))
+        return FlatForest.concatenate(forests)
+
+    def _flat_forest(self):
+        # loaded once per process, compiling the pickled forests of models
+        # trained before they were flattened
+        if getattr(self, '_forest', None) is None:
+            try:
+                self._forest = FlatForest.load(self._flat_dir())
+            except FileNotFoundError:
+                self._forest = self._compile()
+        return self._forest
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_forest'] = None
+        return state
+
 
 #
 # Target Transformer factory
@@ -792,38 +839,12 @@ def transform_targets(Learner):
                     return Ey, Vy, ql, qu
 
                 # All other transforms require quadrature
-                Ey = np.empty_like(Ey_t)
-                Vy = np.empty_like(Vy_t)
-
-                # Used fixed order quadrature to transform prob. estimates
-                for i, (Eyi, Vyi) in enumerate(zip(Ey_t, Vy_t)):
-
-                    # Establish bounds
-                    Syi = np.sqrt(Vyi)
-                    a, b = Eyi - 3 * Syi, Eyi + 3 * Syi  # approx 99% bounds
-
-                    # Quadrature
-                    Ey[i], _ = fixed_quad(self.__expec_int, a, b, n=QUADORDER,
-                                          args=(Eyi, Syi))
-                    Vy[i], _ = fixed_quad(self.__var_int, a, b, n=QUADORDER,
-                                          args=(Ey[i], Eyi, Syi))
-
+                Ey, Vy = _quadrature_moments(self.ytform.itransform, Ey_t,
+                                             Vy_t)
                 ql, qu = norm.interval(interval, loc=Ey, scale=np.sqrt(Vy))
 
                 return Ey, Vy, ql, qu
 
-        def __expec_int(self, x, mu, std):
-
-            px = _normpdf(x, mu, std)
-            Ex = self.ytform.itransform(x) * px
-            return Ex
-
-        def __var_int(self, x, Ex, mu, std):
-
-            px = _normpdf(x, mu, std)
-            Vx = (self.ytform.itransform(x) - Ex)**2 * px
-            return Vx
-
     return TransformedLearner
 
 
@@ -938,14 +959,24 @@ class CubistMultiTransformed(transform_targets(MultiCubist), TagsMixin):
 
 
 def apply_masked(func, data, args=(), kwargs={}):
-    # Data is just a matrix (i.e. X for prediction)
+    # Data is just a matrix (i.e. X for prediction), masked or a
+    # FeatureMatrix
+
+    if isinstance(data, FeatureMatrix):
+        complete = data.complete
+    else:
+        complete = np.ma.count_masked(data) == 0
 
     # No masked data
-    if np.ma.count_masked(data) == 0:
+    if complete:
         return np.ma.array(func(data.data, *args, **kwargs), mask=False)
 
     # Prediction with missing inputs
-    okdata = (data.mask.sum(axis=1)) == 0 if data.ndim == 2 else ~data.mask
+    if isinstance(data, FeatureMatrix):
+        okdata = data.valid_rows
+    else:
+        okdata = (data.mask.sum(axis=1)) == 0 if data.ndim == 2 \
+            else ~data.mask
 
     if data.data[okdata].shape[0] == 0:  # if all of this chunk is masked
         # to get dimension of the func return, we create a dummpy res
@@ -1044,3 +1075,51 @@ _SQRT2PI = np.sqrt(2 * np.pi)
 def _normpdf(x, mu, std):
 
     return 1. / (_SQRT2PI * std) * np.exp(-0.5 * ((x - mu) / std)**2)
+
+
+def _quadrature_moments(itransform, Ey_t, Vy_t, batch=QUADBATCH):
+    """
+    The mean and variance of targets normally distributed once transformed.
+
+    Integrates the inverse transform against the latent normal densities
+    with the fixed order Gauss-Legendre quadrature of
+    `scipy.integrate.fixed_quad`, over +/- 3 standard deviations, and gives
+    the same results as it. Rather than integrating each pixel in turn, the
+    inverse transform is called once on the quadrature nodes of a whole
+    batch of pixels.
+
+    Parameters
+    ----------
+    itransform : callable
+        the inverse target transform, taking a 1D array
+    Ey_t : ndarray
+        the (N,) latent means
+    Vy_t : ndarray
+        the (N,) latent variances
+    batch : int, optional
+        the number of pixels integrated at once
+
+    Returns
+    -------
+    Ey : ndarray
+        the (N,) means of the targets
+    Vy : ndarray
+        the (N,) variances of the targets
+    """
+    nodes, weights = roots_legendre(QUADORDER)
+    nodes = np.real(nodes)
+    Ey = np.empty_like(Ey_t)
+    Vy = np.empty_like(Vy_t)
+    for start in range(0, len(Ey_t), batch):
+        s = slice(start, start + batch)
+        mu = Ey_t[s, np.newaxis]
+        std = np.sqrt(Vy_t[s, np.newaxis])
+        a, b = mu - 3 * std, mu + 3 * std  # approx 99% bounds
+        x = (b - a) * (nodes + 1) / 2.0 + a
+        px = _normpdf(x, mu, std)
+        y = np.reshape(itransform(x.ravel()), x.shape)
+        half_width = (b - a)[:, 0] / 2.0
+        Ey[s] = half_width * np.sum(weights * (y * px), axis=-1)
+        Vy[s] = half_width * np.sum(
+            weights * ((y - Ey[s, np.newaxis])**2 * px), axis=-1)
+    return Ey, Vy
@@ -1,28 +1,117 @@
 import logging
+import os
 import pickle
+import sys
 
 import numpy as np
-from mpi4py import MPI
+
+from uncoverml.featurematrix import FeatureMatrix
+from uncoverml.backends import Op, MPIComm, SingleComm, LocalComm, \
+    ProfiledComm
 
 log = logging.getLogger(__name__)
 
-# We're having trouble with the MPI pickling and 64bit integers
-MPI.pickle.dumps = pickle.dumps
-MPI.pickle.loads = pickle.loads
+MPI = None
+"""module: mpi4py's MPI, once the MPI backend is in use
+"""
 
-comm = MPI.COMM_WORLD
-"""module-level MPI 'world' object representing all connected nodes
+comm = None
+"""module-level 'world' object representing all connected nodes, with
+the interface of an mpi4py communicator
 """
 
-chunks = comm.Get_size()
-"""int: the total number of nodes in the MPI world
+chunks = 1
+"""int: the total number of nodes in the world
 """
 
-chunk_index = comm.Get_rank()
-"""int: the index (from zero) of this node in the MPI world. Also known as
+chunk_index = 0
+"""int: the index (from zero) of this node in the world. Also known as
 the rank of the node.
 """
 
+# set by mpirun, mpiexec, srun and aprun in the processes they launch
+_mpi_launch_variables = ['PMI_RANK', 'PMIX_RANK', 'OMPI_COMM_WORLD_RANK',
+                         'MV2_COMM_WORLD_RANK', 'ALPS_APP_PE']
+
+
+def init(backend, processes=None):
+    """
+    Choose how the nodes communicate.
+
+    Parameters
+    ----------
+    backend : str
+        'mpi' for the nodes of an MPI run, 'single' for a run on one node,
+        or 'local' to fork this process into `processes` nodes on this
+        machine that need no MPI
+    processes : int, optional
+        the number of nodes of a 'local' run
+    """
+    global MPI, comm, chunks, chunk_index
+    if backend == 'mpi':
+        comm = MPIComm()
+        MPI = comm.MPI
+        # We're having trouble with the MPI pickling and 64bit integers
+        MPI.pickle.dumps = pickle.dumps
+        MPI.pickle.loads = pickle.loads
+    elif backend == 'single':
+        comm = SingleComm()
+    elif backend == 'local':
+        if chunks > 1:
+            raise ValueError("Can't fork local nodes in a run of {} "
+                             "nodes".format(chunks))
+        if processes > 1:
+            _finalize_mpi()
+        comm = LocalComm.start(processes) if processes > 1 else SingleComm()
+    else:
+        raise ValueError("Unknown backend {}, use mpi, single or "
+                         "local".format(backend))
+    chunks = comm.Get_size()
+    chunk_index = comm.Get_rank()
+
+
+def profile():
+    """Record the collectives of every node from now on, for
+    `log_profile`"""
+    global comm
+    if not isinstance(comm, ProfiledComm):
+        comm = ProfiledComm(comm)
+
+
+def log_profile():
+    """Log where the nodes have spent time communicating, if `profile` was
+    called. Every node must call this."""
+    if not isinstance(comm, ProfiledComm):
+        return
+    rows, elapsed = comm.report()
+    total = sum(r[4] for r in rows)
+    log.info("Communication: {:.2f}s of {:.2f}s per node ({:.1f}%)".format(
+        total, elapsed, 100 * total / max(elapsed, 1e-9)))
+    log.info("{:>6} {:>10} {:>9} {:>9} {:>9}  call".format(
+        'calls', 'MB', 'mean s', 'max s', 'skew s'))
+    for site, call, count, nbytes, mean_s, max_s, skew in rows:
+        log.info("{:>6} {:>10.2f} {:>9.3f} {:>9.3f} {:>9.3f}  {} at "
+                 "{}".format(count, nbytes / 1e6, mean_s, max_s, skew, call,
+                             site))
+
+
+def _default_backend():
+    """MPI if an MPI launcher started this process, otherwise a single node,
+    overridden by the UNCOVERML_BACKEND environment variable"""
+    if 'UNCOVERML_BACKEND' in os.environ:
+        return os.environ['UNCOVERML_BACKEND']
+    if any(v in os.environ for v in _mpi_launch_variables):
+        return 'mpi'
+    return 'single'
+
+
+def _finalize_mpi():
+    # a process that has initialised MPI can't safely fork, so shut MPI
+    # down if something imported mpi4py before local nodes were asked for
+    MPI = sys.modules.get('mpi4py.MPI')
+    if MPI is not None and MPI.Is_initialized() and not MPI.Is_finalized():
+        MPI.Finalize()
+
 
 def run_once(f, *args, **kwargs):
     """Run a function on one node, broadcast result to all
@@ -70,21 +159,172 @@ def unique(sets1, sets2, dtype):
     out_sets = [np.unique(np.concatenate(k, axis=0)) for k in per_dim]
     return out_sets
 
-unique_op = MPI.Op.Create(unique, commute=True)
-sum0_op = MPI.Op.Create(sum_axis_0, commute=True)
-max0_op = MPI.Op.Create(max_axis_0, commute=True)
-min0_op = MPI.Op.Create(min_axis_0, commute=True)
+unique_op = Op(unique)
+sum0_op = Op(sum_axis_0)
+max0_op = Op(max_axis_0)
+min0_op = Op(min_axis_0)
+
+SUM = Op(lambda x, y, dtype: x + y, 'SUM')
+MAX = Op(lambda x, y, dtype: np.maximum(x, y), 'MAX')
+MIN = Op(lambda x, y, dtype: np.minimum(x, y), 'MIN')
+LOR = Op(lambda x, y, dtype: np.logical_or(x, y), 'LOR')
+
+
+def _buffer(x):
+    """`x` as a contiguous array MPI can type, with bools sent as bytes"""
+    x = np.asarray(x, order='C')
+    if x.dtype.kind not in 'biufc':
+        raise TypeError("Can't send {} arrays as MPI buffers".format(x.dtype))
+    return x.view(np.uint8) if x.dtype.kind == 'b' else x
+
+
+def allreduce_array(x, op=SUM):
+    """Reduce a numeric array elementwise over all nodes
+
+    Unlike `comm.allreduce` the array is sent as a typed buffer rather than
+    pickled, so every node must pass the same shape and type.
+
+    Parameters
+    ----------
+    x : ndarray or scalar
+        this node's contribution
+    op : Op, optional
+        one of the elementwise reductions SUM, MAX, MIN or LOR, SUM by
+        default
+
+    Returns
+    -------
+    result : ndarray or scalar
+        the reduction, a scalar if `x` was one
+    """
+    x = np.asarray(x)
+    if x.dtype.kind == 'b':
+        x = x.astype(np.intp)
+    x = _buffer(x)
+    result = np.empty_like(x)
+    comm.Allreduce(x, result, op=op)
+    return result[()] if result.ndim == 0 else result
+
+
+def allreduce_masked(x):
+    """Sum a masked array elementwise over all nodes
+
+    The data (masked values counting as zero) and whether each value is
+    present anywhere are reduced as two typed buffers. A value of the result
+    is masked only if it is masked on every node, as with `sum0_op`.
+
+    Parameters
+    ----------
+    x : MaskedArray
+        this node's contribution, the same shape on every node
+
+    Returns
+    -------
+    result : MaskedArray
+        the elementwise sum
+    """
+    total = allreduce_array(np.ma.filled(x, 0))
+    present = allreduce_array(~np.ma.getmaskarray(x), op=LOR)
+    return np.ma.masked_array(data=total, mask=~present.astype(bool))
+
+
+def gather_array(x, root=None):
+    """Concatenate arrays from all nodes along their first axis
+
+    Numeric data is sent as a typed buffer with `Gatherv` (`Allgatherv` if
+    `root` is None) instead of being pickled; only the shapes and types are
+    pickled. A mask is sent separately, packed to one bit per value, and
+    only if some node has a masked value.
+
+    Parameters
+    ----------
+    x : ndarray or MaskedArray
+        this node's rows, which may number zero
+    root : int, optional
+        the node to gather to, all nodes if None
+
+    Returns
+    -------
+    result : ndarray or MaskedArray or None
+        the rows of every node in rank order, masked if any node's rows
+        were, or None on nodes other than `root`
+    """
+    x = np.ma.asarray(x)
+    specs = comm.allgather((x.shape, x.dtype.str, bool(np.ma.is_masked(x))))
+    dtype = np.result_type(*[np.dtype(s[1]) for s in specs])
+    if dtype.kind not in 'biufc':
+        # no buffer type for these, so fall back to pickling
+        parts = comm.allgather(x) if root is None \
+            else comm.gather(x, root=root)
+        return None if parts is None else np.ma.concatenate(parts, axis=0)
+
+    shape = next((s[0] for s in specs if s[0][0]), x.shape)
+    rows = np.array([s[0][0] for s in specs])
+    rowsize = int(np.prod(shape[1:], dtype=int))
+    data = _gatherv(np.ma.getdata(x).astype(dtype, copy=False),
+                    rows * rowsize, root)
+    if not any(s[2] for s in specs):
+        return data if data is None else data.reshape(rows.sum(), *shape[1:])
+    mask = np.ma.getmaskarray(x).reshape(len(x), rowsize)
+    packed = _gatherv(np.packbits(mask, axis=1), rows * (-(-rowsize // 8)),
+                      root)
+    if packed is None:
+        return None
+    mask = np.unpackbits(packed.reshape(rows.sum(), -1), axis=1,
+                         count=rowsize).astype(bool)
+    shape = (rows.sum(),) + shape[1:]
+    return np.ma.masked_array(data=data.reshape(shape),
+                              mask=mask.reshape(shape))
+
+
+def _gatherv(x, counts, root):
+    """Gather flattened typed buffers of `counts` values per node"""
+    is_bool = x.dtype.kind == 'b'
+    x = _buffer(x)
+    out = None
+    if root is None or chunk_index == root:
+        out = np.empty(counts.sum(), dtype=x.dtype)
+    if root is None:
+        comm.Allgatherv(x, [out, counts])
+    else:
+        comm.Gatherv(x, [out, counts] if out is not None else None,
+                     root=root)
+    if out is not None and is_bool:
+        out = out.view(bool)
+    return out
+
+
+def bcast_array(x, root=0):
+    """Broadcast a numeric array from one node to all nodes
+
+    The shape and type are pickled and the values sent as a typed buffer.
+
+    Parameters
+    ----------
+    x : ndarray
+        the array to send, ignored on nodes other than `root`
+    root : int, optional
+        the sending node
+
+    Returns
+    -------
+    result : ndarray
+        the array of `root`
+    """
+    if chunk_index == root:
+        x = np.asarray(x, order='C')
+        spec = comm.bcast((x.shape, x.dtype.str), root=root)
+    else:
+        spec = comm.bcast(None, root=root)
+        x = np.empty(spec[0], dtype=np.dtype(spec[1]))
+    comm.Bcast(_buffer(x), root=root)
+    return x
 
 
 def count(x):
-    x_n_local = np.ma.count(x, axis=0).ravel()
-    x_n = comm.allreduce(x_n_local, op=sum0_op)
-    still_masked = np.ma.count_masked(x_n)
-    if still_masked != 0:
-        log.info('Reported subcounts: ' + ', '.join([str(s) for s in x_n]))
-        raise ValueError("Can't compute count: subcounts are still masked")
-    if hasattr(x_n, 'mask'):
-        x_n = x_n.data
+    x_n_local = x.count() if isinstance(x, FeatureMatrix) \
+        else np.ma.count(x, axis=0).ravel()
+    x_n = allreduce_array(x_n_local)
     return x_n
 
 
@@ -92,35 +332,23 @@ def outer_count(x):
 
     xnotmask = (~x.mask).astype(float)
     x_n_outer_local = np.dot(xnotmask.T, xnotmask)
-    x_n_outer = comm.allreduce(x_n_outer_local)
+    x_n_outer = allreduce_array(x_n_outer_local)
 
     return x_n_outer
 
 
 def mean(x):
-    x_n = count(x)
-    x_sum_local = np.ma.sum(x, axis=0)
-    x_sum = comm.allreduce(x_sum_local, op=sum0_op)
-    still_masked = np.ma.count_masked(x_sum)
-    if still_masked != 0:
-        log.info('Reported x_sum: ' + ', '.join([str(s) for s in x_sum]))
-        raise ValueError("Can't compute mean: At least 1 column has nodata")
-    if hasattr(x_sum, 'mask'):
-        x_sum = x_sum.data
-    mean = x_sum / x_n
-    return mean
+    return Moments.of(x).allreduce().mean
 
 
 def sd(x):
-    x_mean = mean(x)
-    delta_mean = mean((x - x_mean)**2)
-    sd = np.sqrt(delta_mean)
-    return sd
+    return Moments.of(x).allreduce().sd
 
 
 def outer(x):
+    x = x.astype(np.float64, copy=False)
     x_outer_local = np.ma.dot(x.T, x)
-    out = comm.allreduce(x_outer_local)
+    out = allreduce_masked(x_outer_local)
     still_masked = np.ma.count_masked(out)
     if still_masked != 0:
         log.info('Reported out: ' + ', '.join([str(s) for s in out]))
@@ -132,9 +360,7 @@ def outer(x):
 
 
 def covariance(x):
-    x_mean = mean(x)
-    cov = outer(x - x_mean) / outer_count(x)
-    return cov
+    return Moments.of(x, covariance=True).allreduce().covariance
 
 
 def eigen_decomposition(x):
@@ -142,30 +368,232 @@ def eigen_decomposition(x):
     return eigvals, eigvecs
 
 
+class Moments:
+    """
+    Mergeable first and second moments of the columns of masked data.
+
+    Holds for every column the count, mean and sum of squared deviations
+    from the mean of its present values. With `covariance` it also holds,
+    for every pair of columns, the number of rows where both are present,
+    the sum over those rows of the products of the columns' deviations
+    (the co-moments), and the sum over those rows of each column's
+    deviations. Moments of disjoint sets of rows merge exactly with Chan's
+    pairwise update, generalised to missing values, so statistics take a
+    single pass over each chunk and a single collective.
+
+    Parameters
+    ----------
+    ndims : int
+        the number of columns
+    covariance : bool, optional
+        whether to keep the co-moments of pairs of columns
+    """
+    def __init__(self, ndims, covariance=False):
+        self.ndims = ndims
+        self.has_covariance = covariance
+        self.count = np.zeros(ndims)
+        self.centre = np.zeros(ndims)
+        self.m2 = np.zeros(ndims)
+        self.pair_count = np.zeros((ndims, ndims)) if covariance else None
+        self.comoment = np.zeros((ndims, ndims)) if covariance else None
+        self.deviation = np.zeros((ndims, ndims)) if covariance else None
+
+    @classmethod
+    def of(cls, x, covariance=False):
+        """The moments of one chunk of rows
+
+        Parameters
+        ----------
+        x : MaskedArray or FeatureMatrix
+            (N, D) values, missing where masked
+        covariance : bool, optional
+            whether to keep co-moments
+
+        Returns
+        -------
+        moments : Moments
+            the moments of the rows of x
+        """
+        result = cls(x.shape[1], covariance)
+        if isinstance(x, FeatureMatrix):
+            data, missing = x.data, None if x.complete else x.mask
+        else:
+            data, missing = np.ma.getdata(x), np.ma.getmask(x)
+            missing = None if missing is np.ma.nomask else missing
+        if missing is None:
+            result.count = np.full(x.shape[1], len(data), dtype=np.float64)
+            total = np.sum(data, axis=0, dtype=np.float64)
+        else:
+            result.count = len(data) - missing.sum(axis=0).astype(np.float64)
+            total = np.sum(np.where(missing, 0, data), axis=0,
+                           dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result.centre = np.where(result.count > 0,
+                                     total / result.count, 0.)
+        # floating point deviations keep the type of x, their sums are
+        # accumulated in double
+        centre = result.centre.astype(x.dtype) if x.dtype.kind == 'f' \
+            else result.centre
+        centred = data - centre
+        if missing is not None:
+            centred[missing] = 0
+        result.m2 = np.sum(centred**2, axis=0, dtype=np.float64)
+        if covariance:
+            centred = centred.astype(np.float64, copy=False)
+            weight = np.ones(data.shape) if missing is None \
+                else (~missing).astype(np.float64)
+            result.pair_count = np.dot(weight.T, weight)
+            result.comoment = np.dot(centred.T, centred)
+            result.deviation = np.dot(centred.T, weight)
+        return result
+
+    def update(self, x):
+        """Add the rows of the masked array or FeatureMatrix `x`, in
+        place"""
+        return self.merge(Moments.of(x, self.has_covariance))
+
+    def merge(self, other):
+        """Add the moments of other rows, in place
+
+        Parameters
+        ----------
+        other : Moments
+            moments of rows disjoint from these
+
+        Returns
+        -------
+        self : Moments
+            the moments of both sets of rows
+        """
+        count = self.count + other.count
+        with np.errstate(divide='ignore', invalid='ignore'):
+            share = np.where(count > 0, other.count / count, 0.)
+        centre = self.centre + (other.centre - self.centre) * share
+        # move the deviations of both sets of rows to the merged means
+        m2 = 0.
+        comoment = 0.
+        deviation = 0.
+        for m in (self, other):
+            shift = m.centre - centre
+            m2 = m2 + m.m2 + m.count * shift**2
+            if self.has_covariance:
+                comoment = comoment + m.comoment + \
+                    shift[:, np.newaxis] * m.deviation.T + \
+                    m.deviation * shift + \
+                    m.pair_count * np.outer(shift, shift)
+                deviation = deviation + m.deviation + \
+                    m.pair_count * shift[:, np.newaxis]
+        self.count = count
+        self.centre = centre
+        self.m2 = m2
+        if self.has_covariance:
+            self.pair_count = self.pair_count + other.pair_count
+            self.comoment = comoment
+            self.deviation = deviation
+        return self
+
+    def _pack(self):
+        parts = [self.count, self.centre, self.m2]
+        if self.has_covariance:
+            parts += [self.pair_count.ravel(), self.comoment.ravel(),
+                      self.deviation.ravel()]
+        return np.concatenate(parts)
+
+    def _unpack(self, packed):
+        d = self.ndims
+        self.count, self.centre, self.m2 = packed[:3 * d].reshape(3, d)
+        if self.has_covariance:
+            self.pair_count, self.comoment, self.deviation = \
+                packed[3 * d:].reshape(3, d, d)
+        return self
+
+    def allreduce(self):
+        """The moments of the rows of all nodes
+
+        The moments of every node are gathered in one collective and merged
+        in rank order, so every node gets the same result.
+
+        Returns
+        -------
+        moments : Moments
+            the moments of all rows
+        """
+        gathered = gather_array(self._pack()[np.newaxis])
+        result = Moments(self.ndims, self.has_covariance)
+        for packed in gathered:
+            result.merge(Moments(self.ndims,
+                                 self.has_covariance)._unpack(packed))
+        return result
+
+    @property
+    def mean(self):
+        self._check_count('mean')
+        return self.centre.copy()
+
+    @property
+    def sd(self):
+        self._check_count('sd')
+        return np.sqrt(self.m2 / self.count)
+
+    def _check_count(self, statistic):
+        if np.any(self.count == 0):
+            log.info('Reported counts: ' +
+                     ', '.join([str(s) for s in self.count]))
+            raise ValueError("Can't compute {}: At least 1 column has "
+                             "nodata".format(statistic))
+
+    @property
+    def covariance(self):
+        if not self.has_covariance:
+            raise ValueError("Co-moments were not accumulated")
+        if np.any(self.pair_count == 0):
+            raise ValueError("Can't compute outer product:"
+                             " completely missing columns!")
+        return self.comoment / self.pair_count
+
+
 def random_full_points(x, Napprox):
-    npernode = int(np.round(Napprox / chunks))
-    npernode = min(npernode, len(x))  # Make sure the dataset is upper bound
-
-    rinds = np.random.permutation(len(x))  # random choice of indices
-
-    # Get random points per node
-    x_p_node = []
-    count = 0
-    for i in rinds:
-        if np.ma.count_masked(x[i]) > 0:
-            continue
-        if count >= npernode:
-            break
-        x_p_node.append(x[i])
-        count += 1
-
-    # one chunk can have all of one or more covariates masked
-    x_p_node = np.vstack(x_p_node) if len(x_p_node) else None
-
-    all_x_p_node = comm.allgather(x_p_node)
-    # filter out the None chunks
-    filter_all_x_p_node = [x for x in all_x_p_node if x is not None]
-
-    # Gather all random points
-    x_p = np.vstack(filter_all_x_p_node)
+    """Sample rows without missing values uniformly from all nodes
+
+    Each node's share of the sample is drawn from the multivariate
+    hypergeometric distribution over the nodes' numbers of complete rows,
+    so the sample is uniform over the complete rows of every node and its
+    size is exact. Only the sampled rows are exchanged.
+
+    Parameters
+    ----------
+    x : MaskedArray or FeatureMatrix
+        (N, D) rows of this node
+    Napprox : int
+        the total number of rows to sample
+
+    Returns
+    -------
+    x_p : ndarray
+        (min(Napprox, M), D) sampled rows, the same on every node, where M
+        is the number of complete rows over all nodes
+    """
+    if isinstance(x, FeatureMatrix):
+        data, complete = x.data, x.valid_rows
+    else:
+        data, complete = np.ma.getdata(x), \
+            ~np.ma.getmaskarray(x).any(axis=1)
+    complete = np.flatnonzero(complete)
+    counts = gather_array(np.array([len(complete)]))
+    sizes = None
+    if chunk_index == 0:
+        # draw each node's share from the rows of it and the nodes after it
+        sizes = np.zeros(chunks, dtype=np.int64)
+        remaining = int(min(Napprox, counts.sum()))
+        for i in range(chunks):
+            rest = int(counts[i + 1:].sum())
+            sizes[i] = np.random.hypergeometric(counts[i], rest, remaining) \
+                if remaining and rest else remaining
+            remaining -= sizes[i]
+    sizes = bcast_array(sizes, root=0)
+    rows = np.random.choice(complete, sizes[chunk_index], replace=False)
+    x_p = gather_array(data[np.sort(rows)])
     return x_p
+
+
+init(_default_backend())
@@ -1,6 +1,5 @@
 import logging
 import numpy as np
-from scipy.integrate import fixed_quad
 from scipy.stats import norm, gamma
 from sklearn.ensemble import GradientBoostingRegressor
 from sklearn.gaussian_process import GaussianProcessRegressor
@@ -14,8 +13,8 @@ from sklearn.linear_model.stochastic_gradient import (SGDRegressor,
                                                       DEFAULT_EPSILON)
 from sklearn.svm import SVR
 from sklearn.metrics import r2_score
-from uncoverml.models import RandomForestRegressor, QUADORDER, \
-    _normpdf, TagsMixin, SGDApproxGP, PredictProbaMixin, \
+from uncoverml.models import RandomForestRegressor, \
+    _quadrature_moments, TagsMixin, SGDApproxGP, PredictProbaMixin, \
     MutualInfoMixin
 from revrand.slm import StandardLinearModel
 from revrand.basis_functions import LinearBasis
@@ -85,16 +84,6 @@ class TransformMixin():
 
 class TransformPredictProbaMixin(TransformMixin):
 
-    def __expec_int(self, x, mu, std):
-        px = _normpdf(x, mu, std)
-        Ex = self.target_transform.itransform(x) * px
-        return Ex
-
-    def __var_int(self, x, Ex, mu, std):
-        px = _normpdf(x, mu, std)
-        Vx = (self.target_transform.itransform(x) - Ex) ** 2 * px
-        return Vx
-
     def predict_proba(self, X, interval=0.95, *args, **kwargs):
 
         # Expectation and variance in latent space
@@ -112,21 +101,8 @@ class TransformPredictProbaMixin(TransformMixin):
             return Ey, Vy, ql, qu
 
         # All other transforms require quadrature
-        Ey = np.empty_like(Ey_t)
-        Vy = np.empty_like(Vy_t)
-
-        # Used fixed order quadrature to transform prob. estimates
-        for i, (Eyi, Vyi) in enumerate(zip(Ey_t, Vy_t)):
-            # Establish bounds
-            Syi = np.sqrt(Vyi)
-            a, b = Eyi - 3 * Syi, Eyi + 3 * Syi  # approx 99% bounds
-
-            # Quadrature
-            Ey[i], _ = fixed_quad(self.__expec_int, a, b, n=QUADORDER,
-                                  args=(Eyi, Syi))
-            Vy[i], _ = fixed_quad(self.__var_int, a, b, n=QUADORDER,
-                                  args=(Ey[i], Eyi, Syi))
-
+        Ey, Vy = _quadrature_moments(self.target_transform.itransform, Ey_t,
+                                     Vy_t)
         ql, qu = norm.interval(interval, loc=Ey, scale=np.sqrt(Vy))
 
         return Ey, Vy, ql, qu
@@ -5,6 +5,7 @@ import logging
 
 import numpy as np
 import skimage
+from scipy.ndimage import maximum_filter1d, minimum_filter1d
 
 
 log = logging.getLogger(__name__)
@@ -80,6 +81,136 @@ def point_patches(image, pwidth, points):
     return output
 
 
+PATCH_STATS = ('centre', 'mean', 'var', 'min', 'max', 'masked')
+"""tuple: the neighbourhood summaries `summaries` can compute"""
+
+
+def _window_sums(a, pwidth):
+    """
+    Sum of `a` (x, y, channels) over the square window of half-width
+    `pwidth` around every pixel, clipped to the image, from a summed-area
+    table.
+    """
+    nx, ny = a.shape[:2]
+    sat = np.zeros((nx + 1, ny + 1) + a.shape[2:])
+    np.cumsum(a, axis=0, out=sat[1:, 1:])
+    np.cumsum(sat[1:, 1:], axis=1, out=sat[1:, 1:])
+    x0 = np.clip(np.arange(nx) - pwidth, 0, nx)
+    x1 = np.clip(np.arange(nx) + pwidth + 1, 0, nx)
+    y0 = np.clip(np.arange(ny) - pwidth, 0, ny)
+    y1 = np.clip(np.arange(ny) + pwidth + 1, 0, ny)
+    return sat[x1][:, y1] - sat[x0][:, y1] - sat[x1][:, y0] + sat[x0][:, y0]
+
+
+def _window_extreme(a, pwidth, filter1d, fill):
+    # separable running filter: the extreme of a square is the extreme
+    # over its rows of the extremes over each row
+    side = 2 * pwidth + 1
+    a = filter1d(a, side, axis=0, mode='constant', cval=fill)
+    return filter1d(a, side, axis=1, mode='constant', cval=fill)
+
+
+def summaries(data, mask, pwidth, stats):
+    """
+    Summarise the square neighbourhood of every pixel of an image.
+
+    Sums come from summed-area tables and extremes from separable running
+    filters, so the cost is linear in the number of pixels whatever the
+    patch width. Windows are clipped to the image and ignore masked pixels.
+
+    Parameters
+    ----------
+        data: ndarray
+            an array of shape (x, y, channels).
+        mask: ndarray
+            a boolean array of the shape of `data`, True where missing.
+        pwidth: int
+            the half-width of the square neighbourhood, in pixels.
+        stats: list
+            names of the summaries to compute, from PATCH_STATS: the
+            centre pixel, mean, (population) variance, min and max of the
+            unmasked pixels, and the number of masked pixels.
+
+    Returns
+    -------
+        summary: ndarray
+            An array of shape (x, y, len(stats) * channels), each summary
+            in turn for every channel.
+        summary_mask: ndarray
+            boolean mask of `summary`, True where the neighbourhood has no
+            unmasked pixel (or, for the centre, the pixel is masked).
+    """
+    unknown = set(stats) - set(PATCH_STATS)
+    if unknown:
+        raise ValueError("Unknown patch statistics {}".format(sorted(unknown)))
+    mask = np.broadcast_to(mask, data.shape)
+    valid = ~mask
+    count = _window_sums(valid.astype(float), pwidth)
+    empty = count == 0
+    raw = data.astype(float)
+    values = raw.copy()
+    # shift each channel by its mean so the variance doesn't suffer from
+    # cancellation
+    shift = np.ma.masked_array(values, mask=mask).mean(axis=(0, 1))
+    shift = np.ma.filled(shift, 0.)
+    values -= shift
+    values[mask] = 0.
+    out, out_mask = [], []
+    for stat in stats:
+        if stat == 'centre':
+            out.append(raw)
+            out_mask.append(mask)
+            continue
+        if stat == 'masked':
+            area = _window_sums(np.ones(data.shape[:2] + (1,)), pwidth)
+            out.append(area - count)
+            out_mask.append(np.zeros(data.shape, dtype=bool))
+            continue
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if stat == 'mean':
+                r = _window_sums(values, pwidth) / count + shift
+            elif stat == 'var':
+                mean = _window_sums(values, pwidth) / count
+                r = np.maximum(_window_sums(values ** 2, pwidth) / count -
+                               mean ** 2, 0.)
+            elif stat == 'min':
+                r = _window_extreme(np.where(mask, np.inf, raw), pwidth,
+                                    minimum_filter1d, np.inf)
+            else:
+                r = _window_extreme(np.where(mask, -np.inf, raw), pwidth,
+                                    maximum_filter1d, -np.inf)
+        r[empty] = 0.
+        out.append(r)
+        out_mask.append(empty)
+    return np.concatenate(out, axis=2), np.concatenate(out_mask, axis=2)
+
+
+def grid_summaries(data, mask, pwidth, stats):
+    """
+    Neighbourhood summaries of the pixels a (x, y, channels) image would
+    have `grid_patches` of, shaped (N, 1, 1, len(stats) * channels) so
+    they stand in for the patches.
+    """
+    s, m = summaries(data, mask, pwidth, stats)
+    nx, ny = data.shape[:2]
+    s = s[pwidth:nx - pwidth, pwidth:ny - pwidth]
+    m = m[pwidth:nx - pwidth, pwidth:ny - pwidth]
+    shp = (-1, 1, 1, s.shape[2])
+    return np.ma.masked_array(data=s.reshape(shp), mask=m.reshape(shp))
+
+
+def point_summaries(data, mask, pwidth, points, stats):
+    """
+    Neighbourhood summaries at (N, 2) points of a (x, y, channels) image,
+    shaped (N, 1, 1, len(stats) * channels).
+    """
+    s, m = summaries(data, mask, pwidth, stats)
+    x, y = points[:, 0], points[:, 1]
+    shp = (-1, 1, 1, s.shape[2])
+    return np.ma.masked_array(data=s[x, y].reshape(shp),
+                              mask=m[x, y].reshape(shp))
+
+
 def _image_to_data(image):
     """
     breaks up an image object into arrays suitable for sending to the
@@ -92,8 +223,10 @@ def _image_to_data(image):
     return data, mask, data_dtype
 
 
-def all_patches(image, patchsize):
+def all_patches(image, patchsize, stats=None):
     data, mask, data_dtype = _image_to_data(image)
+    if stats and patchsize > 0:
+        return grid_summaries(data, mask, patchsize, stats)
     patches = grid_patches(data, patchsize)
     patch_mask = grid_patches(mask, patchsize)
     result = np.ma.masked_array(data=patches, mask=patch_mask)
@@ -1,4 +1,5 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import csv
@@ -6,6 +7,7 @@ import csv
 from uncoverml import features
 from uncoverml import mpiops
 from uncoverml import geoio
+from uncoverml.featurematrix import FeatureMatrix
 from uncoverml.models import apply_masked
 from uncoverml import transforms
 
@@ -50,39 +52,99 @@ def _mask(subchunk, config):
 
 def mask_subchunks(subchunk, config):
     image_source = geoio.RasterioImageSource(config.mask)
+    # only the centre pixel of the mask matters
     result = features.extract_subchunks(image_source, subchunk,
-                                        config.n_subchunks, config.patchsize)
+                                        config.n_subchunks, config.patchsize,
+                                        config.block_rows, config.block_phase,
+                                        ['centre'])
     return result
 
 
-def _get_data(subchunk, config):
+class MaskPlan:
+    """
+    Which pixels of each of this node's subchunks are to be predicted.
+
+    The mask is read once per subchunk up front, and only the number of
+    retained pixels of each subchunk is shared between nodes, in a single
+    collective. Subchunks with nothing to predict on any node are skipped
+    entirely, and a node whose part of a subchunk is entirely masked takes
+    part in the collectives without reading its covariates.
+
+    Parameters
+    ----------
+    config : Config
+        the pipeline configuration, with a mask
+    subchunks : iterable, optional
+        the subchunks to plan, all of them by default
+    """
+    def __init__(self, config, subchunks=None):
+        if subchunks is None:
+            subchunks = range(config.n_subchunks)
+        self.subchunks = list(subchunks)
+        self.retained = {}
+        for i in self.subchunks:
+            mask_x = _mask(i, config)
+            self.retained[i] = ~np.ma.getmaskarray(mask_x)[:, 0]
+        # the last element carries the number of pixels read for the log
+        counts = np.array([np.count_nonzero(self.retained[i])
+                           for i in self.subchunks] +
+                          [sum(len(r) for r in self.retained.values())],
+                          dtype=np.int64)
+        totals = mpiops.allreduce_array(counts)
+        npixels = totals[-1]
+        counts, totals = counts[:-1], totals[:-1]
+        self.counts = dict(zip(self.subchunks, counts))
+        self.totals = dict(zip(self.subchunks, totals))
+        log.info("Predicting {} of {} pixels, {} of {} partitions are "
+                 "entirely masked".format(
+                     int(np.sum(totals)), int(npixels),
+                     int(np.sum(totals == 0)), len(self.subchunks)))
+
+    def empty(self, subchunk):
+        """No node has a pixel to predict in this subchunk."""
+        return self.totals[subchunk] == 0
+
+    def masked(self, subchunk):
+        """This node has no pixel to predict in this subchunk."""
+        return self.counts[subchunk] == 0
+
+
+def _get_data(subchunk, config, reads=None, plan=None):
     features_names = geoio.feature_names(config)
 
     if config.mask:
-        mask_x = _mask(subchunk, config)
-        all_mask_x = np.ma.vstack(mpiops.comm.allgather(mask_x))
-        if all_mask_x.shape[0] == np.sum(all_mask_x.mask):
-            x = np.ma.zeros((mask_x.shape[0], len(features_names)),
-                            dtype=np.bool)
-            x.mask = True
+        if plan is None:
+            plan = MaskPlan(config, [subchunk])
+        if plan.empty(subchunk):
+            npixels = len(plan.retained[subchunk])
+            shape = (npixels, len(features_names))
+            x = FeatureMatrix(np.zeros(shape, dtype=bool),
+                              np.ones(shape, dtype=bool))
             log.info('Partition {} covariates are not loaded as '
                      'the partition is entirely masked.'.format(subchunk + 1))
+            for r in reads or ():
+                r.cancel()
             return x, features_names
 
-    extracted_chunk_sets = geoio.image_subchunks(subchunk, config)
+    masked = plan is not None and plan.masked(subchunk)
+    extracted_chunk_sets = geoio.image_subchunks(subchunk, config, reads,
+                                                 masked)
     transform_sets = [k.transform_set for k in config.feature_sets]
     log.info("Applying feature transforms")
     x = features.transform_features(extracted_chunk_sets, transform_sets,
                                     config.final_transform, config)[0]
-    return _mask_rows(x, subchunk, config), features_names
+    return _mask_rows(x, subchunk, config, plan), features_names
 
 
-def _get_lon_lat(subchunk, config):
+def _get_lon_lat(subchunk, config, plan=None):
     def _impute_lat_lon(cov_file, subchunk, config):
         cov = geoio.RasterioImageSource(cov_file)
         cov_data = features.extract_subchunks(cov, subchunk,
                                               config.n_subchunks,
-                                              config.patchsize)
+                                              config.patchsize,
+                                              config.block_rows,
+                                              config.block_phase,
+                                              ['centre'])
         nn_imputer = transforms.NearestNeighboursImputer()
         cov_data = nn_imputer(cov_data.reshape(cov_data.shape[0], 1))
         return cov_data
@@ -90,40 +152,90 @@ def _get_lon_lat(subchunk, config):
         lat_data = _impute_lat_lon(config.lat, subchunk, config)
         lon_data = _impute_lat_lon(config.lon, subchunk, config)
         lon_lat = np.ma.hstack((lon_data, lat_data))
-        return _mask_rows(lon_lat, subchunk, config)
+        return _mask_rows(lon_lat, subchunk, config, plan)
 
 
-def _mask_rows(x, subchunk, config):
+def _mask_rows(x, subchunk, config, plan=None):
     mask = config.mask
     if mask:
-        mask_source = geoio.RasterioImageSource(mask)
-        mask_data = features.extract_subchunks(mask_source, subchunk,
-                                               config.n_subchunks,
-                                               config.patchsize)
-        mask_data = mask_data.reshape(mask_data.shape[0], 1)
-        mask_x = mask_data.data[:, 0] != config.retain
+        if plan is None:
+            plan = MaskPlan(config, [subchunk])
+        mask_x = ~plan.retained[subchunk]
         log.info('Areas with mask={} will be predicted'.format(config.retain))
 
         assert x.shape[0] == mask_x.shape[0], 'shape mismatch of ' \
                                               'mask and inputs'
+        if isinstance(x, FeatureMatrix):
+            return FeatureMatrix(x.data, mask_x[:, np.newaxis])
         x.mask = np.tile(mask_x, (x.shape[1], 1)).T
     return x
 
 
-def render_partition(model, subchunk, image_out, config):
+def render_partition(model, subchunk, image_out, config, reads=None,
+                     plan=None):
 
-    x, feature_names = _get_data(subchunk, config)
+    if config.mask and plan is None:
+        plan = MaskPlan(config, [subchunk])
+    x, feature_names = _get_data(subchunk, config, reads, plan)
     total_gb = mpiops.comm.allreduce(x.nbytes / 1e9)
     log.info("Loaded {:2.4f}GB of image data".format(total_gb))
     alg = config.algorithm
     log.info("Predicting targets for {}.".format(alg))
     y_star = predict(x, model, interval=config.quantiles,
-                     lon_lat=_get_lon_lat(subchunk, config))
+                     lon_lat=_get_lon_lat(subchunk, config, plan))
     if config.cluster and config.cluster_analysis:
-        cluster_analysis(x, y_star, subchunk, config, feature_names)
+        cluster_analysis(x.to_masked(), y_star, subchunk, config,
+                         feature_names)
     image_out.write(y_star, subchunk)
 
 
+def render_partitions(model, image_out, config, prefetch=True):
+    """
+    Predict and write every subchunk of this node's chunk.
+
+    With `prefetch`, the covariates of the next subchunk are read in the
+    background while the current one is transformed, predicted and
+    written, so reading overlaps computation. At most two subchunks of
+    covariates are held in memory at once. With a mask, the mask is
+    planned first (see `MaskPlan`) so masked subchunks are not read.
+
+    Parameters
+    ----------
+    model : object
+        the trained model
+    image_out : ImageWriter
+        the writer for the prediction image
+    config : Config
+        the pipeline configuration
+    prefetch : bool, optional
+        read the next subchunk while predicting the current one
+    """
+    plan = MaskPlan(config) if config.mask else None
+    if not prefetch:
+        for i in range(config.n_subchunks):
+            log.info("starting to render partition {}".format(i + 1))
+            render_partition(model, i, image_out, config, plan=plan)
+        return
+
+    def submit(i):
+        if plan is None:
+            return geoio.submit_subchunk_reads(i, config, executor)
+        if plan.empty(i):
+            return None
+        return geoio.submit_subchunk_reads(i, config, executor,
+                                           plan.masked(i))
+
+    workers = max(1, geoio.io_threads)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        reads = submit(0)
+        for i in range(config.n_subchunks):
+            log.info("starting to render partition {}".format(i + 1))
+            current = reads
+            if i + 1 < config.n_subchunks:
+                reads = submit(i + 1)
+            render_partition(model, i, image_out, config, current, plan)
+
+
 def cluster_analysis(x, y, partition_no, config, feature_names):
     """
     Parameters
@@ -170,22 +282,17 @@ def div0(a, b):
 def write_mean_and_sd(x, y, writer, config):
     for c in range(config.n_classes):
         c_index = (y == c)[:, 0]
-        c_count = np.ma.sum(c_index)
-        if c_count:
-            x_class = x[c_index, :]
-            x_sum = np.ma.sum(x_class, axis=0)
-            x_count = np.ma.count(x_class, axis=0).ravel()
-        else:
-            x_sum = np.zeros((2, x.shape[1]))  # just a hack
-            x_count = np.zeros((2, x.shape[1]), dtype=np.int32)
-        class_sum = mpiops.comm.allreduce(x_sum, op=mpiops.sum0_op)
-        class_count = mpiops.comm.allreduce(x_count, op=mpiops.sum0_op)
+        x_class = x[c_index, :]
+        # classes absent from a node contribute zeros
+        x_sum = np.ma.sum(x_class, axis=0, dtype=np.float64)
+        x_count = np.ma.count(x_class, axis=0).ravel().astype(np.int64)
+        class_sum = mpiops.allreduce_array(np.ma.filled(x_sum, 0))
+        class_count = mpiops.allreduce_array(x_count)
         class_mean = div0(class_sum, class_count)
 
-        if not c_count:
-            x_class = class_mean
-        delta_c = ((x_class - class_mean) ** 2)
-        delta_c_sum = mpiops.comm.allreduce(delta_c, op=mpiops.sum0_op)
+        delta_c = np.ma.sum((x_class - class_mean) ** 2, axis=0,
+                            dtype=np.float64)
+        delta_c_sum = mpiops.allreduce_array(np.ma.filled(delta_c, 0))
         sd = np.sqrt(delta_c_sum/class_count)
 
         if mpiops.chunk_index == 0:
@@ -101,6 +101,7 @@ def setup_pipeline(config):
 def cli(pipeline_file, partitions, njobs, verbosity):
     uncoverml.mllog.configure(verbosity)
     config = ls.config.Config(pipeline_file)
+    ls.transforms.transformset.set_precision(config.precision)
     config.n_jobs = njobs
     estimator = setup_pipeline(config)
     log.info('Running optimisation for {}'.format(
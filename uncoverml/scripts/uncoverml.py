@@ -21,6 +21,7 @@ import uncoverml.learn
 import uncoverml.mllog
 import uncoverml.mpiops
 import uncoverml.predict
+import uncoverml.transforms
 import uncoverml.validate
 from uncoverml.transforms import StandardiseTransform
 from uncoverml.resampling import resample_shapefile
@@ -35,8 +36,24 @@ warnings.showwarning = warn_with_traceback
 @click.option('-v', '--verbosity',
               type=click.Choice(['DEBUG', 'INFO', 'WARNING', 'ERROR']),
               default='INFO', help='Level of logging')
-def cli(verbosity):
+@click.option('--max-open-files', type=int, default=64,
+              help='maximum number of covariate files each node keeps open')
+@click.option('--io-threads', type=int, default=1,
+              help='number of covariate files each node reads concurrently')
+@click.option('-j', '--processes', type=int, default=1,
+              help='run as this many nodes forked on this machine, '
+                   'without MPI')
+@click.option('--profile-comms', is_flag=True,
+              help='log the time each call site spends communicating '
+                   'between nodes at the end of the command')
+def cli(verbosity, max_open_files, io_threads, processes, profile_comms):
+    if processes > 1:
+        ls.mpiops.init('local', processes)
+    if profile_comms:
+        ls.mpiops.profile()
     ls.mllog.configure(verbosity)
+    ls.geoio.dataset_pool.resize(max_open_files)
+    ls.geoio.io_threads = io_threads
 
 
 def run_crossval(x_all, targets_all, config):
@@ -51,6 +68,7 @@ def run_crossval(x_all, targets_all, config):
               help='divide each node\'s data into this many partitions')
 def learn(pipeline_file, partitions):
     config = ls.config.Config(pipeline_file)
+    ls.transforms.transformset.set_precision(config.precision)
 
     targets_all, x_all = load_data(config, partitions)
 
@@ -60,6 +78,8 @@ def learn(pipeline_file, partitions):
     log.info("Learning full {} model".format(config.algorithm))
     model = ls.learn.local_learn_model(x_all, targets_all, config)
     ls.mpiops.run_once(ls.geoio.export_model, model, config)
+    ls.geoio.log_dataset_pool_stats()
+    ls.mpiops.log_profile()
     log.info("Finished! Total mem = {:.1f} GB".format(_total_gb()))
 
 
@@ -80,10 +100,12 @@ def load_data(config, partitions):
         else:
             log.info("Using memory aggressively: "
                      "dividing all data between nodes")
+        config.block_rows, config.block_phase = \
+            ls.geoio.block_alignment(config)
 
-        config.target_file = ls.mpiops.run_once(resample_shapefile, config)
+        target_file = ls.mpiops.run_once(resample_shapefile, config)
         # Make the targets
-        targets = ls.geoio.load_targets(shapefile=config.target_file,
+        targets = ls.geoio.load_targets(shapefile=target_file,
                                         targetfield=config.target_property)
         # Get the image chunks and their associated transforms
         image_chunk_sets = ls.geoio.image_feature_sets(targets, config)
@@ -127,8 +149,14 @@ def load_data(config, partitions):
 @click.argument('pipeline_file')
 @click.option('-s', '--subsample_fraction', type=float, default=1.0,
               help='only use this fraction of the data for learning classes')
-def cluster(pipeline_file, subsample_fraction):
+@click.option('-p', '--partitions', type=int, default=1,
+              help='divide each node\'s image into this many partitions, '
+                   'fitting the transforms to all of them a partition at a '
+                   'time')
+def cluster(pipeline_file, subsample_fraction, partitions):
     config = ls.config.Config(pipeline_file)
+    ls.transforms.transformset.set_precision(config.precision)
+    config.n_subchunks = partitions
 
     for f in config.feature_sets:
         if not f.transform_set.global_transforms:
@@ -145,10 +173,13 @@ def cluster(pipeline_file, subsample_fraction):
     else:
         log.info("Using memory aggressively: dividing all data between nodes")
 
+    config.block_rows, config.block_phase = ls.geoio.block_alignment(config)
     if config.semi_supervised:
         semisupervised(config)
     else:
         unsupervised(config)
+    ls.geoio.log_dataset_pool_stats()
+    ls.mpiops.log_profile()
     log.info("Finished! Total mem = {:.1f} GB".format(_total_gb()))
 
 
@@ -183,14 +214,20 @@ def unsupervised(config):
     # make sure we're clear that we're clustering
     config.algorithm = config.clustering_algorithm
     config.cubist = False
-    # Get the image chunks and their associated transforms
-    image_chunk_sets = ls.geoio.unsupervised_feature_sets(config)
     transform_sets = [k.transform_set for k in config.feature_sets]
-
-    features, _ = ls.features.transform_features(image_chunk_sets,
-                                                 transform_sets,
-                                                 config.final_transform,
-                                                 config)
+    if config.n_subchunks > 1:
+        log.info("Memory constraint: streaming {} partitions of the "
+                 "image".format(config.n_subchunks))
+        features = ls.features.stream_features(
+            lambda i: ls.geoio.image_subchunks(i, config), transform_sets,
+            config.final_transform, config, config.subsample_fraction)
+    else:
+        # Get the image chunks and their associated transforms
+        image_chunk_sets = ls.geoio.unsupervised_feature_sets(config)
+        features, _ = ls.features.transform_features(image_chunk_sets,
+                                                     transform_sets,
+                                                     config.final_transform,
+                                                     config)
 
     features, _ = ls.features.remove_missing(features)
     model = ls.cluster.KMeans(config.n_classes, config.oversample_factor)
@@ -207,13 +244,22 @@ def unsupervised(config):
               help='mask file used to limit prediction area')
 @click.option('-r', '--retain', type=int, default=None,
               help='mask values where to predict')
-def predict(model_or_cluster_file, partitions, mask, retain):
+@click.option('--prefetch/--no-prefetch', default=True,
+              help='read the next partition while predicting the current '
+                   'one')
+@click.option('--parallel-write', is_flag=True,
+              help='have every node write its own tiles of the output, '
+                   'mosaicked by a VRT per band')
+def predict(model_or_cluster_file, partitions, mask, retain, prefetch,
+            parallel_write):
 
     with open(model_or_cluster_file, 'rb') as f:
         state_dict = pickle.load(f)
 
     model = state_dict["model"]
     config = state_dict["config"]
+    ls.transforms.transformset.set_precision(
+        getattr(config, 'precision', 'float64'))
     config.cluster = True if splitext(model_or_cluster_file)[1] == '.cluster' \
         else False
     config.mask = mask if mask else config.mask
@@ -231,6 +277,7 @@ def predict(model_or_cluster_file, partitions, mask, retain):
                  "through data".format(config.n_subchunks))
     else:
         log.info("Using memory aggressively: dividing all data between nodes")
+    config.block_rows, config.block_phase = ls.geoio.block_alignment(config)
 
     image_shape, image_bbox, image_crs = ls.geoio.get_image_spec(model, config)
 
@@ -244,11 +291,20 @@ def predict(model_or_cluster_file, partitions, mask, retain):
                                      config.n_subchunks, config.output_dir,
                                      band_tags=predict_tags[
                                          0: min(len(predict_tags),
-                                                config.outbands)])
-
-    for i in range(config.n_subchunks):
-        log.info("starting to render partition {}".format(i+1))
-        ls.predict.render_partition(model, i, image_out, config)
+                                                config.outbands)],
+                                     block_rows=config.block_rows,
+                                     block_phase=config.block_phase,
+                                     parallel=parallel_write,
+                                     multiband=getattr(config, 'multiband',
+                                                       False),
+                                     compress=getattr(config, 'compress',
+                                                      None),
+                                     overviews=getattr(config, 'overviews',
+                                                       False),
+                                     patchsize=config.patchsize)
+
+    ls.predict.render_partitions(model, image_out, config, prefetch)
+    image_out.close()
 
     if config.cluster and config.cluster_analysis:
         if ls.mpiops.chunk_index == 0:
@@ -257,6 +313,8 @@ def predict(model_or_cluster_file, partitions, mask, retain):
 
     if config.thumbnails:
         image_out.output_thumbnails(config.thumbnails)
+    ls.geoio.log_dataset_pool_stats()
+    ls.mpiops.log_profile()
     log.info("Finished! Total mem = {:.1f} GB".format(_total_gb()))
 
 
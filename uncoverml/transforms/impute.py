@@ -5,12 +5,21 @@ from scipy.linalg import pinv, solve
 from scipy.spatial import cKDTree
 
 from uncoverml import mpiops
+from uncoverml.featurematrix import FeatureMatrix
+from uncoverml.transforms.transformset import accumulate_moments
 
 log = logging.getLogger(__name__)
 
 
 def impute_with_mean(x, mean):
 
+    if isinstance(x, FeatureMatrix):
+        if x.complete:
+            return x
+        rows = ~x.valid_rows
+        x.data[rows] = np.where(x.rows_mask(rows), mean, x.data[rows])
+        return FeatureMatrix(x.data)
+
     # No missing data
     if np.ma.count_masked(x) == 0:
         return x
@@ -32,9 +41,19 @@ class MeanImputer:
     def __init__(self):
         self.mean = None
 
+    @property
+    def fitted(self):
+        return self.mean is not None
+
+    def accumulate(self, x, moments=None):
+        return accumulate_moments(x, moments)
+
+    def fit(self, moments):
+        self.mean = moments.allreduce().mean
+
     def __call__(self, x):
-        if self.mean is None:
-            self.mean = mpiops.mean(x)
+        if not self.fitted:
+            self.fit(self.accumulate(x))
         x = impute_with_mean(x, self.mean)
         return x
 
@@ -60,35 +79,51 @@ class GaussImputer:
         self.mean = None
         self.prec = None
 
-    def __call__(self, x):
-
-        if self.mean is None or self.prec is None:
-            self._make_impute_stats(x)
+    @property
+    def fitted(self):
+        return self.mean is not None and self.prec is not None
 
-        for i in range(len(x)):
-            x.data[i] = self._gaus_condition(x[i])
-
-        return np.ma.MaskedArray(data=x.data, mask=False)
-
-    def _make_impute_stats(self, x):
+    def accumulate(self, x, moments=None):
+        return accumulate_moments(x, moments, covariance=True)
 
-        self.mean = mpiops.mean(x)
-        cov = mpiops.covariance(x)
+    def fit(self, moments):
+        moments = moments.allreduce()
+        self.mean = moments.mean
+        cov = moments.covariance
         self.prec, rank = pinv(cov, return_rank=True)  # stable pseudo inverse
 
         # if rank < len(self.mean):
         #     raise RuntimeError("This imputation method does not work on low "
         #                        "rank problems!")
 
+    def __call__(self, x):
+
+        if not self.fitted:
+            self.fit(self.accumulate(x))
+
+        if isinstance(x, FeatureMatrix):
+            rows = np.flatnonzero(~x.valid_rows)
+            for i, a in zip(rows, x.rows_mask(rows)):
+                x.data[i] = self._condition(x.data[i], a)
+            return FeatureMatrix(x.data)
+
+        for i in range(len(x)):
+            x.data[i] = self._gaus_condition(x[i])
+
+        return np.ma.MaskedArray(data=x.data, mask=False)
+
     def _gaus_condition(self, xi):
 
         if np.ma.count_masked(xi) == 0:
             return xi
 
-        a = xi.mask
-        b = ~xi.mask
+        return self._condition(xi.data, xi.mask)
+
+    def _condition(self, xi, a):
+        # fill the values of xi missing where a is True
+        b = ~a
 
-        xb = xi[b].data
+        xb = xi[b]
         Laa = self.prec[np.ix_(a, a)]
         Lab = self.prec[np.ix_(a, b)]
 
@@ -119,8 +154,25 @@ class NearestNeighboursImputer:
         self.nodes = nodes
         self.kdtree = None
 
+    @property
+    def fitted(self):
+        return self.kdtree is not None
+
+    def accumulate(self, x, stats=None):
+        raise ValueError("The nearest neighbour imputer can't be fitted "
+                         "out of core")
+
     def __call__(self, x):
 
+        if isinstance(x, FeatureMatrix):
+            if self.kdtree is None:
+                self._make_kdtree(x)
+            rows = ~x.valid_rows
+            if np.any(rows):
+                nn = self._av_neigbours(x.data[rows])
+                x.data[rows] = np.where(x.rows_mask(rows), nn, x.data[rows])
+            return FeatureMatrix(x.data)
+
         # impute with neighbours
         missing_ind = np.ma.count_masked(x, axis=1) > 0
 
@@ -135,7 +187,7 @@ class NearestNeighboursImputer:
 
     def _make_kdtree(self, x):
         self.kdtree = cKDTree(mpiops.random_full_points(x, Napprox=self.nodes))
-        if not np.isfinite(self.kdtree.query(x, k=self.k)[0]).all():
+        if not np.isfinite(self.kdtree.query(x.data, k=self.k)[0]).all():
             log.warning('Kdtree computation encountered problem. '
                         'Not enough neighbors available to compute '
                         'kdtree. Printing kdtree for debugging purpose')
@@ -1,17 +1,28 @@
-
 import numpy as np
 
-from uncoverml import mpiops
+from uncoverml.featurematrix import FeatureMatrix
+from uncoverml.transforms import transformset
 
 
 class CentreTransform:
     def __init__(self):
         self.mean = None
 
+    @property
+    def fitted(self):
+        return self.mean is not None
+
+    def accumulate(self, x, moments=None):
+        x = x.astype(transformset.float_type)
+        return transformset.accumulate_moments(x, moments)
+
+    def fit(self, moments):
+        self.mean = moments.allreduce().mean
+
     def __call__(self, x):
-        x = x.astype(float)
-        if self.mean is None:
-            self.mean = mpiops.mean(x)
+        x = x.astype(transformset.float_type)
+        if not self.fitted:
+            self.fit(self.accumulate(x))
         x -= self.mean
         return x
 
@@ -21,11 +32,23 @@ class StandardiseTransform:
         self.mean = None
         self.sd = None
 
+    @property
+    def fitted(self):
+        return self.sd is not None and self.mean is not None
+
+    def accumulate(self, x, moments=None):
+        x = x.astype(transformset.float_type)
+        return transformset.accumulate_moments(x, moments)
+
+    def fit(self, moments):
+        moments = moments.allreduce()
+        self.mean = moments.mean
+        self.sd = moments.sd
+
     def __call__(self, x):
-        x = x.astype(float)
-        if self.sd is None or self.mean is None:
-            self.mean = mpiops.mean(x)
-            self.sd = mpiops.sd(x)
+        x = x.astype(transformset.float_type)
+        if not self.fitted:
+            self.fit(self.accumulate(x))
 
         # Centre
         x -= self.mean
@@ -48,17 +71,37 @@ class WhitenTransform:
         self.eigvecs = None
         self.keep_fraction = keep_fraction
 
+    @property
+    def fitted(self):
+        return self.mean is not None and self.eigvals is not None and \
+            self.eigvecs is not None
+
+    def accumulate(self, x, moments=None):
+        x = x.astype(transformset.float_type)
+        return transformset.accumulate_moments(x, moments, covariance=True)
+
+    def fit(self, moments):
+        moments = moments.allreduce()
+        self.mean = moments.mean
+        self.eigvals, self.eigvecs = np.linalg.eigh(moments.covariance)
+
     def __call__(self, x):
-        x = x.astype(float)
-        if self.mean is None or self.eigvals is None or self.eigvecs is None:
-            self.mean = mpiops.mean(x)
-            self.eigvals, self.eigvecs = mpiops.eigen_decomposition(x)
+        x = x.astype(transformset.float_type)
+        if not self.fitted:
+            self.fit(self.accumulate(x))
 
         ndims = x.shape[1]
         # make sure 1 <= keepdims <= ndims
         keepdims = min(max(1, int(ndims * self.keep_fraction)), ndims)
         mat = self.eigvecs[:, -keepdims:]
         vec = self.eigvals[np.newaxis, -keepdims:]
-        x = np.ma.dot(x - self.mean, mat, strict=True) / np.sqrt(vec)
+        if isinstance(x, FeatureMatrix):
+            # a row missing any value is missing all of them once rotated
+            y = np.dot(x.data - self.mean.astype(x.dtype),
+                       mat.astype(x.dtype)) / np.sqrt(vec).astype(x.dtype)
+            return FeatureMatrix(y, None if x.complete else
+                                 ~x.valid_rows[:, np.newaxis])
+        x = np.ma.dot(x - self.mean.astype(x.dtype), mat.astype(x.dtype),
+                      strict=True) / np.sqrt(vec).astype(x.dtype)
 
         return x
@@ -3,14 +3,19 @@ import logging
 import numpy as np
 
 from uncoverml import mpiops
+from uncoverml.featurematrix import FeatureMatrix
 
 log = logging.getLogger(__name__)
 
 
 def sets(x):
     """
-    works on a masked x
+    works on a masked x, or a FeatureMatrix
     """
+    if isinstance(x, FeatureMatrix):
+        present = ~x.mask
+        return [np.unique(x.data[present[:, i], i])
+                for i in range(x.shape[1])]
     sets = [np.unique(np.ma.compressed(x[:, i])) for i in range(x.shape[1])]
     return sets
 
@@ -32,17 +37,48 @@ def compute_unique_values(x):
     x_sets : list of ndarray or None
         A list of m sets of unique values for each dimension in x
     """
+    return merge_unique_values(local_unique_values(x))
+
+
+def local_unique_values(x, x_sets=None):
+    """add the per-dimension unique values of x on this node to x_sets"""
     # check data is okay
     if x.dtype == np.dtype('float32') or x.dtype == np.dtype('float64'):
         raise ValueError("Can't do one-hot on float data")
-    else:
-        local_sets = sets(x)
-        full_sets = mpiops.comm.allreduce(local_sets, op=mpiops.unique_op)
-    return full_sets
+    local_sets = sets(x)
+    if x_sets is not None:
+        local_sets = mpiops.unique(x_sets, local_sets, None)
+    return local_sets
+
+
+def merge_unique_values(local_sets):
+    """the union of the per-dimension unique values of every node"""
+    return mpiops.comm.allreduce(local_sets, op=mpiops.unique_op)
 
 
 def one_hot(x, x_set, matrices=None):
+    if isinstance(x, FeatureMatrix):
+        # the columns are the dimensions
+        out, indices = _one_hot_data(x.data[:, np.newaxis, np.newaxis],
+                                     x_set, matrices)
+        out_mask = None if x.complete else _one_hot_mask(
+            x.mask[:, np.newaxis, np.newaxis], x_set, indices, out.shape)
+        return FeatureMatrix(out.reshape(len(x), -1), None if out_mask is
+                             None else out_mask.reshape(len(x), -1))
+
     assert x.ndim == 4  # points, patch_x, patch_y, channel
+    out, indices = _one_hot_data(x.data, x_set, matrices)
+
+    if x.mask.ndim != 0:  # all false
+        out_mask = _one_hot_mask(x.mask, x_set, indices, out.shape)
+    else:
+        out_mask = False
+
+    result = np.ma.MaskedArray(data=out, mask=out_mask)
+    return result
+
+
+def _one_hot_data(data, x_set, matrices):
     if matrices:
         out_dim_sizes = np.array([m.shape[1] for m in matrices])
     else:
@@ -50,12 +86,12 @@ def one_hot(x, x_set, matrices=None):
     # The index points in the output array for each input dimension
     indices = np.hstack((np.array([0]), np.cumsum(out_dim_sizes)))
     total_dims = np.sum(out_dim_sizes)
-    out_shape = x.shape[0:3] + (total_dims,)
+    out_shape = data.shape[0:3] + (total_dims,)
     out = np.zeros(out_shape, dtype=float)
 
     for dim_idx, dim_set in enumerate(x_set):
         # input data
-        dim_in = x.data[..., dim_idx]
+        dim_in = data[..., dim_idx]
 
         # appropriate parts of the output_array
         dim_out = out[..., indices[dim_idx]:indices[dim_idx + 1]]
@@ -67,29 +103,37 @@ def one_hot(x, x_set, matrices=None):
                 dim_out[dim_in == val] = proj[i]
             else:
                 dim_out[..., i][dim_in == val] = 0.5
+    return out, indices
 
-    if x.mask.ndim != 0:  # all false
-        out_mask = np.zeros(out_shape, dtype=bool)
-        for dim_idx, dim_set in enumerate(x_set):
-            dim_mask = x.mask[..., dim_idx]
-            dim_out_mask = out_mask[..., indices[dim_idx]:indices[dim_idx + 1]]
-            # broadcast the mask
-            dim_out_mask[:] = dim_mask[..., np.newaxis]
-    else:
-        out_mask = False
 
-    result = np.ma.MaskedArray(data=out, mask=out_mask)
-    return result
+def _one_hot_mask(mask, x_set, indices, out_shape):
+    out_mask = np.zeros(out_shape, dtype=bool)
+    for dim_idx, dim_set in enumerate(x_set):
+        dim_mask = mask[..., dim_idx]
+        dim_out_mask = out_mask[..., indices[dim_idx]:indices[dim_idx + 1]]
+        # broadcast the mask
+        dim_out_mask[:] = dim_mask[..., np.newaxis]
+    return out_mask
 
 
 class OneHotTransform:
     def __init__(self):
         self.x_sets = None
 
+    @property
+    def fitted(self):
+        return self.x_sets is not None
+
+    def accumulate(self, x, x_sets=None):
+        return local_unique_values(x.astype(int), x_sets)
+
+    def fit(self, x_sets):
+        self.x_sets = merge_unique_values(x_sets)
+
     def __call__(self, x):
         x = x.astype(int)
-        if self.x_sets is None:
-            self.x_sets = compute_unique_values(x)
+        if not self.fitted:
+            self.fit(self.accumulate(x))
 
         for s in self.x_sets:
             log.info("One-hot encoding to d={}".format(len(s)))
@@ -103,14 +147,24 @@ class RandomHotTransform:
         self.seed = seed
         self.matrices = None
 
+    @property
+    def fitted(self):
+        return self.matrices is not None
+
+    def accumulate(self, x, x_sets=None):
+        return local_unique_values(x.astype(int), x_sets)
+
+    def fit(self, x_sets):
+        np.random.seed(self.seed)
+        self.x_sets = merge_unique_values(x_sets)
+        nbands = [len(s) for s in self.x_sets]
+        self.matrices = [np.random.randn(k, self.n_features)
+                         for k in nbands]
+
     def __call__(self, x):
         x = x.astype(int)
-        if self.matrices is None:
-            np.random.seed(self.seed)
-            self.x_sets = compute_unique_values(x)
-            nbands = [len(s) for s in self.x_sets]
-            self.matrices = [np.random.randn(k, self.n_features)
-                             for k in nbands]
+        if not self.fitted:
+            self.fit(self.accumulate(x))
         for s in self.x_sets:
             log.info("One-hot encoding to "
                      "d={} space then projecting to d={}".format(
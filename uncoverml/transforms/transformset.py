@@ -4,24 +4,75 @@ import logging
 import numpy as np
 
 from uncoverml import mpiops
+from uncoverml.featurematrix import FeatureMatrix
 
 log = logging.getLogger(__name__)
 
+float_type = np.dtype(np.float64)
+"""numpy.dtype: the floating point type continuous features are computed in.
+Statistics are always accumulated in float64.
+"""
+
+
+def set_precision(precision):
+    """
+    Set the floating point type of the features pipeline-wide.
+
+    Parameters
+    ----------
+    precision : str
+        'float64' (the default) or 'float32', which halves the memory of
+        the features
+    """
+    global float_type
+    if precision not in ('float32', 'float64'):
+        raise ValueError("precision must be float32 or float64, "
+                         "not {}".format(precision))
+    float_type = np.dtype(precision)
+
 
 def build_feature_vector(image_chunks, is_categorical):
-    dtype = int if is_categorical else float
+    """
+    Flatten and concatenate the (N, ...) image chunks into the (N, D)
+    FeatureMatrix the imputer and global transforms work on.
+    """
+    dtype = int if is_categorical else float_type
     for k, im in image_chunks.items():
         image_chunks[k] = im.reshape(im.shape[0], -1).astype(dtype)
-    x_data = np.concatenate([a.data for a in image_chunks.values()], axis=1)
-    x_mask = np.concatenate([a.mask for a in image_chunks.values()], axis=1)
-    x = np.ma.masked_array(data=x_data, mask=x_mask)
-    return x
+    x_data = np.concatenate([np.ma.getdata(a) for a in image_chunks.values()],
+                            axis=1)
+    x_mask = np.concatenate([np.ma.getmaskarray(a)
+                             for a in image_chunks.values()], axis=1)
+    return FeatureMatrix(x_data, x_mask)
+
+
+def accumulate_moments(x, moments=None, covariance=False):
+    """
+    Add the rows of a chunk to the moments a transform is fitted to.
+
+    Parameters
+    ----------
+    x : FeatureMatrix or MaskedArray
+        (N, D) chunk of features
+    moments : Moments, optional
+        the moments of the chunks so far on this node, if any
+    covariance : bool, optional
+        whether the moments include co-moments
+
+    Returns
+    -------
+    moments : Moments
+        the moments including x
+    """
+    if moments is None:
+        return mpiops.Moments.of(x, covariance)
+    return moments.update(x)
 
 
 def missing_percentage(x):
     x_n = np.sum(mpiops.count(x))
     x_full_local = np.product(x.shape)
-    x_full = mpiops.comm.allreduce(x_full_local)
+    x_full = mpiops.allreduce_array(x_full_local)
     missing = (1.0 - x_n / x_full) * 100.0
     return missing
 
@@ -31,6 +82,47 @@ class TransformSet:
             self.global_transforms = (transforms if transforms else [])
             self.imputer = imputer
 
+    def _stages(self):
+        return ([self.imputer] if self.imputer else []) + \
+            self.global_transforms
+
+    @property
+    def fitted(self):
+        """True if every transform has its statistics"""
+        return all(t.fitted for t in self._stages())
+
+    def accumulate(self, x, stats=None):
+        """
+        Add a chunk to the statistics of the first unfitted transform.
+
+        The transforms before it are applied to the chunk first, so calling
+        this on every chunk then `fit` fits one more transform. Repeating
+        that until the set is `fitted` fits the whole set over data that
+        never has to be in memory at once.
+
+        Parameters
+        ----------
+        x : FeatureMatrix
+            a chunk of features
+        stats : object, optional
+            the statistics of the previous chunks, if any
+
+        Returns
+        -------
+        stats : object
+            the statistics including x, to pass with the next chunk
+        """
+        for t in self._stages():
+            if not t.fitted:
+                return t.accumulate(x, stats)
+            x = t(x)
+        return stats
+
+    def fit(self, stats):
+        """Fit the first unfitted transform to statistics from `accumulate`
+        on every node"""
+        next(t for t in self._stages() if not t.fitted).fit(stats)
+
     def __call__(self, x):
         # impute
         if self.imputer:
@@ -53,6 +145,31 @@ class ImageTransformSet(TransformSet):
         self.is_categorical = is_categorical
         super().__init__(imputer, global_transforms)
 
+    @property
+    def fitted(self):
+        return all(t.fitted for level in self.image_transforms
+                   for t in level) and super().fitted
+
+    def accumulate(self, image_chunks, stats=None):
+        transformed_chunks = copy.copy(image_chunks)
+        for level in self.image_transforms:
+            if not all(t.fitted for t in level):
+                stats = stats if stats else [None] * len(level)
+                return [t.accumulate(transformed_chunks[lbl], s)
+                        for t, lbl, s in zip(level, image_chunks, stats)]
+            for t, lbl in zip(level, image_chunks):
+                transformed_chunks[lbl] = t(transformed_chunks[lbl])
+        x = build_feature_vector(transformed_chunks, self.is_categorical)
+        return super().accumulate(x, stats)
+
+    def fit(self, stats):
+        for level in self.image_transforms:
+            if not all(t.fitted for t in level):
+                for t, s in zip(level, stats):
+                    t.fit(s)
+                return
+        super().fit(stats)
+
     def __call__(self, image_chunks):
         transformed_chunks = copy.copy(image_chunks)
         # apply the per-image transforms